@@ -39,6 +39,32 @@ def init_app(app):
         logger.debug(traceback.format_exc())
         # Continue anyway
     
+    try:
+        # Lazy import to avoid circular import issues
+        from .utils.stats_cache import init_stats_cache
+        # Setup agent stats cache and its invalidation
+        init_stats_cache(app)
+    except Exception as e:
+        logger.error(f"Error setting up agent stats cache: {e}")
+        import traceback
+        logger.debug(traceback.format_exc())
+        # Continue anyway
+    
+    try:
+        # Only present when the Agent system is installed in the panel
+        from hiddifypanel.services.traffic_log_buffer import init_traffic_log_buffer
+    except ImportError:
+        init_traffic_log_buffer = None
+    if init_traffic_log_buffer is not None:
+        try:
+            # Configure the buffered TrafficLog writer
+            init_traffic_log_buffer(app)
+        except Exception as e:
+            logger.error(f"Error setting up traffic log buffer: {e}")
+            import traceback
+            logger.debug(traceback.format_exc())
+            # Continue anyway
+    
     try:
         # Lazy import to avoid circular import issues
         from .tasks.periodic_checker import setup_periodic_checker
@@ -93,15 +93,10 @@ def extend_admin_user_view(admin_view):
             # Get traffic_limit_GB from form
             if hasattr(form, 'traffic_limit_GB') and form.traffic_limit_GB.data is not None:
                 # The TrafficLimitField already converts GB to bytes
-                # But we need to save it to the database
-                from hiddifypanel.database import db
                 traffic_limit_bytes = form.traffic_limit_GB.data
                 
-                # Update the model's traffic_limit directly
-                db.session.execute(
-                    db.text("UPDATE admin_user SET traffic_limit = :limit WHERE id = :id"),
-                    {"limit": traffic_limit_bytes, "id": model.id}
-                )
+                # traffic_limit is a mapped column, flushed with the model
+                model.traffic_limit = traffic_limit_bytes
                 logger.debug(f"Updated traffic_limit for admin {model.id}: {traffic_limit_bytes} bytes")
         except Exception as e:
             logger.warning(f"Error handling traffic_limit_GB in on_model_change: {e}")
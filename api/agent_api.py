@@ -1,11 +1,16 @@
 """
 Agent API endpoints for managing agents/resellers
 """
-from flask import current_app as app, g
+import csv
+import io
+import json
+from flask import current_app as app, g, request, Response, stream_with_context
 from flask.views import MethodView
 from apiflask import abort
 from hiddifypanel.auth import login_required
-from hiddifypanel.models import Role, Agent, User, TrafficLog
+from hiddifypanel.models import Role, Agent, TrafficLog
+from hiddifypanel.models.agent import AGENT_SORT_KEYS, AGENT_STATUS_FILTERS
+from hiddifypanel.models.user import ONE_GIG
 from hiddifypanel.database import db
 from marshmallow import Schema, fields, validate
 from datetime import datetime, timedelta
@@ -25,15 +30,38 @@ class AgentSchema(Schema):
     telegram_id = fields.Integer(allow_none=True)
     traffic_limit_GB = fields.Float(allow_none=True, validate=validate.Range(min=0))
     traffic_used_GB = fields.Float(dump_only=True)
+    traffic_allocated_GB = fields.Float(dump_only=True)
     traffic_remaining_GB = fields.Float(dump_only=True, allow_none=True)
     traffic_usage_percentage = fields.Float(dump_only=True, allow_none=True)
     is_traffic_limit_exceeded = fields.Boolean(dump_only=True)
     is_traffic_warning = fields.Boolean(dump_only=True)
     users_count = fields.Integer(dump_only=True)
+    active_users_count = fields.Integer(dump_only=True)
     created_at = fields.DateTime(dump_only=True)
     updated_at = fields.DateTime(dump_only=True)
 
 
+class AgentListQuerySchema(Schema):
+    """Query parameters for listing agents"""
+    limit = fields.Integer(load_default=50, validate=validate.Range(min=1, max=500))
+    cursor = fields.String(load_default=None)
+    sort = fields.String(load_default='id', validate=validate.OneOf(AGENT_SORT_KEYS))
+    order = fields.String(load_default='asc', validate=validate.OneOf(['asc', 'desc']))
+    status = fields.String(load_default=None, validate=validate.OneOf(AGENT_STATUS_FILTERS))
+    projection = fields.String(load_default=None, data_key='fields')
+
+
+# Query parameters that switch GET /agents from the full list to one page
+AGENT_LIST_ARGS = ('limit', 'cursor', 'sort', 'order', 'status', 'fields')
+
+
+class AgentPageSchema(Schema):
+    """Schema for one page of agents"""
+    agents = fields.List(fields.Nested(AgentSchema))
+    next_cursor = fields.String(allow_none=True)
+    count = fields.Integer()
+
+
 class PostAgentSchema(Schema):
     """Schema for creating Agent"""
     name = fields.String(required=True, validate=validate.Length(min=1, max=512))
@@ -59,6 +87,7 @@ class AgentTrafficSchema(Schema):
     agent_id = fields.Integer(dump_only=True)
     traffic_limit_GB = fields.Float(allow_none=True)
     traffic_used_GB = fields.Float()
+    traffic_allocated_GB = fields.Float()
     traffic_remaining_GB = fields.Float(allow_none=True)
     traffic_usage_percentage = fields.Float(allow_none=True)
     is_traffic_limit_exceeded = fields.Boolean()
@@ -68,6 +97,66 @@ class AgentTrafficSchema(Schema):
     total_users_traffic_GB = fields.Float()
 
 
+class TrafficHistoryQuerySchema(Schema):
+    """Query parameters for the traffic history of an agent"""
+    start = fields.DateTime(load_default=None)
+    end = fields.DateTime(load_default=None)
+    resolution = fields.String(load_default=None, validate=validate.OneOf(['hour', 'day']))
+    user_id = fields.Integer(load_default=None)
+
+
+class TrafficBucketSchema(Schema):
+    """One bucket of a traffic history"""
+    bucket = fields.DateTime()
+    used_traffic_GB = fields.Float()
+    entries = fields.Integer()
+
+
+class TrafficHistorySchema(Schema):
+    """Schema for the traffic history of an agent"""
+    agent_id = fields.Integer()
+    resolution = fields.String()
+    total_GB = fields.Float()
+    buckets = fields.List(fields.Nested(TrafficBucketSchema))
+
+
+class TrafficLogQuerySchema(Schema):
+    """Query parameters for the traffic logs of an agent"""
+    start = fields.DateTime(load_default=None)
+    end = fields.DateTime(load_default=None)
+    user_id = fields.Integer(load_default=None)
+    order = fields.String(load_default='desc', validate=validate.OneOf(['asc', 'desc']))
+    limit = fields.Integer(load_default=100, validate=validate.Range(min=1, max=1000))
+    cursor = fields.String(load_default=None)
+
+
+class TrafficLogExportQuerySchema(Schema):
+    """Query parameters for exporting the traffic logs of an agent"""
+    start = fields.DateTime(load_default=None)
+    end = fields.DateTime(load_default=None)
+    user_id = fields.Integer(load_default=None)
+    order = fields.String(load_default='asc', validate=validate.OneOf(['asc', 'desc']))
+    format = fields.String(load_default='ndjson', validate=validate.OneOf(['ndjson', 'csv']))
+
+
+class TrafficLogSchema(Schema):
+    """Schema for one traffic log"""
+    id = fields.Integer()
+    user_id = fields.Integer(allow_none=True)
+    agent_id = fields.Integer(allow_none=True)
+    used_traffic = fields.Integer()
+    used_traffic_GB = fields.Float()
+    timestamp = fields.DateTime()
+    description = fields.String(allow_none=True)
+
+
+class TrafficLogPageSchema(Schema):
+    """Schema for one page of traffic logs"""
+    logs = fields.List(fields.Nested(TrafficLogSchema))
+    next_cursor = fields.String(allow_none=True)
+    count = fields.Integer()
+
+
 class SuccessfulSchema(Schema):
     """Schema for successful response"""
     status = fields.Integer()
@@ -144,11 +233,49 @@ class AgentsApi(MethodView):
     """API for listing and creating agents"""
     decorators = [login_required({Role.super_admin, Role.admin})]
 
-    @app.output(AgentSchema(many=True))
-    def get(self):
-        """List all agents"""
-        agents = Agent.get_all()
-        return [agent.to_dict(dump_id=True) for agent in agents]
+    @app.input(AgentListQuerySchema, location='query', arg_name='query')
+    def get(self, query: dict):
+        """List agents
+        
+        Without query parameters every agent is returned as a list, as before.
+        With any of limit, cursor, sort (id|used|remaining|usage_percentage),
+        order (asc|desc), status (exceeded|warning|unlimited|limited) or
+        fields (comma separated projection) one keyset-paginated page is
+        returned with next_cursor.
+        """
+        if not any(arg in request.args for arg in AGENT_LIST_ARGS):
+            return AgentSchema(many=True).dump([agent.to_dict(dump_id=True) for agent in Agent.get_all()])
+        
+        projection = None
+        if query.get('projection'):
+            projection = [name.strip() for name in query['projection'].split(',') if name.strip()]
+            unknown = set(projection) - set(AgentSchema().fields)
+            if unknown:
+                abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+        
+        try:
+            agents, next_cursor = Agent.get_page(
+                limit=query['limit'],
+                cursor=query.get('cursor'),
+                sort=query['sort'],
+                descending=query['order'] == 'desc',
+                status=query.get('status')
+            )
+        except ValueError as e:
+            abort(400, str(e))
+        
+        items = []
+        for agent in agents:
+            item = agent.to_dict(dump_id=True)
+            if projection:
+                item = {name: item.get(name) for name in projection}
+            items.append(item)
+        
+        return AgentPageSchema().dump({
+            'agents': items,
+            'next_cursor': next_cursor,
+            'count': len(items)
+        })
 
     @app.input(PostAgentSchema, arg_name='data')
     @app.output(AgentSchema)
@@ -186,35 +313,163 @@ class AgentTrafficApi(MethodView):
 
     @app.output(AgentTrafficSchema)
     def get(self, uuid: str):
-        """Get agent traffic statistics"""
+        """Get agent traffic statistics (read-only)"""
         agent = Agent.by_uuid(uuid)
         if not agent:
             abort(404, "Agent not found")
         
-        # Update traffic_used from users
-        agent.update_traffic_used(commit=False)
-        
-        # Get active users count
-        active_users_count = agent.users.filter(User.enable == True).count()
-        
-        # Get total users traffic
-        from sqlalchemy import func
-        total_users_traffic = db.session.query(
-            func.coalesce(func.sum(User.current_usage), 0)
-        ).filter(
-            User.agent_id == agent.id
-        ).scalar() or 0
-        
+        # The counters are maintained by the User listeners and reconciled by
+        # the periodic job, so nothing is recomputed or written here
         return {
             'agent_id': agent.id,
             'traffic_limit_GB': agent.traffic_limit_GB,
             'traffic_used_GB': agent.traffic_used_GB,
+            'traffic_allocated_GB': agent.traffic_allocated_GB,
             'traffic_remaining_GB': agent.traffic_remaining_GB,
             'traffic_usage_percentage': agent.traffic_usage_percentage,
             'is_traffic_limit_exceeded': agent.is_traffic_limit_exceeded,
             'is_traffic_warning': agent.is_traffic_warning,
-            'users_count': agent.users.count(),
-            'active_users_count': active_users_count,
-            'total_users_traffic_GB': total_users_traffic / (1024 ** 3)
+            'users_count': agent.users_count or 0,
+            'active_users_count': agent.active_users_count or 0,
+            'total_users_traffic_GB': agent.traffic_used_GB
         }
 
+
+class AgentTrafficHistoryApi(MethodView):
+    """API for the traffic history of an agent, read from the rollup tables"""
+    decorators = [login_required({Role.super_admin, Role.admin, Role.agent})]
+
+    @app.input(TrafficHistoryQuerySchema, location='query', arg_name='query')
+    @app.output(TrafficHistorySchema)
+    def get(self, uuid: str, query: dict):
+        """Get agent traffic per hour or per day (default: last 30 days)
+        
+        Ranges up to two days are returned per hour, longer ones per day,
+        unless resolution=hour|day is given.
+        """
+        from hiddifypanel.services.traffic_rollup import HOURLY_SERIES_MAX_RANGE, get_traffic_series
+        
+        agent = Agent.by_uuid(uuid)
+        if not agent:
+            abort(404, "Agent not found")
+        
+        end = query.get('end') or datetime.utcnow()
+        start = query.get('start') or end - timedelta(days=30)
+        if start >= end:
+            abort(400, "start must be before end")
+        resolution = query.get('resolution') or ('hour' if end - start <= HOURLY_SERIES_MAX_RANGE else 'day')
+        
+        buckets = get_traffic_series(
+            agent_id=agent.id,
+            user_id=query.get('user_id'),
+            start=start,
+            end=end,
+            resolution=resolution
+        )
+        return {
+            'agent_id': agent.id,
+            'resolution': resolution,
+            'total_GB': sum(bucket['used_traffic'] for bucket in buckets) / ONE_GIG,
+            'buckets': [
+                {
+                    'bucket': bucket['bucket'],
+                    'used_traffic_GB': bucket['used_traffic'] / ONE_GIG,
+                    'entries': bucket['entries']
+                }
+                for bucket in buckets
+            ]
+        }
+
+
+# Columns of the CSV export, in order
+TRAFFIC_LOG_EXPORT_COLUMNS = ('id', 'timestamp', 'agent_id', 'user_id', 'used_traffic', 'description')
+
+
+class AgentTrafficLogsApi(MethodView):
+    """API for the traffic logs of an agent, one keyset-paginated page at a time"""
+    decorators = [login_required({Role.super_admin, Role.admin, Role.agent})]
+
+    @app.input(TrafficLogQuerySchema, location='query', arg_name='query')
+    @app.output(TrafficLogPageSchema)
+    def get(self, uuid: str, query: dict):
+        """Get agent traffic logs (newest first unless order=asc)
+        
+        Pass next_cursor back as cursor to get the following page. Rows
+        moved to the archive (TRAFFIC_LOG_ARCHIVE_DAYS) are not listed.
+        """
+        agent = Agent.by_uuid(uuid)
+        if not agent:
+            abort(404, "Agent not found")
+        
+        try:
+            logs, next_cursor = TrafficLog.get_logs_page(
+                agent_id=agent.id,
+                user_id=query.get('user_id'),
+                start_date=query.get('start'),
+                end_date=query.get('end'),
+                limit=query['limit'],
+                cursor=query.get('cursor'),
+                descending=query['order'] == 'desc'
+            )
+        except ValueError as e:
+            abort(400, str(e))
+        
+        return {
+            'logs': [log.to_dict() for log in logs],
+            'next_cursor': next_cursor,
+            'count': len(logs)
+        }
+
+
+class AgentTrafficLogsExportApi(MethodView):
+    """API streaming all traffic logs of an agent as NDJSON or CSV"""
+    decorators = [login_required({Role.super_admin, Role.admin, Role.agent})]
+
+    @app.input(TrafficLogExportQuerySchema, location='query', arg_name='query')
+    def get(self, uuid: str, query: dict):
+        """Export agent traffic logs (oldest first unless order=desc)
+        
+        The response is generated while it is sent, a batch of rows at a
+        time, so the worker's memory does not grow with the range. Rows
+        moved to the archive (TRAFFIC_LOG_ARCHIVE_DAYS) are not exported.
+        """
+        agent = Agent.by_uuid(uuid)
+        if not agent:
+            abort(404, "Agent not found")
+        
+        logs = TrafficLog.iter_logs(
+            agent_id=agent.id,
+            user_id=query.get('user_id'),
+            start_date=query.get('start'),
+            end_date=query.get('end'),
+            descending=query['order'] == 'desc'
+        )
+        
+        if query['format'] == 'csv':
+            body, mimetype = _csv_lines(logs), 'text/csv'
+        else:
+            body, mimetype = (json.dumps(log) + '\n' for log in logs), 'application/x-ndjson'
+        
+        filename = f"agent-{agent.id}-traffic.{query['format']}"
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+
+
+def _csv_lines(logs):
+    """CSV text of logs, one line per yielded chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    def line(values) -> str:
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+    
+    yield line(TRAFFIC_LOG_EXPORT_COLUMNS)
+    for log in logs:
+        yield line([log[column] for column in TRAFFIC_LOG_EXPORT_COLUMNS])
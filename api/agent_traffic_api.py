@@ -10,8 +10,10 @@ from loguru import logger
 
 from hiddifypanel.models.admin import AdminUser, AdminMode
 from hiddifypanel.database import db
+from ..utils.agent_listing import AGENT_SORT_KEYS, AGENT_STATUS_FILTERS
 from ..utils.traffic_calculator import AgentTrafficCalculator
 from ..utils.traffic_checker import AgentTrafficChecker
+from ..utils.stats_cache import agent_stats_cache
 
 agent_traffic_bp = APIBlueprint('agent_traffic', __name__)
 
@@ -29,6 +31,7 @@ class AgentTrafficStatsSchema(BaseModel):
     total_traffic_GB: float
     traffic_limit_GB: Optional[float]
     remaining_traffic_GB: Optional[float]
+    allocated_traffic_GB: float
     is_limit_exceeded: bool
     users_count: int
     active_users_count: int
@@ -38,11 +41,17 @@ class AgentTrafficStatsSchema(BaseModel):
 @agent_traffic_bp.get('/agents/<int:agent_id>/traffic')
 @output(AgentTrafficStatsSchema)
 def get_agent_traffic(agent_id: int):
-    """دریافت آمار ترافیک یک ایجنت"""
+    """دریافت آمار ترافیک یک ایجنت
+    
+    Served from the process-local stats cache, so the figures can be up to
+    AGENT_TRAFFIC_STATS_CACHE_TTL seconds stale when another process (e.g.
+    a Celery worker) changed them.
+    """
     agent = AdminUser.query.get(agent_id)
     if not agent:
         return {'error': 'Agent not found'}, 404
     
+    # Checked before the cache, since the mode may have changed elsewhere
     if agent.mode != AdminMode.agent:
         return {'error': 'User is not an agent'}, 400
     
@@ -50,6 +59,21 @@ def get_agent_traffic(agent_id: int):
     return stats
 
 
+@agent_traffic_bp.get('/agents/traffic-stats-cache')
+def get_traffic_stats_cache_info():
+    """وضعیت کش آمار ترافیک (hit/miss)"""
+    return agent_stats_cache.info()
+
+
+@agent_traffic_bp.get('/agents/check-schedule')
+def get_agents_check_schedule():
+    """ترتیب بررسی ایجنت‌ها در زمان‌بند تطبیقی (نزدیک‌ترین بررسی اول)"""
+    from ..tasks.adaptive_scheduler import get_check_schedule
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    return {'agents': get_check_schedule(limit)}
+
+
 @agent_traffic_bp.put('/agents/<int:agent_id>/traffic-limit')
 @input(TrafficLimitSchema)
 def set_agent_traffic_limit(agent_id: int, json_data: dict):
@@ -85,12 +109,54 @@ def set_agent_traffic_limit(agent_id: int, json_data: dict):
 
 @agent_traffic_bp.get('/agents/traffic')
 def get_all_agents_traffic():
-    """دریافت ترافیک تمام ایجنت‌ها"""
+    """دریافت ترافیک تمام ایجنت‌ها
+    
+    Without query parameters every agent is returned. With any of limit,
+    cursor, sort (id|used|remaining|usage_percentage), order (asc|desc),
+    status (exceeded|warning|unlimited|limited) or fields (comma separated
+    projection) one keyset-paginated page is returned with next_cursor.
+    """
+    paginated_args = ('limit', 'cursor', 'sort', 'order', 'status', 'fields')
     try:
-        agents_traffic = AgentTrafficCalculator.get_all_agents_traffic()
+        if not any(arg in request.args for arg in paginated_args):
+            agents_traffic = AgentTrafficCalculator.get_all_agents_traffic()
+            return {
+                'agents': agents_traffic,
+                'count': len(agents_traffic)
+            }
+        
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        except ValueError:
+            return {'error': 'limit must be an integer'}, 400
+        
+        sort = request.args.get('sort', 'id')
+        if sort not in AGENT_SORT_KEYS:
+            return {'error': f'sort must be one of {", ".join(AGENT_SORT_KEYS)}'}, 400
+        
+        status = request.args.get('status')
+        if status is not None and status not in AGENT_STATUS_FILTERS:
+            return {'error': f'status must be one of {", ".join(AGENT_STATUS_FILTERS)}'}, 400
+        
+        try:
+            agents_traffic, next_cursor = AgentTrafficCalculator.get_agents_traffic_page(
+                limit=limit,
+                cursor=request.args.get('cursor'),
+                sort=sort,
+                descending=request.args.get('order', 'asc') == 'desc',
+                status=status
+            )
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        
+        projection = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+        if projection:
+            agents_traffic = [{name: item.get(name) for name in projection} for item in agents_traffic]
+        
         return {
             'agents': agents_traffic,
-            'count': len(agents_traffic)
+            'count': len(agents_traffic),
+            'next_cursor': next_cursor
         }
     except Exception as e:
         logger.error(f"Error getting agents traffic: {e}")
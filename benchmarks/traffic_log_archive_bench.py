@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the columnar traffic log archive against the traffic_log table
+
+Fills a copy of traffic_log (with the same indexes) in a scratch SQLite
+database, writes the same rows to a TrafficLogArchive, and compares the size
+on disk and the time of a range sum and of per-user totals for every agent:
+
+    python traffic_log_archive_bench.py --rows 2000000
+    python traffic_log_archive_bench.py --rows 500000 --agents 20 --months 6
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, func, select
+
+
+def create_scratch_table(engine):
+    """Copy of traffic_log with its indexes, without foreign keys"""
+    from hiddifypanel.models import TrafficLog
+
+    metadata = MetaData()
+    columns = [
+        Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+        for column in TrafficLog.__table__.columns
+    ]
+    indexes = [
+        Index(f"bench_{index.name}", *[column.name for column in index.columns])
+        for index in TrafficLog.__table__.indexes
+    ]
+    table = Table('bench_traffic_log', metadata, *columns, *indexes)
+    metadata.create_all(engine)
+    return table
+
+
+def generate_rows(count: int, agents: int, users_per_agent: int, start: datetime, months: int):
+    seconds = months * 30 * 86400
+    for log_id in range(1, count + 1):
+        agent_id = random.randint(1, agents)
+        yield {
+            'id': log_id,
+            'agent_id': agent_id,
+            'user_id': agent_id * 10000 + random.randint(1, users_per_agent),
+            'used_traffic': random.randint(1, 50 * 1024 ** 2),
+            'timestamp': start + timedelta(seconds=random.randint(0, seconds)),
+            'description': 'User traffic usage',
+        }
+
+
+def fill(engine, table, archive, rows: list):
+    from hiddifypanel.services.traffic_log_archive import rows_to_columns
+    from hiddifypanel.services.traffic_log_partitions import month_start
+
+    with engine.begin() as conn:
+        conn.execute(table.insert(), rows)
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['agent_id'], month_start(row['timestamp'])), []).append(row)
+    for (agent_id, month), group in groups.items():
+        archive.append(agent_id, month, rows_to_columns(group))
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def timed(func, *args) -> tuple:
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--agents', type=int, default=50)
+    parser.add_argument('--users', type=int, default=200, help='users per agent')
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--chunk', type=int, default=100000)
+    args = parser.parse_args()
+
+    from hiddifypanel.services.traffic_log_archive import TrafficLogArchive
+
+    workdir = tempfile.mkdtemp(prefix='traffic_archive_bench_')
+    db_path = os.path.join(workdir, 'traffic_log.db')
+    engine = create_engine(f"sqlite:///{db_path}")
+    table = create_scratch_table(engine)
+    archive = TrafficLogArchive(os.path.join(workdir, 'archive'))
+
+    start = datetime(2025, 1, 1)
+    rows = generate_rows(args.rows, args.agents, args.users, start, args.months)
+    while True:
+        chunk = [row for _, row in zip(range(args.chunk), rows)]
+        if not chunk:
+            break
+        fill(engine, table, archive, chunk)
+    # Closed months are compacted by archive_traffic_logs()
+    for agent_id in archive.agents():
+        for month in archive.months(agent_id):
+            archive.compact(agent_id, month)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('VACUUM')
+
+    # One month in the middle of the range, for every agent
+    range_start = start + timedelta(days=15)
+    range_end = range_start + timedelta(days=30)
+
+    def sql_range_sums():
+        with engine.connect() as conn:
+            return [conn.execute(select(func.sum(table.c.used_traffic)).where(
+                table.c.agent_id == agent_id,
+                table.c.timestamp >= range_start,
+                table.c.timestamp < range_end
+            )).scalar() or 0 for agent_id in range(1, args.agents + 1)]
+
+    def archive_range_sums():
+        return [archive.range_sum(agent_id, range_start, range_end) for agent_id in range(1, args.agents + 1)]
+
+    def sql_user_totals():
+        with engine.connect() as conn:
+            return [dict(conn.execute(
+                select(table.c.user_id, func.sum(table.c.used_traffic))
+                .where(table.c.agent_id == agent_id).group_by(table.c.user_id)
+            ).all()) for agent_id in range(1, args.agents + 1)]
+
+    def archive_user_totals():
+        return [archive.user_totals(agent_id) for agent_id in range(1, args.agents + 1)]
+
+    sql_sums, sql_sums_time = timed(sql_range_sums)
+    archive_sums, archive_sums_time = timed(archive_range_sums)
+    sql_totals, sql_totals_time = timed(sql_user_totals)
+    archive_totals, archive_totals_time = timed(archive_user_totals)
+    assert sql_sums == archive_sums, "range sums differ"
+    assert sql_totals == archive_totals, "user totals differ"
+
+    table_size = os.path.getsize(db_path)
+    archive_size = directory_size(archive.root)
+    print(f"rows: {args.rows:,} ({args.agents} agents x {args.months} months)")
+    print(f"size     : table+indexes {table_size / 1024 ** 2:,.1f} MB, archive {archive_size / 1024 ** 2:,.1f} MB "
+          f"({table_size / archive_size:.1f}x smaller)")
+    print(f"range sum: sql {sql_sums_time * 1000:,.1f} ms, archive {archive_sums_time * 1000:,.1f} ms "
+          f"({sql_sums_time / archive_sums_time:.1f}x)")
+    print(f"per-user : sql {sql_totals_time * 1000:,.1f} ms, archive {archive_totals_time * 1000:,.1f} ms "
+          f"({sql_totals_time / archive_totals_time:.1f}x)")
+
+    shutil.rmtree(workdir)
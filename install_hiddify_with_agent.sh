@@ -177,6 +177,22 @@ cp services/traffic_service.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
     echo -e "${YELLOW}⚠ Could not copy traffic_service.py (might need manual copy)${NC}"
 }
 
+cp services/traffic_log_buffer.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
+    echo -e "${YELLOW}⚠ Could not copy traffic_log_buffer.py (might need manual copy)${NC}"
+}
+
+cp services/traffic_rollup.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
+    echo -e "${YELLOW}⚠ Could not copy traffic_rollup.py (might need manual copy)${NC}"
+}
+
+cp services/traffic_log_partitions.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
+    echo -e "${YELLOW}⚠ Could not copy traffic_log_partitions.py (might need manual copy)${NC}"
+}
+
+cp services/traffic_log_archive.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
+    echo -e "${YELLOW}⚠ Could not copy traffic_log_archive.py (might need manual copy)${NC}"
+}
+
 cp services/__init__.py "$HIDDIFY_SOURCE/hiddifypanel/services/" || {
     echo -e "${YELLOW}⚠ Could not copy services/__init__.py (might need manual copy)${NC}"
 }
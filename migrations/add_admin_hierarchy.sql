@@ -0,0 +1,17 @@
+-- Migration script to create the admin_hierarchy closure table
+-- One row per (ancestor, descendant) pair of admin_user, including (id, id, 0)
+-- Backfill it with: python backfill_admin_hierarchy.py
+
+CREATE TABLE IF NOT EXISTS admin_hierarchy (
+    ancestor_id INTEGER NOT NULL,
+    descendant_id INTEGER NOT NULL,
+    depth INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (ancestor_id, descendant_id),
+    FOREIGN KEY (ancestor_id) REFERENCES admin_user (id) ON DELETE CASCADE,
+    FOREIGN KEY (descendant_id) REFERENCES admin_user (id) ON DELETE CASCADE
+);
+
+-- IF NOT EXISTS works on MariaDB, PostgreSQL and SQLite. MySQL has no such
+-- clause: remove "IF NOT EXISTS" there, and on a second run ignore the
+-- duplicate key name error (1061) of this statement only
+CREATE INDEX IF NOT EXISTS idx_admin_hierarchy_descendant ON admin_hierarchy (descendant_id, ancestor_id);
@@ -0,0 +1,10 @@
+-- Migration script to add the allocated-traffic counter to the agent table
+-- traffic_allocated = SUM(usage_limit) of the agent's users; maintained by the
+-- User listeners in services/traffic_service.py and corrected by
+-- reconcile_agents_traffic()
+
+ALTER TABLE agent ADD COLUMN traffic_allocated BIGINT NOT NULL DEFAULT 0;
+
+-- Backfill from the user table
+UPDATE agent SET
+    traffic_allocated = (SELECT COALESCE(SUM(user.usage_limit), 0) FROM user WHERE user.agent_id = agent.id);
@@ -0,0 +1,11 @@
+-- Migration script to add denormalized user counters to the agent table
+-- Maintained by the User listeners in services/traffic_service.py and
+-- corrected by reconcile_agents_traffic()
+
+ALTER TABLE agent ADD COLUMN users_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE agent ADD COLUMN active_users_count INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill from the user table
+UPDATE agent SET
+    users_count = (SELECT COUNT(*) FROM user WHERE user.agent_id = agent.id),
+    active_users_count = (SELECT COUNT(*) FROM user WHERE user.agent_id = agent.id AND user.enable = 1);
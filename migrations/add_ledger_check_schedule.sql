@@ -0,0 +1,9 @@
+-- Migration script to add the adaptive checker state to agent_traffic_ledger
+-- (init_traffic_ledger() adds these columns automatically)
+
+ALTER TABLE agent_traffic_ledger ADD COLUMN usage_rate FLOAT NOT NULL DEFAULT 0;
+ALTER TABLE agent_traffic_ledger ADD COLUMN sampled_consumed BIGINT;
+ALTER TABLE agent_traffic_ledger ADD COLUMN sampled_at DATETIME;
+ALTER TABLE agent_traffic_ledger ADD COLUMN next_check_at DATETIME;
+
+CREATE INDEX idx_agent_traffic_ledger_next_check ON agent_traffic_ledger (next_check_at);
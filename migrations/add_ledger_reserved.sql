@@ -0,0 +1,13 @@
+-- Migration script to add the reserved counter to agent_traffic_ledger
+-- reserved = SUM(usage_limit) of the users under each admin; new users are
+-- admitted by an atomic conditional UPDATE of this column
+-- (init_traffic_ledger() adds the column and reconciles it automatically)
+
+ALTER TABLE agent_traffic_ledger ADD COLUMN reserved BIGINT NOT NULL DEFAULT 0;
+
+-- Backfill from the user table through the admin_hierarchy closure table
+UPDATE agent_traffic_ledger SET reserved = (
+    SELECT COALESCE(SUM(user.usage_limit), 0)
+    FROM user JOIN admin_hierarchy ON admin_hierarchy.descendant_id = user.added_by
+    WHERE admin_hierarchy.ancestor_id = agent_traffic_ledger.admin_id
+);
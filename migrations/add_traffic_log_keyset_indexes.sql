@@ -0,0 +1,7 @@
+-- Migration script to add the indexes used by the keyset-paginated
+-- TrafficLog queries (WHERE agent_id/user_id = ? ORDER BY timestamp, id)
+-- The month tables of TRAFFIC_LOG_PARTITIONING = 'tables' are created with
+-- them already
+
+CREATE INDEX idx_traffic_log_agent_timestamp ON traffic_log (agent_id, timestamp);
+CREATE INDEX idx_traffic_log_user_timestamp ON traffic_log (user_id, timestamp);
@@ -0,0 +1,32 @@
+-- Migration script to add the hourly/daily rollup tables of traffic_log
+-- Filled incrementally by services/traffic_rollup.py (periodic task
+-- agent_traffic.rollup_logs); agent_id 0 / user_id 0 rows hold the totals
+-- of all agents / all users
+
+CREATE TABLE IF NOT EXISTS traffic_rollup_hourly (
+    agent_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    bucket DATETIME NOT NULL,
+    used_traffic BIGINT NOT NULL DEFAULT 0,
+    entries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (agent_id, user_id, bucket)
+);
+CREATE INDEX idx_traffic_rollup_hourly_user ON traffic_rollup_hourly (user_id, bucket);
+
+CREATE TABLE IF NOT EXISTS traffic_rollup_daily (
+    agent_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    bucket DATETIME NOT NULL,
+    used_traffic BIGINT NOT NULL DEFAULT 0,
+    entries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (agent_id, user_id, bucket)
+);
+CREATE INDEX idx_traffic_rollup_daily_user ON traffic_rollup_daily (user_id, bucket);
+
+-- Last traffic_log.id already rolled up; the first run starts from 0 and
+-- works through the existing rows in batches
+CREATE TABLE IF NOT EXISTS traffic_rollup_watermark (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    last_log_id BIGINT NOT NULL DEFAULT 0,
+    updated_at DATETIME NOT NULL
+);
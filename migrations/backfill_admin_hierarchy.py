@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Migration script to create and backfill the admin_hierarchy closure table
+"""
+import sys
+
+
+def migrate():
+    """Create admin_hierarchy if needed and rebuild it from parent_admin_id"""
+    from loguru import logger
+    
+    try:
+        from hiddifypanel.database import db
+        from hiddify_agent_traffic_manager.models.admin_hierarchy import AdminHierarchy, rebuild_admin_hierarchy
+        
+        AdminHierarchy.__table__.create(db.engine, checkfirst=True)
+        rows = rebuild_admin_hierarchy()
+        logger.success(f"admin_hierarchy backfilled with {rows} rows")
+        return True
+    except Exception as e:
+        logger.error(f"Error backfilling admin_hierarchy: {e}")
+        import traceback
+        logger.debug(traceback.format_exc())
+        return False
+
+
+if __name__ == '__main__':
+    try:
+        from hiddifypanel import create_app
+        app = create_app()
+        with app.app_context():
+            success = migrate()
+            sys.exit(0 if success else 1)
+    except (ImportError, RuntimeError) as e:
+        print(f"Error: Could not initialize HiddifyPanel app ({e})")
+        sys.exit(1)
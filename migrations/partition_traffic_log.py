@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Migration script to partition traffic_log by month
+
+Uses TRAFFIC_LOG_PARTITIONING from the app config:
+- 'native' (MySQL/MariaDB): rebuilds traffic_log as a RANGE-partitioned table
+  (drops its foreign keys, primary key becomes (id, timestamp))
+- 'tables': rolls the pending rows up, then moves the rows of traffic_log
+  into the traffic_log_YYYYMM tables
+"""
+import sys
+from datetime import timedelta
+
+
+def migrate():
+    """Partition traffic_log according to TRAFFIC_LOG_PARTITIONING"""
+    from loguru import logger
+    
+    try:
+        from hiddifypanel.database import db
+        from hiddifypanel.services.traffic_log_partitions import traffic_log_router
+        from hiddifypanel.services.traffic_rollup import init_traffic_rollups, rollup_all_traffic_logs
+        
+        mode = traffic_log_router.mode
+        if mode == 'none':
+            logger.error("Set TRAFFIC_LOG_PARTITIONING to 'native' or 'tables' first")
+            return False
+        
+        if mode == 'native':
+            with db.engine.begin() as connection:
+                if traffic_log_router.partitions(connection):
+                    logger.info("traffic_log is already partitioned")
+                    return True
+                names = traffic_log_router.partition_native_table(connection)
+            logger.success(f"traffic_log partitioned into {len(names)} monthly partitions")
+            return True
+        
+        # Every moved row must already be in the rollups: a month table that
+        # exists already has a watermark above the moved ids
+        init_traffic_rollups()
+        rollup_all_traffic_logs(max_batches=10000, lag=timedelta(0))
+        with db.engine.begin() as connection:
+            moved = traffic_log_router.move_legacy_rows(connection)
+            created = traffic_log_router.ensure_partitions(connection)
+        logger.success(f"Moved {moved} traffic_log rows into month tables, created {created}")
+        return True
+    except Exception as e:
+        logger.error(f"Error partitioning traffic_log: {e}")
+        import traceback
+        logger.debug(traceback.format_exc())
+        return False
+
+
+if __name__ == '__main__':
+    try:
+        from hiddifypanel import create_app
+        app = create_app()
+        with app.app_context():
+            success = migrate()
+            sys.exit(0 if success else 1)
+    except (ImportError, RuntimeError) as e:
+        print(f"Error: Could not initialize HiddifyPanel app ({e})")
+        sys.exit(1)
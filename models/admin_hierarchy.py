@@ -0,0 +1,206 @@
+"""
+Closure table for the admin_user hierarchy
+جدول closure برای سلسله‌مراتب ادمین‌ها و زیرمجموعه‌هایشان
+"""
+from sqlalchemy import Column, Integer, ForeignKey, Index, event, select
+from loguru import logger
+
+from hiddifypanel.database import db
+from hiddifypanel.models.admin import AdminUser
+
+# Same depth limit as AdminUser.recursive_sub_admins_ids()
+MAX_DEPTH = 20
+
+
+class AdminHierarchy(db.Model):
+    """
+    Ancestor/descendant pairs of admin_user
+
+    Every admin has a (id, id, 0) row for itself and one row per ancestor, so
+    "all admins under X" is a single indexed lookup on ancestor_id.
+    """
+    __tablename__ = 'admin_hierarchy'
+
+    ancestor_id = Column(Integer, ForeignKey('admin_user.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey('admin_user.id', ondelete='CASCADE'), primary_key=True)
+    depth = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_admin_hierarchy_descendant', 'descendant_id', 'ancestor_id'),
+    )
+
+    @classmethod
+    def descendant_ids_select(cls, ancestor_id: int):
+        """SELECT of the admin ids under ancestor_id (including itself)"""
+        return select(cls.descendant_id).where(cls.ancestor_id == ancestor_id)
+
+
+def _parent_id(admin_id, parent_admin_id):
+    """Return the effective parent, treating self-parented admins as roots"""
+    if parent_admin_id is None or parent_admin_id == admin_id:
+        return None
+    return parent_admin_id
+
+
+def _ancestors_of(connection, admin_id: int) -> list:
+    """(ancestor_id, depth) rows of admin_id, including itself"""
+    table = AdminHierarchy.__table__
+    return connection.execute(
+        select(table.c.ancestor_id, table.c.depth).where(table.c.descendant_id == admin_id)
+    ).all()
+
+
+def _subtree_of(connection, admin_id: int) -> list:
+    """(descendant_id, depth) rows under admin_id, including itself"""
+    table = AdminHierarchy.__table__
+    return connection.execute(
+        select(table.c.descendant_id, table.c.depth).where(table.c.ancestor_id == admin_id)
+    ).all()
+
+
+def _is_in_subtree(connection, admin_id: int, parent_id) -> bool:
+    """True if parent_id is admin_id or one of its sub-admins"""
+    if parent_id is None:
+        return False
+    table = AdminHierarchy.__table__
+    return connection.execute(
+        select(table.c.descendant_id).where(
+            table.c.ancestor_id == admin_id,
+            table.c.descendant_id == parent_id
+        )
+    ).first() is not None
+
+
+def _link_subtree(connection, admin_id: int, parent_id):
+    """Attach the subtree rooted at admin_id below parent_id"""
+    if parent_id is None:
+        return
+
+    subtree = _subtree_of(connection, admin_id)
+    subtree_ids = {descendant_id for descendant_id, _ in subtree}
+    if parent_id in subtree_ids:
+        logger.error(f"Admin {admin_id} cannot be moved under its own sub-admin {parent_id}")
+        return
+
+    rows = [
+        {'ancestor_id': ancestor_id, 'descendant_id': descendant_id, 'depth': ancestor_depth + depth + 1}
+        for ancestor_id, ancestor_depth in _ancestors_of(connection, parent_id)
+        for descendant_id, depth in subtree
+    ]
+    if rows:
+        connection.execute(AdminHierarchy.__table__.insert(), rows)
+
+
+def _unlink_subtree(connection, admin_id: int):
+    """Detach the subtree rooted at admin_id from all of its former ancestors"""
+    table = AdminHierarchy.__table__
+    subtree_ids = [descendant_id for descendant_id, _ in _subtree_of(connection, admin_id)]
+    if not subtree_ids:
+        return
+    connection.execute(
+        table.delete().where(
+            table.c.descendant_id.in_(subtree_ids),
+            table.c.ancestor_id.notin_(subtree_ids)
+        )
+    )
+
+
+def admin_after_insert(mapper, connection, target):
+    """Add closure rows for a new admin"""
+    connection.execute(
+        AdminHierarchy.__table__.insert(),
+        [{'ancestor_id': target.id, 'descendant_id': target.id, 'depth': 0}]
+    )
+    _link_subtree(connection, target.id, _parent_id(target.id, target.parent_admin_id))
+
+
+def admin_before_update(mapper, connection, target):
+    """Refuse a parent_admin_id change that would make the admin its own ancestor"""
+    from sqlalchemy.orm import attributes
+
+    if not attributes.get_history(target, 'parent_admin_id').has_changes():
+        return
+
+    parent_id = _parent_id(target.id, target.parent_admin_id)
+    if _is_in_subtree(connection, target.id, parent_id):
+        # Raised before anything is written, so the flush rolls back cleanly
+        raise ValueError(f"Admin {target.id} cannot be moved under its own sub-admin {parent_id}")
+
+
+def admin_after_update(mapper, connection, target):
+    """Move the admin's subtree when parent_admin_id changes"""
+    from sqlalchemy.orm import attributes
+
+    history = attributes.get_history(target, 'parent_admin_id')
+    if not history.has_changes():
+        return
+
+    parent_id = _parent_id(target.id, target.parent_admin_id)
+    if _is_in_subtree(connection, target.id, parent_id):
+        # Keep the current closure rather than leaving the subtree detached
+        logger.error(f"Admin {target.id} cannot be moved under its own sub-admin {parent_id}")
+        return
+
+    _unlink_subtree(connection, target.id)
+    _link_subtree(connection, target.id, parent_id)
+
+
+def admin_after_delete(mapper, connection, target):
+    """Remove every closure row that references the deleted admin"""
+    table = AdminHierarchy.__table__
+    connection.execute(
+        table.delete().where(
+            (table.c.ancestor_id == target.id) | (table.c.descendant_id == target.id)
+        )
+    )
+
+
+def rebuild_admin_hierarchy(commit: bool = True) -> int:
+    """
+    بازسازی کامل جدول closure از روی parent_admin_id
+
+    Returns:
+        تعداد سطرهای درج شده
+    """
+    parents = {
+        admin_id: _parent_id(admin_id, parent_admin_id)
+        for admin_id, parent_admin_id in db.session.query(AdminUser.id, AdminUser.parent_admin_id)
+    }
+
+    rows = []
+    for admin_id in parents:
+        rows.append({'ancestor_id': admin_id, 'descendant_id': admin_id, 'depth': 0})
+        seen = {admin_id}
+        ancestor_id = parents[admin_id]
+        depth = 1
+        while ancestor_id is not None and ancestor_id in parents and ancestor_id not in seen and depth <= MAX_DEPTH:
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': admin_id, 'depth': depth})
+            seen.add(ancestor_id)
+            ancestor_id = parents[ancestor_id]
+            depth += 1
+
+    db.session.execute(AdminHierarchy.__table__.delete())
+    if rows:
+        db.session.execute(AdminHierarchy.__table__.insert(), rows)
+    if commit:
+        db.session.commit()
+
+    logger.info(f"Rebuilt admin_hierarchy with {len(rows)} rows for {len(parents)} admins")
+    return len(rows)
+
+
+def init_admin_hierarchy():
+    """Create the closure table, backfill it if empty and register listeners"""
+    AdminHierarchy.__table__.create(db.engine, checkfirst=True)
+
+    if db.session.query(AdminHierarchy.ancestor_id).first() is None:
+        rebuild_admin_hierarchy()
+
+    for name, listener in (
+        ('after_insert', admin_after_insert),
+        ('before_update', admin_before_update),
+        ('after_update', admin_after_update),
+        ('after_delete', admin_after_delete),
+    ):
+        if not event.contains(AdminUser, name, listener):
+            event.listen(AdminUser, name, listener)
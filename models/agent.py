@@ -2,13 +2,53 @@
 Agent/Reseller Model for HiddifyPanel
 مدل Agent برای سیستم Reseller
 """
+import base64
 import datetime
-from sqlalchemy import Column, Integer, BigInteger, DateTime, ForeignKey, Index
+import json
+from sqlalchemy import Column, Integer, BigInteger, DateTime, ForeignKey, Index, and_, case, func, literal, or_
 from sqlalchemy.orm import relationship
 from hiddifypanel.database import db
 from hiddifypanel.models.base_account import BaseAccount
 from hiddifypanel.models.user import ONE_GIG
 
+# Sort keys and status filters accepted by Agent.get_page() and
+# AgentTrafficCalculator.get_agents_traffic_page()
+AGENT_SORT_KEYS = ('id', 'used', 'remaining', 'usage_percentage')
+AGENT_STATUS_FILTERS = ('exceeded', 'warning', 'unlimited', 'limited')
+
+
+def agent_sort_key(sort: str, traffic_used, traffic_limit):
+    """
+    SQL sort expression of an agent listing (see AGENT_SORT_KEYS)
+
+    Works on columns as well as on bound literals, so a keyset cursor is
+    compared with exactly the same arithmetic. Unlimited agents sort as -1.
+    """
+    if sort == 'used':
+        return traffic_used
+    if sort == 'remaining':
+        remaining = traffic_limit - traffic_used
+        return func.coalesce(case((remaining < 0, 0), else_=remaining), -1)
+    if sort == 'usage_percentage':
+        return func.coalesce(traffic_used * 100.0 / func.nullif(traffic_limit, 0), -1)
+    raise ValueError(f"Unknown sort key: {sort}")
+
+
+def encode_agent_cursor(agent_id: int, traffic_used, traffic_limit) -> str:
+    """Opaque keyset cursor pointing after the given agent row"""
+    data = {'id': agent_id, 'used': int(traffic_used or 0), 'limit': traffic_limit}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_agent_cursor(cursor: str) -> dict:
+    """Decode a cursor from encode_agent_cursor(), raising ValueError if invalid"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        limit = None if data['limit'] is None else int(data['limit'])
+        return {'id': int(data['id']), 'used': int(data['used']), 'limit': limit}
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
 
 class Agent(BaseAccount):
     """
@@ -22,6 +62,11 @@ class Agent(BaseAccount):
     # Traffic limits (in bytes)
     traffic_limit = Column(BigInteger, nullable=True, default=None, comment='Traffic limit in bytes, NULL = unlimited')
     traffic_used = Column(BigInteger, default=0, nullable=False, comment='Total traffic used by all users under this agent')
+    traffic_allocated = Column(BigInteger, default=0, nullable=False, comment='Total usage_limit of all users under this agent')
+    
+    # Denormalized user counters, maintained by the traffic_service listeners
+    users_count = Column(Integer, default=0, nullable=False, comment='Number of users under this agent')
+    active_users_count = Column(Integer, default=0, nullable=False, comment='Number of enabled users under this agent')
     
     # Timestamps
     created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
@@ -56,6 +101,18 @@ class Agent(BaseAccount):
         """Get traffic used in GB"""
         return self.traffic_used / ONE_GIG
     
+    @property
+    def traffic_allocated_GB(self) -> float:
+        """Get traffic allocated to users (sum of their usage_limit) in GB"""
+        return (self.traffic_allocated or 0) / ONE_GIG
+    
+    @property
+    def traffic_unallocated_GB(self) -> float | None:
+        """Get traffic that can still be allocated to users in GB"""
+        if self.traffic_limit is None:
+            return None
+        return max(0, (self.traffic_limit - (self.traffic_allocated or 0)) / ONE_GIG)
+    
     @property
     def traffic_remaining_GB(self) -> float | None:
         """Get remaining traffic in GB"""
@@ -89,6 +146,10 @@ class Agent(BaseAccount):
         """
         Check if agent can create a new user with specified traffic limit
         
+        Enforcement looks at traffic_used (consumed), admission at
+        traffic_allocated (sum of users' usage_limit); both are columns of
+        this row, so no users are aggregated.
+        
         Args:
             user_traffic_limit_GB: Traffic limit for the new user in GB
             
@@ -103,17 +164,62 @@ class Agent(BaseAccount):
         
         if user_traffic_limit_GB is not None:
             user_traffic_limit_bytes = int(user_traffic_limit_GB * ONE_GIG)
-            new_total = self.traffic_used + user_traffic_limit_bytes
-            
-            if new_total > self.traffic_limit:
-                remaining_GB = self.traffic_remaining_GB or 0
-                return False, f"Creating user would exceed agent traffic limit. Remaining: {remaining_GB:.2f} GB"
+            return self.can_allocate(user_traffic_limit_bytes)
+        
+        return True, None
+    
+    def can_allocate(self, traffic_bytes: int) -> tuple[bool, str | None]:
+        """
+        Check if traffic_bytes more can be allocated to this agent's users
+        
+        Returns:
+            tuple: (can_allocate: bool, error_message: str | None)
+        """
+        if self.traffic_limit is None or traffic_bytes <= 0:
+            return True, None
+        
+        if (self.traffic_allocated or 0) + traffic_bytes > self.traffic_limit:
+            unallocated_GB = self.traffic_unallocated_GB or 0
+            return False, f"Allocating {traffic_bytes / ONE_GIG:.2f} GB would exceed agent traffic limit. Unallocated: {unallocated_GB:.2f} GB"
         
         return True, None
     
+    def get_allocated_traffic(self) -> int:
+        """
+        Sum the usage_limit of this agent's users from the user table
+        """
+        from hiddifypanel.models.user import User
+        from sqlalchemy import func
+        
+        return db.session.query(
+            func.coalesce(func.sum(User.usage_limit), 0)
+        ).filter(
+            User.agent_id == self.id
+        ).scalar() or 0
+    
+    def get_users_counts(self) -> tuple[int, int]:
+        """
+        Count (users_count, active_users_count) from the user table with a single query
+        """
+        from hiddifypanel.models.user import User
+        from sqlalchemy import func, case
+        
+        users_count, active_users_count = db.session.query(
+            func.count(User.id),
+            func.coalesce(func.sum(case((User.enable == True, 1), else_=0)), 0)
+        ).filter(
+            User.agent_id == self.id
+        ).one()
+        
+        return users_count, int(active_users_count)
+    
     def update_traffic_used(self, commit: bool = True):
         """
-        Update traffic_used by calculating sum of all users' current_usage
+        Recompute traffic_used from the sum of all users' current_usage
+        (and traffic_allocated and the user counters from the user table)
+        
+        These are kept up to date incrementally by the User listeners in
+        traffic_service; this is the full recompute used to fix drift.
         """
         from hiddifypanel.models.user import User
         from sqlalchemy import func
@@ -125,6 +231,8 @@ class Agent(BaseAccount):
         ).scalar() or 0
         
         self.traffic_used = total_usage
+        self.traffic_allocated = self.get_allocated_traffic()
+        self.users_count, self.active_users_count = self.get_users_counts()
         self.updated_at = datetime.datetime.utcnow()
         
         if commit:
@@ -140,11 +248,13 @@ class Agent(BaseAccount):
             **base,
             'traffic_limit_GB': self.traffic_limit_GB,
             'traffic_used_GB': self.traffic_used_GB,
+            'traffic_allocated_GB': self.traffic_allocated_GB,
             'traffic_remaining_GB': self.traffic_remaining_GB,
             'traffic_usage_percentage': self.traffic_usage_percentage,
             'is_traffic_limit_exceeded': self.is_traffic_limit_exceeded,
             'is_traffic_warning': self.is_traffic_warning,
-            'users_count': self.users.count() if hasattr(self, 'users') else 0,
+            'users_count': self.users_count or 0,
+            'active_users_count': self.active_users_count or 0,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
         }
@@ -163,6 +273,80 @@ class Agent(BaseAccount):
     def get_all(cls):
         """Get all agents"""
         return db.session.query(cls).all()
+    
+    @classmethod
+    def get_page(cls, limit: int = 50, cursor: str = None, sort: str = 'id',
+                 descending: bool = False, status: str = None):
+        """
+        Get one page of agents using keyset pagination
+        
+        Args:
+            limit: Page size
+            cursor: Cursor returned with the previous page
+            sort: One of AGENT_SORT_KEYS
+            descending: Sort direction
+            status: Optional filter, one of AGENT_STATUS_FILTERS
+            
+        Returns:
+            tuple: (agents: list, next_cursor: str | None)
+        """
+        query = db.session.query(cls)
+        
+        if status == 'unlimited':
+            query = query.filter(cls.traffic_limit.is_(None))
+        elif status == 'limited':
+            query = query.filter(cls.traffic_limit.isnot(None))
+        elif status == 'exceeded':
+            query = query.filter(cls.traffic_limit.isnot(None), cls.traffic_used >= cls.traffic_limit)
+        elif status == 'warning':
+            query = query.filter(cls.traffic_limit > 0, cls.traffic_used * 100 > cls.traffic_limit * 90)
+        elif status is not None:
+            raise ValueError(f"Unknown status filter: {status}")
+        
+        key = cls.id if sort == 'id' else agent_sort_key(sort, cls.traffic_used, cls.traffic_limit)
+        
+        if cursor:
+            last = decode_agent_cursor(cursor)
+            after_id = cls.id < last['id'] if descending else cls.id > last['id']
+            if sort == 'id':
+                query = query.filter(after_id)
+            else:
+                last_key = agent_sort_key(
+                    sort,
+                    literal(last['used'], BigInteger),
+                    literal(last['limit'], BigInteger)
+                )
+                after_key = key < last_key if descending else key > last_key
+                query = query.filter(or_(after_key, and_(key == last_key, after_id)))
+        
+        if sort == 'id':
+            order_by = [cls.id.desc() if descending else cls.id.asc()]
+        elif descending:
+            order_by = [key.desc(), cls.id.desc()]
+        else:
+            order_by = [key.asc(), cls.id.asc()]
+        
+        agents = query.order_by(*order_by).limit(limit + 1).all()
+        if len(agents) > limit:
+            agents = agents[:limit]
+            return agents, encode_agent_cursor(agents[-1].id, agents[-1].traffic_used, agents[-1].traffic_limit)
+        return agents, None
+
+
+def encode_log_cursor(log) -> str:
+    """Opaque keyset cursor pointing after a traffic log (a TrafficLog or a row mapping)"""
+    timestamp, log_id = (log['timestamp'], log['id']) if isinstance(log, dict) else (log.timestamp, log.id)
+    data = {'ts': timestamp.isoformat(), 'id': log_id}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_log_cursor(cursor: str) -> tuple:
+    """Decode a cursor from encode_log_cursor() into (timestamp, id), raising ValueError if invalid"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(data['ts']), int(data['id'])
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
 
 
 class TrafficLog(db.Model):
@@ -195,6 +379,9 @@ class TrafficLog(db.Model):
         Index('idx_traffic_log_agent_id', 'agent_id'),
         Index('idx_traffic_log_timestamp', 'timestamp'),
         Index('idx_traffic_log_user_agent', 'user_id', 'agent_id'),
+        # Keyset pagination on (timestamp, id) per agent/user
+        Index('idx_traffic_log_agent_timestamp', 'agent_id', 'timestamp'),
+        Index('idx_traffic_log_user_timestamp', 'user_id', 'timestamp'),
     )
     
     @property
@@ -217,41 +404,199 @@ class TrafficLog(db.Model):
     @classmethod
     def create_log(cls, user_id: int = None, agent_id: int = None, used_traffic: int = 0, 
                    description: str = None, commit: bool = True):
-        """Create a new traffic log entry"""
+        """
+        Create a new traffic log entry
+        
+        With monthly partition tables the row is inserted into its month's
+        table on the session's connection, and the returned log is not
+        attached to the session (its id is set, though).
+        """
+        from hiddifypanel.services.traffic_log_partitions import traffic_log_router
+        
         log = cls(
             user_id=user_id,
             agent_id=agent_id,
             used_traffic=used_traffic,
             description=description
         )
-        db.session.add(log)
+        if traffic_log_router.mode == 'tables':
+            log.timestamp = datetime.datetime.utcnow()
+            row = {
+                'user_id': user_id,
+                'agent_id': agent_id,
+                'used_traffic': used_traffic,
+                'timestamp': log.timestamp,
+                'description': description,
+            }
+            traffic_log_router.insert(db.session.connection(), [row])
+            log.id = row['id']
+        else:
+            db.session.add(log)
         if commit:
             db.session.commit()
         return log
     
     @classmethod
-    def get_agent_traffic_logs(cls, agent_id: int, start_date: datetime.datetime = None, 
-                               end_date: datetime.datetime = None, limit: int = 100):
-        """Get traffic logs for an agent"""
-        query = db.session.query(cls).filter(cls.agent_id == agent_id)
+    def _log_filter(cls, agent_id: int = None, user_id: int = None, start_date: datetime.datetime = None,
+                    end_date: datetime.datetime = None, after: tuple = None, descending: bool = True):
+        """where(table) for traffic_log_router.select(); after = (timestamp, id) of the last row seen"""
+        def where(table):
+            conditions = []
+            if agent_id is not None:
+                conditions.append(table.c.agent_id == agent_id)
+            if user_id is not None:
+                conditions.append(table.c.user_id == user_id)
+            if start_date:
+                conditions.append(table.c.timestamp >= start_date)
+            if end_date:
+                conditions.append(table.c.timestamp <= end_date)
+            if after:
+                timestamp, log_id = after
+                if descending:
+                    conditions.append(or_(table.c.timestamp < timestamp,
+                                          and_(table.c.timestamp == timestamp, table.c.id < log_id)))
+                else:
+                    conditions.append(or_(table.c.timestamp > timestamp,
+                                          and_(table.c.timestamp == timestamp, table.c.id > log_id)))
+            return conditions
+        return where
+    
+    @classmethod
+    def get_logs_page(cls, agent_id: int = None, user_id: int = None, start_date: datetime.datetime = None,
+                      end_date: datetime.datetime = None, limit: int = 100, cursor: str = None,
+                      descending: bool = True):
+        """
+        Get one page of traffic logs using keyset pagination on (timestamp, id)
+        
+        Args:
+            agent_id / user_id: Optional filters
+            start_date / end_date: Optional range (inclusive)
+            limit: Page size
+            cursor: Cursor returned with the previous page
+            descending: Newest first (default) or oldest first
+            
+        Returns:
+            tuple: (logs: list, next_cursor: str | None)
+            
+        The logs are transient TrafficLog objects built from the rows, not
+        loaded into the session: with monthly tables the page merges several
+        tables, and the identity map must not fold their rows together.
+        Rows moved to the columnar archive are not included.
+        """
+        from hiddifypanel.services.traffic_log_partitions import traffic_log_router
         
-        if start_date:
-            query = query.filter(cls.timestamp >= start_date)
-        if end_date:
-            query = query.filter(cls.timestamp <= end_date)
+        after = decode_log_cursor(cursor) if cursor else None
+        where = cls._log_filter(agent_id, user_id, start_date, end_date, after, descending)
+        connection = db.session.connection()
+        statement = traffic_log_router.select(
+            connection, where, start_date, end_date, descending=descending, limit=limit + 1
+        )
         
-        return query.order_by(cls.timestamp.desc()).limit(limit).all()
+        logs = [cls(**row) for row in connection.execute(statement).mappings()]
+        if len(logs) > limit:
+            logs = logs[:limit]
+            return logs, encode_log_cursor(logs[-1])
+        return logs, None
     
     @classmethod
-    def get_user_traffic_logs(cls, user_id: int, start_date: datetime.datetime = None,
-                               end_date: datetime.datetime = None, limit: int = 100):
-        """Get traffic logs for a user"""
-        query = db.session.query(cls).filter(cls.user_id == user_id)
+    def iter_logs(cls, agent_id: int = None, user_id: int = None, start_date: datetime.datetime = None,
+                  end_date: datetime.datetime = None, descending: bool = False, batch_size: int = 1000):
+        """
+        Yield traffic logs as dicts, batch_size rows per query
         
-        if start_date:
-            query = query.filter(cls.timestamp >= start_date)
-        if end_date:
-            query = query.filter(cls.timestamp <= end_date)
+        Every batch is a keyset query on a short-lived connection, so memory
+        stays constant and no transaction is held open however many rows
+        there are. Rows are not loaded into the session. Rows moved to the
+        columnar archive (see traffic_log_archive.py) are not included.
+        """
+        from hiddifypanel.services.traffic_log_partitions import traffic_log_router
         
-        return query.order_by(cls.timestamp.desc()).limit(limit).all()
+        after = None
+        while True:
+            where = cls._log_filter(agent_id, user_id, start_date, end_date, after, descending)
+            with db.engine.connect() as connection:
+                rows = connection.execute(traffic_log_router.select(
+                    connection, where, start_date, end_date, descending=descending, limit=batch_size
+                )).mappings().all()
+            
+            for row in rows:
+                yield {
+                    'id': row['id'],
+                    'user_id': row['user_id'],
+                    'agent_id': row['agent_id'],
+                    'used_traffic': row['used_traffic'],
+                    'timestamp': row['timestamp'].isoformat() if row['timestamp'] else None,
+                    'description': row['description'],
+                }
+            if len(rows) < batch_size:
+                return
+            after = (rows[-1]['timestamp'], rows[-1]['id'])
+    
+    @classmethod
+    def get_agent_traffic_logs(cls, agent_id: int, start_date: datetime.datetime = None, 
+                               end_date: datetime.datetime = None, limit: int = 100, cursor: str = None):
+        """Get traffic logs for an agent, newest first (cursor: see get_logs_page)"""
+        return cls.get_logs_page(agent_id=agent_id, start_date=start_date, end_date=end_date,
+                                 limit=limit, cursor=cursor)[0]
+    
+    @classmethod
+    def get_user_traffic_logs(cls, user_id: int, start_date: datetime.datetime = None,
+                               end_date: datetime.datetime = None, limit: int = 100, cursor: str = None):
+        """Get traffic logs for a user, newest first (cursor: see get_logs_page)"""
+        return cls.get_logs_page(user_id=user_id, start_date=start_date, end_date=end_date,
+                                 limit=limit, cursor=cursor)[0]
+
+
+# Rollup rows use 0 instead of NULL: agent_id 0 = all agents, user_id 0 = all users
+ROLLUP_ALL = 0
+
+
+class TrafficRollupHourly(db.Model):
+    """
+    Hourly totals of traffic_log
+    جمع ساعتی ترافیک به ازای (agent_id, user_id)
+    
+    Besides one row per (agent, user), every hour has an (agent, 0) row with
+    the agent's total and a (0, 0) row with the total of all logs, so an
+    agent chart reads one row per bucket. Filled by services/traffic_rollup.py.
+    """
+    __tablename__ = 'traffic_rollup_hourly'
+    
+    agent_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(DateTime, primary_key=True, comment='Start of the hour (UTC)')
+    used_traffic = Column(BigInteger, nullable=False, default=0)
+    entries = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('idx_traffic_rollup_hourly_user', 'user_id', 'bucket'),
+    )
+
+
+class TrafficRollupDaily(db.Model):
+    """
+    Daily totals of traffic_log
+    جمع روزانه ترافیک، با همان کلیدهای TrafficRollupHourly
+    """
+    __tablename__ = 'traffic_rollup_daily'
+    
+    agent_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(DateTime, primary_key=True, comment='Start of the day (UTC)')
+    used_traffic = Column(BigInteger, nullable=False, default=0)
+    entries = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('idx_traffic_rollup_daily_user', 'user_id', 'bucket'),
+    )
+
 
+class TrafficRollupWatermark(db.Model):
+    """
+    Last traffic_log id already added to the rollup tables
+    """
+    __tablename__ = 'traffic_rollup_watermark'
+    
+    name = Column(db.String(64), primary_key=True)
+    last_log_id = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
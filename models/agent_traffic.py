@@ -8,6 +8,56 @@ from loguru import logger
 
 ONE_GIG = 1024 * 1024 * 1024
 
+# Users disabled per UPDATE/commit when enforcing a limit
+# (override with AGENT_TRAFFIC_DISABLE_BATCH_SIZE in the app config)
+DISABLE_BATCH_SIZE = 1000
+
+
+def _disable_batch_size() -> int:
+    """Configured batch size for disable_all_users"""
+    from flask import current_app
+    try:
+        return int(current_app.config.get('AGENT_TRAFFIC_DISABLE_BATCH_SIZE', DISABLE_BATCH_SIZE))
+    except RuntimeError:
+        # Outside of an app context
+        return DISABLE_BATCH_SIZE
+
+
+def _disable_users(session, user_ids: list) -> int:
+    """
+    Disable the still enabled users of user_ids with bulk UPDATEs
+    
+    The UPDATE skips the User listeners, so active_users_count of each
+    agent is moved here by the number of rows actually disabled.
+    """
+    from hiddifypanel.models.user import User
+    
+    if not hasattr(User, 'agent_id'):
+        return session.query(User).filter(
+            User.id.in_(user_ids),
+            User.enable == True
+        ).update({User.enable: False}, synchronize_session=False)
+    
+    from hiddifypanel.models import Agent
+    
+    by_agent = {}
+    for user_id, agent_id in session.query(User.id, User.agent_id).filter(User.id.in_(user_ids)):
+        by_agent.setdefault(agent_id, []).append(user_id)
+    
+    agents = Agent.__table__
+    affected = 0
+    for agent_id, agent_user_ids in by_agent.items():
+        disabled = session.query(User).filter(
+            User.id.in_(agent_user_ids),
+            User.enable == True
+        ).update({User.enable: False}, synchronize_session=False)
+        if agent_id and disabled:
+            session.execute(agents.update().where(agents.c.id == agent_id).values(
+                active_users_count=agents.c.active_users_count - disabled
+            ))
+        affected += disabled
+    return affected
+
 
 def init_agent_traffic(app: Flask):
     """Initialize agent traffic extension"""
@@ -46,75 +96,134 @@ def init_agent_traffic(app: Flask):
     # Add properties and methods to AdminUser
     _extend_admin_user(AdminUser)
     
+    # Admin hierarchy closure table (used for per-agent aggregations)
+    try:
+        from .admin_hierarchy import init_admin_hierarchy
+        init_admin_hierarchy()
+    except Exception as e:
+        logger.error(f"Error initializing admin_hierarchy table: {e}")
+    
+    # Running per-agent usage counters
+    try:
+        from .traffic_ledger import init_traffic_ledger
+        init_traffic_ledger()
+    except Exception as e:
+        logger.error(f"Error initializing agent_traffic_ledger table: {e}")
+    
     return app
 
 
+def _map_traffic_limit_column(AdminUser):
+    """Register traffic_limit as a mapped column on AdminUser
+    
+    The column is loaded together with the admin_user row and kept in the
+    identity map, so reading a limit costs no extra round-trip.
+    """
+    if 'traffic_limit' in AdminUser.__table__.c:
+        return
+    # Declarative classes map attributes assigned after class creation
+    AdminUser.traffic_limit = Column(BigInteger, nullable=True, default=None)
+
+
 def _extend_admin_user(AdminUser):
     """Extend AdminUser model with traffic management methods"""
     from hiddifypanel.models.user import User
+    from ..utils.request_memo import memoize_per_request
+    
+    _map_traffic_limit_column(AdminUser)
     
     @property
     def traffic_limit_GB(self):
         """Get traffic limit in GB"""
-        from hiddifypanel.database import db
-        try:
-            result = db.session.execute(
-                db.text("SELECT traffic_limit FROM admin_user WHERE id = :id"),
-                {"id": self.id}
-            ).first()
-            traffic_limit = result[0] if result and result[0] else None
-        except Exception as e:
-            logger.debug(f"Error getting traffic_limit: {e}")
-            traffic_limit = None
-        
-        if traffic_limit is None:
+        if self.traffic_limit is None:
             return None
-        return traffic_limit / ONE_GIG
+        return self.traffic_limit / ONE_GIG
     
     @traffic_limit_GB.setter
     def traffic_limit_GB(self, value):
-        """Set traffic limit in GB"""
-        from hiddifypanel.database import db
+        """Set traffic limit in GB (the caller is responsible for committing)"""
         if value is None:
-            traffic_limit = None
+            self.traffic_limit = None
         else:
-            traffic_limit = int(value * ONE_GIG)
+            self.traffic_limit = int(value * ONE_GIG)
+    
+    def hierarchy_users_query(self):
+        """Query of all users created by this agent and its sub-admins"""
+        from .admin_hierarchy import AdminHierarchy
         
-        db.session.execute(
-            db.text("UPDATE admin_user SET traffic_limit = :limit WHERE id = :id"),
-            {"limit": traffic_limit, "id": self.id}
+        return User.query.join(
+            AdminHierarchy, AdminHierarchy.descendant_id == User.added_by
+        ).filter(
+            AdminHierarchy.ancestor_id == self.id
         )
-        db.session.commit()
-        self._traffic_limit = traffic_limit
+    
+    @memoize_per_request
+    def hierarchy_admin_ids(self):
+        """Ids of this agent and all of its sub-admins"""
+        from hiddifypanel.database import db
+        from .admin_hierarchy import AdminHierarchy
+        
+        return [row[0] for row in db.session.execute(AdminHierarchy.descendant_ids_select(self.id))]
+    
+    @memoize_per_request
+    def get_ledger_counters(self):
+        """
+        (consumed, allocated) bytes of this agent's users
+        
+        consumed is SUM(current_usage), allocated is SUM(usage_limit); both
+        come from the agent's single ledger row, kept up to date by the User
+        listeners, and are recomputed only if the row is missing. Rows of
+        non-agent admins are only refreshed by reconcile_traffic_ledger().
+        """
+        from .traffic_ledger import AgentTrafficLedger
+        
+        counters = AgentTrafficLedger.counters_for(self.id)
+        if counters is not None:
+            return counters
+        return self.calculate_total_traffic(), self.calculate_allocated_traffic()
     
     def get_total_traffic(self):
         """محاسبه مجموع ترافیک مصرفی تمام کاربران ایجاد شده توسط این ایجنت"""
+        return self.get_ledger_counters()[0]
+    
+    @memoize_per_request
+    def calculate_total_traffic(self):
+        """Recompute SUM(current_usage) of this agent's users from the user table"""
         from hiddifypanel.database import db
         from sqlalchemy import func
+        from .admin_hierarchy import AdminHierarchy
         
-        # Get all users created by this agent (including sub-admins)
-        admin_ids = self.recursive_sub_admins_ids()
-        
+        # Users of this agent and its sub-admins, via the closure table
         total_traffic = db.session.query(
             func.coalesce(func.sum(User.current_usage), 0)
+        ).join(
+            AdminHierarchy, AdminHierarchy.descendant_id == User.added_by
         ).filter(
-            User.added_by.in_(admin_ids)
+            AdminHierarchy.ancestor_id == self.id
         ).scalar()
         
         return total_traffic or 0
     
+    @memoize_per_request
+    def calculate_allocated_traffic(self):
+        """Recompute SUM(usage_limit) of this agent's users from the user table"""
+        from sqlalchemy import func
+        
+        return self.hierarchy_users_query().with_entities(
+            func.coalesce(func.sum(User.usage_limit), 0)
+        ).scalar() or 0
+    
     def get_total_traffic_GB(self):
         """Get total traffic in GB"""
         return self.get_total_traffic() / ONE_GIG
     
     def get_remaining_traffic(self):
         """محاسبه ترافیک باقیمانده"""
-        if self.traffic_limit_GB is None:
+        if self.traffic_limit is None:
             return None  # No limit set
         
         total = self.get_total_traffic()
-        limit = int(self.traffic_limit_GB * ONE_GIG)
-        remaining = limit - total
+        remaining = self.traffic_limit - total
         return max(0, remaining)
     
     def get_remaining_traffic_GB(self):
@@ -124,20 +233,29 @@ def _extend_admin_user(AdminUser):
             return None
         return remaining / ONE_GIG
     
+    def get_reserved_traffic(self):
+        """Bytes allocated (reserved) by the usage_limit of this agent's users"""
+        return self.get_ledger_counters()[1]
+    
     def can_create_user_with_traffic(self, user_traffic_limit_GB=None):
-        """بررسی اینکه آیا می‌تواند کاربر جدید با ترافیک مشخص ایجاد کند"""
+        """
+        بررسی اینکه آیا می‌تواند کاربر جدید با ترافیک مشخص ایجاد کند
+        
+        This is the same check reserve_traffic() makes, but without
+        reserving anything; the insert hook makes the binding reservation.
+        """
         # If no traffic limit is set for agent, allow creation
-        if self.traffic_limit_GB is None:
+        if self.traffic_limit is None:
             return True, None
         
-        current_total = self.get_total_traffic()
-        agent_limit = int(self.traffic_limit_GB * ONE_GIG)
+        current_total, reserved = self.get_ledger_counters()
+        agent_limit = self.traffic_limit
         
-        # If user_traffic_limit is provided, check if adding it would exceed
+        # If user_traffic_limit is provided, check if reserving it would exceed
         if user_traffic_limit_GB is not None:
             user_limit = int(user_traffic_limit_GB * ONE_GIG)
-            if current_total + user_limit > agent_limit:
-                return False, f"مجموع ترافیک کاربران ({current_total/ONE_GIG:.2f} GB) به علاوه ترافیک کاربر جدید ({user_traffic_limit_GB} GB) از حد مجاز ایجنت ({self.traffic_limit_GB} GB) بیشتر است"
+            if reserved + user_limit > agent_limit:
+                return False, f"مجموع ترافیک رزرو شده کاربران ({reserved/ONE_GIG:.2f} GB) به علاوه ترافیک کاربر جدید ({user_traffic_limit_GB} GB) از حد مجاز ایجنت ({self.traffic_limit_GB} GB) بیشتر است"
         
         # Check if current usage is already over limit
         if current_total >= agent_limit:
@@ -147,39 +265,83 @@ def _extend_admin_user(AdminUser):
     
     def is_traffic_limit_exceeded(self):
         """بررسی اینکه آیا ترافیک از حد مجاز تجاوز کرده است"""
-        if self.traffic_limit_GB is None:
+        if self.traffic_limit is None:
             return False
         
-        total = self.get_total_traffic()
-        limit = int(self.traffic_limit_GB * ONE_GIG)
-        return total >= limit
+        return self.get_total_traffic() >= self.traffic_limit
     
-    def disable_all_users(self):
-        """غیرفعال‌سازی تمام کاربران ایجاد شده توسط این ایجنت"""
+    def iter_disable_users_batches(self, batch_size=None, after_id=0):
+        """
+        غیرفعال‌سازی کاربران این ایجنت به صورت دسته‌ای
+        
+        Users are disabled in id order, batch_size rows per UPDATE with a
+        commit after each batch, so row locks are held only briefly. A
+        progress dict is yielded after every batch; since only enabled users
+        are selected, an interrupted run is resumed by simply running again
+        (or by passing the last reported id as after_id).
+        """
         from hiddifypanel.database import db
-        from hiddifypanel.models.user import User
+        from .admin_hierarchy import AdminHierarchy
         
-        admin_ids = self.recursive_sub_admins_ids()
+        from ..utils.stats_cache import agent_stats_cache
+        from ..utils.request_memo import invalidate_request_memo
         
-        affected = db.session.query(User).filter(
-            User.added_by.in_(admin_ids)
-        ).update(
-            {User.enable: False},
-            synchronize_session=False
-        )
+        batch_size = batch_size or _disable_batch_size()
+        admin_ids = AdminHierarchy.descendant_ids_select(self.id)
+        # Bulk UPDATEs bypass the ORM events, so drop the cached figures of
+        # this agent, its sub-admins and its ancestors explicitly
+        ancestor_ids = [row[0] for row in db.session.query(AdminHierarchy.ancestor_id).filter(
+            AdminHierarchy.descendant_id == self.id
+        )]
+        cached_ids = list(set(self.hierarchy_admin_ids()) | set(ancestor_ids) | {self.id})
+        progress = {'agent_id': self.id, 'batches': 0, 'disabled': 0, 'last_id': after_id}
+        
+        while True:
+            user_ids = [row[0] for row in db.session.query(User.id).filter(
+                User.added_by.in_(admin_ids),
+                User.enable == True,
+                User.id > progress['last_id']
+            ).order_by(User.id).limit(batch_size)]
+            
+            if not user_ids:
+                break
+            
+            affected = _disable_users(db.session, user_ids)
+            db.session.commit()
+            agent_stats_cache.invalidate(cached_ids)
+            invalidate_request_memo(cached_ids)
+            
+            progress['batches'] += 1
+            progress['disabled'] += affected
+            progress['last_id'] = user_ids[-1]
+            logger.debug(f"Agent {self.id}: disabled batch {progress['batches']} ({affected} users, last id {progress['last_id']})")
+            yield dict(progress)
+    
+    def disable_all_users(self, batch_size=None, after_id=0):
+        """غیرفعال‌سازی تمام کاربران ایجاد شده توسط این ایجنت"""
+        progress = {'disabled': 0, 'batches': 0}
+        for progress in self.iter_disable_users_batches(batch_size, after_id):
+            pass
         
-        db.session.commit()
-        logger.warning(f"Disabled {affected} users for agent {self.name} (ID: {self.id}) due to traffic limit exceeded")
+        affected = progress['disabled']
+        logger.warning(f"Disabled {affected} users for agent {self.name} (ID: {self.id}) in {progress['batches']} batch(es) due to traffic limit exceeded")
         return affected
     
     # Attach methods to AdminUser class
     AdminUser.traffic_limit_GB = traffic_limit_GB
+    AdminUser.hierarchy_users_query = hierarchy_users_query
+    AdminUser.hierarchy_admin_ids = hierarchy_admin_ids
+    AdminUser.get_ledger_counters = get_ledger_counters
     AdminUser.get_total_traffic = get_total_traffic
+    AdminUser.calculate_total_traffic = calculate_total_traffic
+    AdminUser.calculate_allocated_traffic = calculate_allocated_traffic
     AdminUser.get_total_traffic_GB = get_total_traffic_GB
     AdminUser.get_remaining_traffic = get_remaining_traffic
     AdminUser.get_remaining_traffic_GB = get_remaining_traffic_GB
+    AdminUser.get_reserved_traffic = get_reserved_traffic
     AdminUser.can_create_user_with_traffic = can_create_user_with_traffic
     AdminUser.is_traffic_limit_exceeded = is_traffic_limit_exceeded
+    AdminUser.iter_disable_users_batches = iter_disable_users_batches
     AdminUser.disable_all_users = disable_all_users
 
 
@@ -0,0 +1,494 @@
+"""
+Running per-admin traffic counters
+شمارنده‌های ترافیک مصرفی هر ادمین/ایجنت که به صورت افزایشی به‌روز می‌شوند
+"""
+import datetime
+from sqlalchemy import Column, Integer, BigInteger, Float, DateTime, ForeignKey, Index, event, select, func, literal, or_
+from sqlalchemy.orm import Session, attributes, object_session
+from sqlalchemy import inspect as sa_inspect
+from loguru import logger
+
+from hiddifypanel.database import db
+from hiddifypanel.models.admin import AdminUser, AdminMode
+from hiddifypanel.models.user import User
+
+from .admin_hierarchy import AdminHierarchy
+
+# session.info key of the per-flush {admin_id: {column: delta}} map
+_PENDING_DELTAS_KEY = 'agent_traffic_ledger_deltas'
+
+# InstanceState.info key set on users whose usage_limit was already
+# reserved by reserve_traffic() during the current flush
+RESERVED_KEY = 'agent_traffic_reserved'
+
+# InstanceState.info key holding the stored current_usage of users whose
+# current_usage was set while expired (read in bulk before the flush)
+_STORED_USAGE_KEY = 'agent_traffic_stored_usage'
+
+# Ledger rows recomputed per transaction by reconcile_traffic_ledger()
+RECONCILE_BATCH_SIZE = 200
+
+# Columns added after the table was first released, with their DDL
+_ADDED_COLUMNS = (
+    ('reserved', 'BIGINT NOT NULL DEFAULT 0'),
+    ('usage_rate', 'FLOAT NOT NULL DEFAULT 0'),
+    ('sampled_consumed', 'BIGINT'),
+    ('sampled_at', 'DATETIME'),
+    ('next_check_at', 'DATETIME'),
+)
+
+
+class AgentTrafficLedger(db.Model):
+    """
+    One row per admin holding SUM(current_usage) and SUM(usage_limit) of
+    all users under it
+
+    consumed is the "used" side, checked by enforcement; reserved is the
+    "allocated" side, checked by admission (new users and usage_limit
+    increases reserve through reserve_traffic()). Both move by the change of
+    each user's current_usage/usage_limit and are corrected by
+    reconcile_traffic_ledger().
+
+    Online, a change moves the owning admin's row and the rows of its agent
+    ancestors only. Rows of the owner and of plain admins above the agents
+    hold their full subtree totals as of the last reconcile.
+
+    usage_rate, sampled_* and next_check_at hold the state of the adaptive
+    limit checker (tasks/adaptive_scheduler.py).
+    """
+    __tablename__ = 'agent_traffic_ledger'
+
+    admin_id = Column(Integer, ForeignKey('admin_user.id', ondelete='CASCADE'), primary_key=True)
+    consumed = Column(BigInteger, nullable=False, default=0, comment='SUM(current_usage) of users under this admin, in bytes')
+    reserved = Column(BigInteger, nullable=False, default=0, comment='SUM(usage_limit) of users under this admin, in bytes')
+    updated_at = Column(DateTime, nullable=True)
+    reconciled_at = Column(DateTime, nullable=True)
+
+    # Adaptive checker state
+    usage_rate = Column(Float, nullable=False, default=0, comment='Smoothed consumption rate, in bytes per second')
+    sampled_consumed = Column(BigInteger, nullable=True, comment='consumed at the last check')
+    sampled_at = Column(DateTime, nullable=True)
+    next_check_at = Column(DateTime, nullable=True, comment='When the limit of this admin is checked next, NULL = now')
+
+    __table_args__ = (
+        Index('idx_agent_traffic_ledger_next_check', 'next_check_at'),
+    )
+
+    @classmethod
+    def consumed_for(cls, admin_id: int):
+        """Return the counter of admin_id, or None if it has no ledger row"""
+        return db.session.query(cls.consumed).filter(cls.admin_id == admin_id).scalar()
+
+    @classmethod
+    def counters_for(cls, admin_id: int):
+        """Return (consumed, reserved) of admin_id from one row, or None if it has no ledger row"""
+        row = db.session.query(cls.consumed, cls.reserved).filter(cls.admin_id == admin_id).first()
+        return (row[0] or 0, row[1] or 0) if row else None
+
+    @classmethod
+    def reserved_for(cls, admin_id: int):
+        """Return the reserved bytes of admin_id, or None if it has no ledger row"""
+        return db.session.query(cls.reserved).filter(cls.admin_id == admin_id).scalar()
+
+
+def _old_value(history, current):
+    """Value of an attribute before the pending change"""
+    return history.deleted[0] if history.deleted else current
+
+
+def _propagation_ids(connection, admin_id: int, include_self: bool = True) -> list:
+    """
+    Ledger rows moved online by a change under admin_id, in ascending id order
+
+    These are admin_id itself and those of its ancestors that are agents.
+    The owner and plain admins sit above every agent, so updating them here
+    would make every usage sync in the panel write the same row; their
+    subtree totals are filled in by reconcile_traffic_ledger() instead.
+    """
+    hierarchy = AdminHierarchy.__table__
+    query = select(hierarchy.c.ancestor_id).join(
+        AdminUser.__table__, AdminUser.id == hierarchy.c.ancestor_id
+    ).where(
+        hierarchy.c.descendant_id == admin_id,
+        or_(hierarchy.c.depth == 0, AdminUser.mode == AdminMode.agent)
+    ).order_by(hierarchy.c.ancestor_id)
+    if not include_self:
+        query = query.where(hierarchy.c.depth > 0)
+    return [row[0] for row in connection.execute(query)]
+
+
+def _apply_row_deltas(connection, row_deltas: dict):
+    """Add {admin_id: (consumed, reserved)} to the ledger rows, one UPDATE per row in ascending id order"""
+    ledger = AgentTrafficLedger.__table__
+    now = datetime.datetime.utcnow()
+    for row_id in sorted(row_deltas):
+        consumed, reserved = row_deltas[row_id]
+        if not (consumed or reserved):
+            continue
+        connection.execute(
+            ledger.update().where(ledger.c.admin_id == row_id).values(
+                consumed=ledger.c.consumed + consumed,
+                reserved=ledger.c.reserved + reserved,
+                updated_at=now
+            )
+        )
+
+
+def _apply_deltas(connection, admin_id, consumed: int = 0, reserved: int = 0, include_self: bool = True):
+    """Add the deltas to the counters of admin_id and of its agent ancestors"""
+    if not admin_id or not (consumed or reserved):
+        return
+
+    _apply_row_deltas(connection, {
+        row_id: (consumed, reserved) for row_id in _propagation_ids(connection, admin_id, include_self)
+    })
+
+
+def reserve_traffic(connection, admin_id: int, amount: int, limit: int = None) -> bool:
+    """
+    رزرو اتمیک ترافیک برای کاربر جدید
+
+    A single conditional UPDATE adds amount to the admin's reserved bytes
+    only while reserved + amount stays within limit (and consumed is below
+    it); concurrent reservations serialize on that agent's row only, so two
+    of them can never both pass the check. The agent ancestors' counters
+    follow without a check. Their rows and the admin's own are locked first
+    in ascending id order, the same order the usage flush updates them in,
+    so reservations and usage syncs cannot deadlock. The UPDATEs run in the
+    caller's transaction: committing it finalizes the reservation, rolling
+    it back releases it. A negative amount (lowering a user's limit) is
+    never refused.
+
+    Returns:
+        False if the reservation would exceed limit (nothing is changed)
+    """
+    amount = amount or 0
+    if not admin_id:
+        return True
+
+    ledger = AgentTrafficLedger.__table__
+    if limit is not None and amount < 0:
+        limit = None
+    if limit is None:
+        _apply_deltas(connection, admin_id, reserved=amount)
+        return True
+
+    if amount == 0:
+        # Nothing to reserve, only refuse admins that are already exhausted
+        consumed = connection.execute(
+            select(ledger.c.consumed).where(ledger.c.admin_id == admin_id)
+        ).scalar() or 0
+        return consumed < limit
+
+    row_ids = _propagation_ids(connection, admin_id)
+    connection.execute(
+        select(ledger.c.admin_id).where(
+            ledger.c.admin_id.in_(row_ids)
+        ).order_by(ledger.c.admin_id).with_for_update()
+    ).all()
+
+    result = connection.execute(
+        ledger.update().where(
+            ledger.c.admin_id == admin_id,
+            ledger.c.reserved + amount <= limit,
+            ledger.c.consumed < limit
+        ).values(
+            reserved=ledger.c.reserved + amount,
+            updated_at=datetime.datetime.utcnow()
+        )
+    )
+    if result.rowcount == 0:
+        exists = connection.execute(
+            select(ledger.c.admin_id).where(ledger.c.admin_id == admin_id)
+        ).first()
+        if exists is not None:
+            return False
+        # No ledger row yet; admit and let reconcile_traffic_ledger() count it
+        logger.warning(f"No agent_traffic_ledger row for admin {admin_id}, reservation not recorded")
+        return True
+
+    _apply_row_deltas(connection, {row_id: (0, amount) for row_id in row_ids if row_id != admin_id})
+    return True
+
+
+def mark_reserved(target):
+    """Tell the ledger listeners that target's usage_limit is already reserved"""
+    sa_inspect(target).info[RESERVED_KEY] = True
+
+
+def clear_reserved(target):
+    """Forget a reservation mark left by an earlier, failed flush"""
+    sa_inspect(target).info.pop(RESERVED_KEY, None)
+
+
+def _record_deltas(target, admin_id, consumed: int = 0, reserved: int = 0):
+    """Remember the deltas of admin_id until the end of the flush"""
+    if not admin_id or not (consumed or reserved):
+        return
+
+    session = object_session(target)
+    if session is None:
+        return
+
+    pending = session.info.setdefault(_PENDING_DELTAS_KEY, {})
+    deltas = pending.setdefault(admin_id, {'consumed': 0, 'reserved': 0})
+    deltas['consumed'] += consumed
+    deltas['reserved'] += reserved
+
+
+def user_after_insert(mapper, connection, target):
+    """Count a new user's usage and (unless already reserved) usage_limit"""
+    reserved = 0
+    if not sa_inspect(target).info.pop(RESERVED_KEY, False):
+        reserved = target.usage_limit or 0
+    _record_deltas(target, target.added_by, consumed=target.current_usage or 0, reserved=reserved)
+
+
+def user_after_update(mapper, connection, target):
+    """Move the counters by the change of current_usage/usage_limit (or owner)"""
+    already_reserved = sa_inspect(target).info.pop(RESERVED_KEY, False)
+    usage_history = attributes.get_history(target, 'current_usage')
+    limit_history = attributes.get_history(target, 'usage_limit')
+    owner_history = attributes.get_history(target, 'added_by')
+    if not (usage_history.has_changes() or limit_history.has_changes() or owner_history.has_changes()):
+        return
+
+    stored_usage = sa_inspect(target).info.pop(_STORED_USAGE_KEY, None)
+    new_usage = target.current_usage or 0
+    if usage_history.deleted or stored_usage is None:
+        old_usage = _old_value(usage_history, target.current_usage) or 0
+    else:
+        old_usage = stored_usage or 0
+    new_limit = target.usage_limit or 0
+    old_limit = _old_value(limit_history, target.usage_limit) or 0
+    new_owner = target.added_by
+    old_owner = _old_value(owner_history, target.added_by)
+
+    if old_owner == new_owner:
+        reserved = 0 if already_reserved else new_limit - old_limit
+        _record_deltas(target, new_owner, consumed=new_usage - old_usage, reserved=reserved)
+    else:
+        _record_deltas(target, old_owner, consumed=-old_usage, reserved=-old_limit)
+        _record_deltas(target, new_owner, consumed=new_usage, reserved=new_limit)
+
+
+def user_after_delete(mapper, connection, target):
+    """Remove a deleted user's usage and release its reservation"""
+    _record_deltas(
+        target, target.added_by,
+        consumed=-(target.current_usage or 0),
+        reserved=-(target.usage_limit or 0)
+    )
+
+
+def session_before_flush(session, flush_context, instances):
+    """
+    Read the stored current_usage of users it was set on while expired
+
+    current_usage has no active_history (that would be a SELECT per user on
+    every usage sync), so those users' old values are read with one query
+    per flush instead.
+    """
+    expired = {}
+    for target in session.dirty:
+        if not isinstance(target, User) or target.id is None:
+            continue
+        history = attributes.get_history(target, 'current_usage')
+        if history.added and not history.deleted:
+            expired[target.id] = target
+    if not expired:
+        return
+
+    users = User.__table__
+    ids = list(expired)
+    for offset in range(0, len(ids), 1000):
+        for user_id, current_usage in session.connection().execute(
+            select(users.c.id, users.c.current_usage).where(users.c.id.in_(ids[offset:offset + 1000]))
+        ):
+            sa_inspect(expired[user_id]).info[_STORED_USAGE_KEY] = current_usage or 0
+
+
+def session_after_flush(session, flush_context):
+    """Apply the accumulated deltas, one UPDATE per ledger row in ascending id order"""
+    pending = session.info.pop(_PENDING_DELTAS_KEY, None)
+    if not pending:
+        return
+
+    connection = session.connection()
+    row_deltas = {}
+    for admin_id, deltas in pending.items():
+        if not (deltas['consumed'] or deltas['reserved']):
+            continue
+        for row_id in _propagation_ids(connection, admin_id):
+            consumed, reserved = row_deltas.get(row_id, (0, 0))
+            row_deltas[row_id] = (consumed + deltas['consumed'], reserved + deltas['reserved'])
+    _apply_row_deltas(connection, row_deltas)
+
+
+def session_after_rollback(session):
+    """Drop deltas of a flush that did not complete"""
+    session.info.pop(_PENDING_DELTAS_KEY, None)
+
+
+def admin_after_insert(mapper, connection, target):
+    """Create the ledger row of a new admin"""
+    connection.execute(
+        AgentTrafficLedger.__table__.insert(),
+        [{'admin_id': target.id, 'consumed': 0, 'reserved': 0}]
+    )
+
+
+def _subtree_counters(connection, admin_id: int) -> tuple:
+    """(consumed, reserved) of the users under admin_id, summed from the user table"""
+    hierarchy = AdminHierarchy.__table__
+    users = User.__table__
+    row = connection.execute(
+        select(
+            func.coalesce(func.sum(users.c.current_usage), 0),
+            func.coalesce(func.sum(users.c.usage_limit), 0)
+        ).select_from(
+            users.join(hierarchy, hierarchy.c.descendant_id == users.c.added_by)
+        ).where(hierarchy.c.ancestor_id == admin_id)
+    ).first()
+    return (row[0] or 0, row[1] or 0) if row else (0, 0)
+
+
+def admin_before_update(mapper, connection, target):
+    """Take a moving admin's counters off its old ancestors"""
+    if attributes.get_history(target, 'parent_admin_id').has_changes():
+        consumed, reserved = _subtree_counters(connection, target.id)
+        _apply_deltas(connection, target.id, consumed=-consumed, reserved=-reserved, include_self=False)
+
+
+def admin_after_update(mapper, connection, target):
+    """Add a moved admin's counters to its new ancestors"""
+    if attributes.get_history(target, 'parent_admin_id').has_changes():
+        consumed, reserved = _subtree_counters(connection, target.id)
+        _apply_deltas(connection, target.id, consumed=consumed, reserved=reserved, include_self=False)
+
+    ledger = AgentTrafficLedger.__table__
+    if attributes.get_history(target, 'mode').has_changes():
+        # Only agent rows are kept up to date online, so refill a new agent's row
+        consumed, reserved = _subtree_counters(connection, target.id)
+        connection.execute(
+            ledger.update().where(ledger.c.admin_id == target.id).values(
+                consumed=consumed, reserved=reserved, updated_at=datetime.datetime.utcnow()
+            )
+        )
+
+    if attributes.get_history(target, 'traffic_limit').has_changes():
+        # Let the adaptive checker look at the new limit right away
+        connection.execute(
+            ledger.update().where(ledger.c.admin_id == target.id).values(next_check_at=None)
+        )
+
+
+def reconcile_traffic_ledger(batch_size: int = RECONCILE_BATCH_SIZE):
+    """
+    همگام‌سازی کامل شمارنده‌ها با SUM(current_usage) و SUM(usage_limit)
+
+    Missing ledger rows are created, then the counters are recomputed in
+    batches of batch_size admin ids, each in a transaction of its own. A
+    batch first locks its ledger rows in ascending id order (the order
+    reserve_traffic() and the usage flush use), so the sums cannot miss a
+    delta committed meanwhile, and only holds those rows until it commits.
+    """
+    ledger = AgentTrafficLedger.__table__
+    hierarchy = AdminHierarchy.__table__
+    users = User.__table__
+
+    db.session.execute(
+        ledger.insert().from_select(
+            ['admin_id', 'consumed', 'reserved'],
+            select(AdminUser.id, literal(0), literal(0)).where(
+                AdminUser.id.notin_(select(ledger.c.admin_id))
+            )
+        )
+    )
+    db.session.commit()
+
+    def subtree_sum(column):
+        return select(
+            func.coalesce(func.sum(column), 0)
+        ).select_from(
+            users.join(hierarchy, hierarchy.c.descendant_id == users.c.added_by)
+        ).where(
+            hierarchy.c.ancestor_id == ledger.c.admin_id
+        ).scalar_subquery()
+
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(ledger.c.admin_id).where(
+                ledger.c.admin_id > last_id
+            ).order_by(ledger.c.admin_id).limit(batch_size).with_for_update()
+        ).scalars().all()
+        if not batch:
+            db.session.commit()
+            break
+
+        now = datetime.datetime.utcnow()
+        db.session.execute(
+            ledger.update().where(
+                ledger.c.admin_id >= batch[0], ledger.c.admin_id <= batch[-1]
+            ).values(
+                consumed=subtree_sum(users.c.current_usage),
+                reserved=subtree_sum(users.c.usage_limit),
+                updated_at=now,
+                reconciled_at=now
+            )
+        )
+        db.session.commit()
+        last_id = batch[-1]
+
+    from ..utils.stats_cache import agent_stats_cache
+    from ..utils.request_memo import invalidate_request_memo
+    agent_stats_cache.clear()
+    invalidate_request_memo()
+    logger.debug("Agent traffic ledger reconciled")
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    """No-op 'set' listener; registered with active_history=True"""
+    return value
+
+
+def init_traffic_ledger():
+    """Create the ledger table, fill it if empty and register listeners"""
+    AgentTrafficLedger.__table__.create(db.engine, checkfirst=True)
+
+    columns = [col['name'] for col in db.inspect(db.engine).get_columns(AgentTrafficLedger.__tablename__)]
+    missing = [(name, ddl) for name, ddl in _ADDED_COLUMNS if name not in columns]
+    for name, ddl in missing:
+        logger.info(f"Adding {name} column to agent_traffic_ledger table...")
+        db.session.execute(db.text(f"ALTER TABLE agent_traffic_ledger ADD COLUMN {name} {ddl}"))
+    if missing:
+        db.session.commit()
+        for index in AgentTrafficLedger.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    if 'reserved' in dict(missing) or db.session.query(AgentTrafficLedger.admin_id).first() is None:
+        reconcile_traffic_ledger()
+
+    for target, name, listener in (
+        (User, 'after_insert', user_after_insert),
+        (User, 'after_update', user_after_update),
+        (User, 'after_delete', user_after_delete),
+        (AdminUser, 'after_insert', admin_after_insert),
+        # Registered after the admin_hierarchy listeners, so after_update
+        # sees the new ancestors
+        (AdminUser, 'before_update', admin_before_update),
+        (AdminUser, 'after_update', admin_after_update),
+        (Session, 'before_flush', session_before_flush),
+        (Session, 'after_flush', session_after_flush),
+        (Session, 'after_rollback', session_after_rollback),
+    ):
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    # Load the stored value before these are overwritten, so the listeners
+    # see the real change even when the attribute was expired (e.g. by a
+    # commit) when it was set; current_usage is read by session_before_flush
+    for attribute in (User.usage_limit, User.added_by):
+        if not event.contains(attribute, 'set', _load_old_value):
+            event.listen(attribute, 'set', _load_old_value, active_history=True, retval=True)
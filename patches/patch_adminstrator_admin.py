@@ -301,7 +301,7 @@ def patch_adminstrator_admin(file_path):
     if re.search(on_model_change_pattern, content):
         content = re.sub(
             on_model_change_pattern,
-            r"\1\n\n        # Handle traffic_limit_GB from form\n        if hasattr(form, 'traffic_limit_GB') and form.traffic_limit_GB.data is not None:\n            from hiddifypanel.database import db\n            traffic_limit_bytes = form.traffic_limit_GB.data\n            db.session.execute(\n                db.text(\"UPDATE admin_user SET traffic_limit = :limit WHERE id = :id\"),\n                {\"limit\": traffic_limit_bytes, \"id\": model.id}\n            )",
+            r"\1\n\n        # Handle traffic_limit_GB from form\n        if hasattr(form, 'traffic_limit_GB') and form.traffic_limit_GB.data is not None:\n            model.traffic_limit = form.traffic_limit_GB.data",
             content
         )
     
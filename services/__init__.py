@@ -3,15 +3,33 @@ Services package for HiddifyPanel
 """
 from .traffic_service import (
     update_agent_traffic,
+    reconcile_agents_traffic,
     log_user_traffic,
     check_agent_can_create_user,
     check_agent_can_update_user_traffic
 )
+from .traffic_log_buffer import TrafficLogBuffer, traffic_log_buffer, init_traffic_log_buffer
+from .traffic_rollup import rollup_traffic_logs, get_traffic_total, get_traffic_series
+from .traffic_log_partitions import TrafficLogRouter, traffic_log_router, maintain_traffic_log_partitions
+from .traffic_log_archive import TrafficLogArchive, get_traffic_log_archive, archive_traffic_logs
 
 __all__ = [
     'update_agent_traffic',
+    'reconcile_agents_traffic',
     'log_user_traffic',
     'check_agent_can_create_user',
-    'check_agent_can_update_user_traffic'
+    'check_agent_can_update_user_traffic',
+    'TrafficLogBuffer',
+    'traffic_log_buffer',
+    'init_traffic_log_buffer',
+    'rollup_traffic_logs',
+    'get_traffic_total',
+    'get_traffic_series',
+    'TrafficLogRouter',
+    'traffic_log_router',
+    'maintain_traffic_log_partitions',
+    'TrafficLogArchive',
+    'get_traffic_log_archive',
+    'archive_traffic_logs'
 ]
 
@@ -0,0 +1,386 @@
+"""
+Columnar archive of old TrafficLog rows
+آرشیو ستونی لاگ‌های ترافیک قدیمی
+
+archive_traffic_logs() moves traffic_log rows older than
+TRAFFIC_LOG_ARCHIVE_DAYS into one directory per agent and month under
+TRAFFIC_LOG_ARCHIVE_DIR:
+
+    agent_<agent_id>/<YYYYMM>/<first_id>-<last_id>/timestamp.npy     int64, microseconds since the epoch (UTC)
+                                                   id.npy            int64, traffic_log.id
+                                                   user_id.npy       int32, 0 = no user
+                                                   used_traffic.npy  int64, bytes
+
+Every archiving batch adds a chunk to its month; once the month is closed
+(or has more than MAX_CHUNKS chunks) the chunks are compacted into one.
+Rows of a chunk are sorted by (timestamp, id), so TrafficLogArchive answers range sums
+with a binary search and per-user/per-day totals with vectorized NumPy
+operations on memory-mapped files. About 28 bytes per row, against the table
+row plus its five indexes. The description column is not archived, and only
+rows already rolled up (see traffic_rollup.py) are moved, so the rollup
+tables keep covering the archived period. get_traffic_total() reads the
+archive for the partial hours at the edges of its range; iter_logs(),
+get_logs_page() and the traffic log export only see rows still in the
+database.
+
+NumPy is only needed when the archive is used.
+"""
+import os
+import re
+import shutil
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from hiddifypanel.database import db
+from hiddifypanel.models.agent import TrafficRollupWatermark
+from loguru import logger
+from sqlalchemy import select
+
+from .traffic_log_partitions import add_months, month_start, traffic_log_router
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = {
+    'timestamp': '<i8',
+    'id': '<i8',
+    'user_id': '<i4',
+    'used_traffic': '<i8',
+}
+
+# Rows read from the database per batch
+DEFAULT_BATCH_SIZE = 50000
+
+# A month with more chunks than this is compacted even if it is still open
+MAX_CHUNKS = 32
+
+_CHUNK_RE = re.compile(r'^(\d+)-(\d+)(?:-\d+)?$')
+_EPOCH = datetime(1970, 1, 1)
+_US_PER_DAY = 86400 * 1000000
+
+
+def _sorted(columns: dict) -> dict:
+    """Columns reordered by (timestamp, id)"""
+    order = np.lexsort((columns['id'], columns['timestamp']))
+    return {column: values[order] for column, values in columns.items()}
+
+
+def to_microseconds(value: datetime) -> int:
+    """Naive UTC (or aware) datetime -> microseconds since the epoch"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("The traffic log archive needs NumPy (pip install numpy)")
+
+
+class TrafficLogArchive:
+    """
+    Reader and writer of the per-agent, per-month column files
+
+    Example:
+        archive = TrafficLogArchive('/var/lib/hiddify/traffic_archive')
+        archive.range_sum(agent_id=3, start=datetime(2025, 1, 1), end=datetime(2025, 4, 1))
+        archive.user_totals(agent_id=3)
+    """
+
+    def __init__(self, root: str):
+        _require_numpy()
+        self.root = root
+
+    # -- layout ----------------------------------------------------------------
+
+    def _month_dir(self, agent_id, month: datetime) -> str:
+        return os.path.join(self.root, f"agent_{agent_id or 0}", f"{month:%Y%m}")
+
+    def agents(self) -> list:
+        """Agent ids with archived rows (0 = rows without an agent)"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            int(name[len('agent_'):]) for name in os.listdir(self.root)
+            if name.startswith('agent_') and name[len('agent_'):].isdigit()
+        )
+
+    def months(self, agent_id) -> list:
+        """Archived months of an agent, oldest first"""
+        agent_dir = os.path.join(self.root, f"agent_{agent_id or 0}")
+        if not os.path.isdir(agent_dir):
+            return []
+        return sorted(
+            datetime.strptime(name, '%Y%m') for name in os.listdir(agent_dir)
+            if len(name) == 6 and name.isdigit()
+        )
+
+    def chunks(self, agent_id, month: datetime) -> list:
+        """Chunk directories of a month, by first id"""
+        month_dir = self._month_dir(agent_id, month)
+        if not os.path.isdir(month_dir):
+            return []
+        if os.path.exists(os.path.join(month_dir, 'id.npy')):
+            # Month written as a single set of column files
+            return [month_dir]
+        ranges = []
+        for name in os.listdir(month_dir):
+            match = _CHUNK_RE.match(name)
+            if match:
+                ranges.append((int(match.group(1)), int(match.group(2)), name))
+        return [os.path.join(month_dir, name) for _, _, name in sorted(ranges)]
+
+    @staticmethod
+    def _read_chunk(chunk_dir: str, mmap: bool = True) -> dict:
+        return {
+            column: np.load(os.path.join(chunk_dir, f"{column}.npy"), mmap_mode='r' if mmap else None)
+            for column in COLUMNS
+        }
+
+    def read(self, agent_id, month: datetime, mmap: bool = True) -> dict:
+        """{column: array} of one month sorted by (timestamp, id) (empty arrays if nothing is archived)"""
+        chunks = [self._read_chunk(chunk_dir, mmap) for chunk_dir in self.chunks(agent_id, month)]
+        if not chunks:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+        if len(chunks) == 1:
+            return chunks[0]
+        return _sorted({column: np.concatenate([chunk[column] for chunk in chunks]) for column in COLUMNS})
+
+    # -- writing -----------------------------------------------------------------
+
+    def append(self, agent_id, month: datetime, columns: dict) -> int:
+        """
+        Add rows to a month as a new chunk; returns how many were new
+
+        Only the new rows are written, so archiving a month batch by batch
+        costs O(rows) I/O; compact() later merges the chunks. Rows whose id
+        is archived already (only chunks with an overlapping id range are
+        looked at) are skipped, so a run interrupted between writing the
+        files and deleting the rows can simply be repeated.
+        """
+        new = {column: np.asarray(columns[column], dtype=dtype) for column, dtype in COLUMNS.items()}
+        if not len(new['id']):
+            return 0
+        first_id, last_id = int(new['id'].min()), int(new['id'].max())
+        for chunk_dir in self.chunks(agent_id, month):
+            ids = np.load(os.path.join(chunk_dir, 'id.npy'), mmap_mode='r')
+            if len(ids) and ids.min() <= last_id and ids.max() >= first_id:
+                fresh = ~np.isin(new['id'], ids)
+                new = {column: values[fresh] for column, values in new.items()}
+        if not len(new['id']):
+            return 0
+
+        month_dir = self._month_dir(agent_id, month)
+        name = f"{int(new['id'].min())}-{int(new['id'].max())}"
+        suffix = 0
+        while os.path.exists(os.path.join(month_dir, name if not suffix else f"{name}-{suffix}")):
+            suffix += 1
+        staging = self._write_staging(f"{month_dir}.tmp-{os.getpid()}", _sorted(new))
+        os.makedirs(month_dir, exist_ok=True)
+        os.rename(staging, os.path.join(month_dir, name if not suffix else f"{name}-{suffix}"))
+        return len(new['id'])
+
+    def compact(self, agent_id, month: datetime) -> int:
+        """
+        Merge the chunks of a month into one; returns the rows rewritten
+
+        The month is loaded once, written into a new directory and swapped
+        in; readers keep their (unlinked) mmaps of the previous version.
+        """
+        chunks = self.chunks(agent_id, month)
+        month_dir = self._month_dir(agent_id, month)
+        if len(chunks) <= 1 and chunks != [month_dir]:
+            return 0
+
+        merged = self.read(agent_id, month, mmap=False)
+        staging = f"{month_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        self._write_staging(
+            os.path.join(staging, f"{int(merged['id'].min())}-{int(merged['id'].max())}"), merged
+        )
+
+        previous = f"{month_dir}.old-{os.getpid()}"
+        os.rename(month_dir, previous)
+        os.rename(staging, month_dir)
+        shutil.rmtree(previous, ignore_errors=True)
+        return len(merged['id'])
+
+    @staticmethod
+    def _write_staging(path: str, columns: dict) -> str:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        for column, values in columns.items():
+            with open(os.path.join(path, f"{column}.npy"), 'wb') as f:
+                np.save(f, values)
+                f.flush()
+                os.fsync(f.fileno())
+        return path
+
+    # -- queries -------------------------------------------------------------------
+
+    def _slices(self, agent_id, start: datetime = None, end: datetime = None):
+        """(columns, lo, hi) of every archived chunk overlapping [start, end)"""
+        start_us = to_microseconds(start) if start else None
+        end_us = to_microseconds(end) if end else None
+        for month in self.months(agent_id):
+            if end is not None and month >= end:
+                continue
+            if start is not None and add_months(month, 1) <= start:
+                continue
+            for chunk_dir in self.chunks(agent_id, month):
+                columns = self._read_chunk(chunk_dir)
+                timestamps = columns['timestamp']
+                lo = int(np.searchsorted(timestamps, start_us, 'left')) if start_us is not None else 0
+                hi = int(np.searchsorted(timestamps, end_us, 'left')) if end_us is not None else len(timestamps)
+                if lo < hi:
+                    yield columns, lo, hi
+
+    def total(self, start: datetime = None, end: datetime = None, agent_id: int = None, user_id: int = None) -> int:
+        """Bytes archived in [start, end) for an agent, a user, both or everyone"""
+        agent_ids = [agent_id] if agent_id else self.agents()
+        return sum(self.range_sum(agent, start, end, user_id) for agent in agent_ids)
+
+    def range_sum(self, agent_id, start: datetime = None, end: datetime = None, user_id: int = None) -> int:
+        """Bytes archived for an agent (optionally one user) in [start, end)"""
+        total = 0
+        for columns, lo, hi in self._slices(agent_id, start, end):
+            used = columns['used_traffic'][lo:hi]
+            if user_id is not None:
+                used = used[columns['user_id'][lo:hi] == user_id]
+            total += int(used.sum())
+        return total
+
+    def user_totals(self, agent_id, start: datetime = None, end: datetime = None) -> dict:
+        """{user_id: bytes} archived for an agent in [start, end)"""
+        totals = defaultdict(int)
+        for columns, lo, hi in self._slices(agent_id, start, end):
+            users, inverse = np.unique(columns['user_id'][lo:hi], return_inverse=True)
+            sums = np.bincount(inverse, weights=columns['used_traffic'][lo:hi], minlength=len(users))
+            for user_id, used in zip(users.tolist(), sums.tolist()):
+                totals[user_id] += int(used)
+        return dict(totals)
+
+    def daily_totals(self, agent_id, start: datetime = None, end: datetime = None, user_id: int = None) -> list:
+        """[(day, bytes)] archived for an agent (optionally one user) in [start, end)"""
+        totals = defaultdict(int)
+        for columns, lo, hi in self._slices(agent_id, start, end):
+            days = columns['timestamp'][lo:hi] // _US_PER_DAY
+            used = columns['used_traffic'][lo:hi]
+            if user_id is not None:
+                mask = columns['user_id'][lo:hi] == user_id
+                days, used = days[mask], used[mask]
+            unique_days, inverse = np.unique(days, return_inverse=True)
+            sums = np.bincount(inverse, weights=used, minlength=len(unique_days))
+            for day, value in zip(unique_days.tolist(), sums.tolist()):
+                totals[day] += int(value)
+        return [(_EPOCH + timedelta(days=day), totals[day]) for day in sorted(totals)]
+
+    def info(self) -> dict:
+        """Number of agents, months, chunks, rows and bytes on disk"""
+        months = chunks = rows = size = 0
+        for agent_id in self.agents():
+            for month in self.months(agent_id):
+                months += 1
+                for chunk_dir in self.chunks(agent_id, month):
+                    chunks += 1
+                    rows += len(np.load(os.path.join(chunk_dir, 'id.npy'), mmap_mode='r'))
+                    size += sum(
+                        os.path.getsize(os.path.join(chunk_dir, f"{column}.npy")) for column in COLUMNS
+                    )
+        return {'agents': len(self.agents()), 'months': months, 'chunks': chunks, 'rows': rows, 'bytes': size}
+
+
+def get_traffic_log_archive(root: str = None) -> TrafficLogArchive:
+    """Archive in TRAFFIC_LOG_ARCHIVE_DIR (default: <instance path>/traffic_archive)"""
+    if root is None:
+        from flask import current_app
+        root = current_app.config.get('TRAFFIC_LOG_ARCHIVE_DIR') or os.path.join(
+            current_app.instance_path, 'traffic_archive'
+        )
+    return TrafficLogArchive(root)
+
+
+def rows_to_columns(rows: list) -> dict:
+    return {
+        'timestamp': [to_microseconds(row['timestamp']) for row in rows],
+        'id': [row['id'] for row in rows],
+        'user_id': [row['user_id'] or 0 for row in rows],
+        'used_traffic': [row['used_traffic'] for row in rows],
+    }
+
+
+def archive_traffic_logs(older_than_days: int = None, archive: TrafficLogArchive = None,
+                         batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    """
+    Move traffic_log rows older than older_than_days into the archive
+
+    Every batch is written to the files first (one new chunk per agent and
+    month) and deleted from its table afterwards, in its own transaction.
+    Only rows at or below the table's rollup watermark are moved. Months
+    touched by the run are compacted when they are closed.
+
+    Args:
+        older_than_days: TRAFFIC_LOG_ARCHIVE_DAYS when None
+    """
+    from flask import current_app
+
+    if older_than_days is None:
+        older_than_days = current_app.config.get('TRAFFIC_LOG_ARCHIVE_DAYS')
+    if not older_than_days:
+        return {'skipped': True, 'reason': 'TRAFFIC_LOG_ARCHIVE_DAYS is not set'}
+    archive = archive or get_traffic_log_archive()
+    cutoff = datetime.utcnow() - timedelta(days=int(older_than_days))
+    watermarks = TrafficRollupWatermark.__table__
+
+    with db.engine.connect() as connection:
+        tables = traffic_log_router.tables_for_range(connection, None, cutoff)
+
+    moved = 0
+    touched = set()
+    for log in tables:
+        last_id = 0
+        while True:
+            with db.engine.begin() as connection:
+                watermark = connection.execute(
+                    select(watermarks.c.last_log_id).where(watermarks.c.name == log.name)
+                ).scalar() or 0
+                rows = connection.execute(
+                    select(log.c.id, log.c.agent_id, log.c.user_id, log.c.used_traffic, log.c.timestamp).where(
+                        log.c.id > last_id,
+                        log.c.id <= watermark,
+                        log.c.timestamp < cutoff
+                    ).order_by(log.c.id).limit(batch_size)
+                ).mappings().all()
+                if not rows:
+                    break
+
+                groups = defaultdict(list)
+                for row in rows:
+                    groups[(row['agent_id'] or 0, month_start(row['timestamp']))].append(row)
+                for (agent_id, month), group in groups.items():
+                    archive.append(agent_id, month, rows_to_columns(group))
+                    touched.add((agent_id, month))
+
+                connection.execute(log.delete().where(
+                    log.c.id > last_id,
+                    log.c.id <= rows[-1]['id'],
+                    log.c.id <= watermark,
+                    log.c.timestamp < cutoff
+                ))
+                last_id = rows[-1]['id']
+                moved += len(rows)
+        logger.debug(f"Archived {log.name} up to id {last_id}")
+
+    compacted = 0
+    for agent_id, month in sorted(touched):
+        # Rows of an open month keep arriving; compact it only when it has too many chunks
+        if add_months(month, 1) <= cutoff or len(archive.chunks(agent_id, month)) > MAX_CHUNKS:
+            archive.compact(agent_id, month)
+            compacted += 1
+
+    logger.info(f"Archived {moved} traffic log rows older than {cutoff:%Y-%m-%d}, compacted {compacted} months")
+    return {'archived': moved, 'compacted': compacted, 'cutoff': cutoff.isoformat()}
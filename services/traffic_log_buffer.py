@@ -0,0 +1,287 @@
+"""
+Write-behind buffer for TrafficLog rows
+بافر نوشتن دسته‌ای لاگ‌های ترافیک
+"""
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from hiddifypanel.database import db
+from loguru import logger
+
+# Flush when this many rows are waiting...
+DEFAULT_MAX_ROWS = 1000
+# ...or when the oldest waiting row is this old (seconds)
+DEFAULT_MAX_DELAY = 5.0
+# Rows kept while the database is unreachable; older ones are dropped
+DEFAULT_MAX_PENDING = 100000
+# Longest wait between two flush attempts after failures (seconds)
+MAX_RETRY_DELAY = 60.0
+
+
+class TrafficLogBuffer:
+    """
+    Accumulate traffic_log rows in memory and insert them in batches
+
+    Rows are written with one executemany INSERT per flush (per month with
+    monthly partition tables) on a connection of their own, so the caller's
+    session is never touched. A flush happens
+    when max_rows rows are waiting, when the oldest row is max_delay seconds
+    old (background thread, started by the first add()) and at interpreter
+    exit. If a flush fails the
+    rows are kept for the next one, up to max_pending rows in total; that,
+    plus whatever is buffered when the process is killed, is the bounded
+    loss this trades for throughput.
+
+    Rows of users that no longer exist are discarded before the INSERT. A
+    batch rejected by the database for its data (IntegrityError/DataError)
+    is split in halves until the offending rows are isolated and discarded,
+    so one bad row cannot block the others. Any other failure (database
+    unreachable) backs off: no inline flushes from add() and no background
+    flush until the retry delay, which doubles up to MAX_RETRY_DELAY.
+    """
+
+    def __init__(self, max_rows: int = DEFAULT_MAX_ROWS, max_delay: float = DEFAULT_MAX_DELAY,
+                 max_pending: int = DEFAULT_MAX_PENDING, engine=None, table=None, user_table=None):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.engine = engine
+        self.table = table
+        self.user_table = user_table
+        self.written = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.flushes = 0
+        self.failures = 0
+        self._retry_at = None
+        self._rows = deque()
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _user_table(self):
+        if self.user_table is None:
+            from hiddifypanel.models import User
+            self.user_table = User.__table__
+        return self.user_table
+
+    def add(self, user_id: int, used_traffic: int, agent_id: int = None,
+            description: str = None, timestamp: datetime = None):
+        """Queue one row; flushes inline when max_rows rows are waiting"""
+        row = {
+            'user_id': user_id,
+            'agent_id': agent_id,
+            'used_traffic': used_traffic,
+            'timestamp': timestamp or datetime.utcnow(),
+            'description': description,
+        }
+        with self._lock:
+            self._rows.append(row)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._rows) > self.max_pending:
+                self._rows.popleft()
+                self.dropped += 1
+            full = len(self._rows) >= self.max_rows
+
+        if self._thread is None:
+            self.start()
+
+        # While backing off the request thread must not wait for the database
+        if full and not self.backing_off():
+            self.flush()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def backing_off(self) -> bool:
+        """True while waiting to retry after a failed flush"""
+        retry_at = self._retry_at
+        return retry_at is not None and time.monotonic() < retry_at
+
+    def flush(self) -> int:
+        """Insert all waiting rows; returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._rows:
+                    return 0
+                rows = list(self._rows)
+                self._rows.clear()
+                self._oldest = None
+
+            written, unwritten, error = 0, rows, None
+            try:
+                rows = self._resolve_users(rows)
+                written, unwritten, error = self._insert_isolating(rows)
+            except Exception as e:
+                error = e
+
+            self.written += written
+            if error is not None:
+                self._back_off()
+                logger.error(
+                    f"Could not write {len(unwritten)} traffic log rows, keeping them for the next flush "
+                    f"in {self._retry_at - time.monotonic():.0f}s: {error}"
+                )
+                self._requeue(unwritten)
+                return written
+
+            self.failures = 0
+            self._retry_at = None
+            self.flushes += 1
+            return written
+
+    def _engine(self):
+        return self.engine if self.engine is not None else db.engine
+
+    def _resolve_users(self, rows: list) -> list:
+        """Fill in the owner agent of rows queued without one and drop rows of unknown users"""
+        from sqlalchemy import select
+
+        user_ids = {row['user_id'] for row in rows if row['user_id']}
+        if not user_ids:
+            return rows
+
+        user_table = self._user_table()
+        has_agent = 'agent_id' in user_table.c
+        columns = [user_table.c.id, user_table.c.agent_id] if has_agent else [user_table.c.id]
+        with self._engine().connect() as connection:
+            users = {
+                row[0]: row[1] if has_agent else None
+                for row in connection.execute(select(*columns).where(user_table.c.id.in_(user_ids)))
+            }
+
+        kept = []
+        for row in rows:
+            if row['user_id'] and row['user_id'] not in users:
+                continue
+            if row['agent_id'] is None and row['user_id']:
+                row['agent_id'] = users[row['user_id']]
+            kept.append(row)
+
+        if len(kept) < len(rows):
+            self.discarded += len(rows) - len(kept)
+            logger.warning(f"Discarded {len(rows) - len(kept)} traffic log rows of deleted or unknown users")
+        return kept
+
+    def _insert_isolating(self, rows: list) -> tuple:
+        """
+        Insert rows, splitting batches the database rejects for their data
+
+        Returns:
+            (written, unwritten rows, error): error is the exception that
+            stopped the flush, with unwritten the rows still to be written
+        """
+        from sqlalchemy.exc import DataError, IntegrityError
+
+        written = 0
+        chunks = [rows] if rows else []
+        while chunks:
+            chunk = chunks.pop()
+            try:
+                self._insert(chunk)
+            except (IntegrityError, DataError) as e:
+                if len(chunk) == 1:
+                    self.discarded += 1
+                    logger.warning(f"Discarded a traffic log row rejected by the database: {chunk[0]} ({e.orig})")
+                else:
+                    middle = len(chunk) // 2
+                    chunks.extend([chunk[middle:], chunk[:middle]])
+                continue
+            except Exception as e:
+                unwritten = chunk + [row for pending in reversed(chunks) for row in pending]
+                return written, unwritten, e
+            written += len(chunk)
+        return written, [], None
+
+    def _insert(self, rows: list):
+        with self._engine().begin() as connection:
+            if self.table is not None:
+                connection.execute(self.table.insert(), rows)
+            else:
+                from .traffic_log_partitions import traffic_log_router
+                traffic_log_router.insert(connection, rows)
+
+    def _back_off(self):
+        """Schedule the next flush attempt after a failure"""
+        self.failures += 1
+        delay = min(MAX_RETRY_DELAY, max(self.max_delay, 1.0) * 2 ** (self.failures - 1))
+        self._retry_at = time.monotonic() + delay
+
+    def _requeue(self, rows: list):
+        """Put rows of a failed flush back in front, dropping the oldest beyond max_pending"""
+        with self._lock:
+            self._rows.extendleft(reversed(rows))
+            overflow = len(self._rows) - self.max_pending
+            for _ in range(max(0, overflow)):
+                self._rows.popleft()
+            if overflow > 0:
+                self.dropped += overflow
+                logger.warning(f"Traffic log buffer full, dropped {overflow} oldest rows")
+            if self._rows and self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def start(self):
+        """Start the background thread flushing rows older than max_delay"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self.engine is None:
+                try:
+                    # The flush thread runs outside the app context
+                    self.engine = db.engine
+                except RuntimeError:
+                    pass
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='traffic-log-buffer', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread and write what is left"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.wait(min(1.0, self.max_delay)):
+            oldest = self._oldest
+            if oldest is not None and time.monotonic() - oldest >= self.max_delay and not self.backing_off():
+                self.flush()
+
+    def info(self) -> dict:
+        """Counters of the buffer"""
+        return {
+            'pending': len(self._rows),
+            'written': self.written,
+            'dropped': self.dropped,
+            'discarded': self.discarded,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'max_rows': self.max_rows,
+            'max_delay': self.max_delay,
+        }
+
+
+traffic_log_buffer = TrafficLogBuffer()
+
+
+def init_traffic_log_buffer(app) -> TrafficLogBuffer:
+    """Configure the buffer from the app config; its flush thread starts with the first row"""
+    traffic_log_buffer.max_rows = int(app.config.get('TRAFFIC_LOG_BUFFER_ROWS', DEFAULT_MAX_ROWS))
+    traffic_log_buffer.max_delay = float(app.config.get('TRAFFIC_LOG_BUFFER_DELAY', DEFAULT_MAX_DELAY))
+    traffic_log_buffer.max_pending = int(app.config.get('TRAFFIC_LOG_BUFFER_MAX_PENDING', DEFAULT_MAX_PENDING))
+    if app.config.get('TRAFFIC_LOG_PARTITIONING'):
+        # The flush thread runs outside the app context
+        from .traffic_log_partitions import traffic_log_router
+        traffic_log_router.configure(app.config['TRAFFIC_LOG_PARTITIONING'])
+    with app.app_context():
+        traffic_log_buffer.engine = db.engine
+    return traffic_log_buffer
@@ -0,0 +1,488 @@
+"""
+Monthly partitions of traffic_log
+پارتیشن‌بندی ماهانه جدول traffic_log
+
+TRAFFIC_LOG_PARTITIONING selects one of:
+
+- 'none' (default): the single traffic_log table
+- 'native': MySQL/MariaDB RANGE partitions pYYYYMM on TO_DAYS(timestamp), set
+  up once by migrations/partition_traffic_log.py; reads and writes still go to
+  traffic_log and the server prunes partitions from the timestamp predicate
+- 'tables': one traffic_log_YYYYMM table per month (SQLite, or any database
+  without native partitions); traffic_log_router writes each row to the
+  table of its month and reads only the months of the requested range.
+  Rows logged before the switch stay in traffic_log, which is always read.
+  Ids come from one counter shared by all months (traffic_log_id_sequence),
+  so they are unique across the tables.
+
+Old months are removed by dropping their partition or table
+(maintain_traffic_log_partitions), never with a DELETE scan.
+"""
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from hiddifypanel.database import db
+from hiddifypanel.models.agent import TrafficLog, TrafficRollupWatermark
+from loguru import logger
+from sqlalchemy import BigInteger, Column, Index, MetaData, String, Table, func, inspect, select, text, union_all
+from sqlalchemy.exc import IntegrityError
+
+MODES = ('none', 'native', 'tables')
+
+MONTH_TABLE_PREFIX = 'traffic_log_'
+
+# Single-row table holding the last id handed out to a month table
+ID_SEQUENCE_TABLE = 'traffic_log_id_sequence'
+
+# Partitions/tables created ahead of the current month
+DEFAULT_MONTHS_AHEAD = 2
+
+_MONTH_TABLE_RE = re.compile(r'^traffic_log_(\d{4})(\d{2})$')
+_PARTITION_RE = re.compile(r'^p(\d{4})(\d{2})$')
+_CATCH_ALL_PARTITION = 'pmax'
+
+# Month tables live outside db.Model's metadata so create_all() ignores them
+_month_metadata = MetaData()
+
+_id_sequence = Table(
+    ID_SEQUENCE_TABLE, _month_metadata,
+    Column('name', String(64), primary_key=True),
+    Column('last_id', BigInteger, nullable=False)
+)
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    years, index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + years, month=index + 1)
+
+
+def _log_order(columns, descending: bool) -> list:
+    """(timestamp, id) keyset order of traffic_log rows"""
+    if descending:
+        return [columns.timestamp.desc(), columns.id.desc()]
+    return [columns.timestamp.asc(), columns.id.asc()]
+
+
+def _parse_month(match) -> datetime:
+    return datetime(int(match.group(1)), int(match.group(2)), 1)
+
+
+class TrafficLogRouter:
+    """
+    Route traffic_log reads and writes to the monthly partitions
+
+    Example:
+        with db.engine.begin() as connection:
+            traffic_log_router.insert(connection, rows)
+            query = traffic_log_router.select(connection, where, start, end)
+    """
+
+    def __init__(self, mode: str = None):
+        self._mode = mode
+        self._config_mode = 'none'
+        self._lock = threading.Lock()
+        self._id_sequence_ready = False
+
+    @property
+    def mode(self) -> str:
+        mode = self._mode
+        if mode is None:
+            from flask import current_app
+            try:
+                mode = self._config_mode = current_app.config.get('TRAFFIC_LOG_PARTITIONING', 'none')
+            except RuntimeError:
+                # Outside of an app context (e.g. the log buffer thread)
+                mode = self._config_mode
+        if mode not in MODES:
+            raise ValueError(f"Unknown TRAFFIC_LOG_PARTITIONING: {mode}")
+        return mode
+
+    def configure(self, mode: str = None):
+        """Fix the mode (None = read TRAFFIC_LOG_PARTITIONING on every use)"""
+        if mode is not None and mode not in MODES:
+            raise ValueError(f"Unknown TRAFFIC_LOG_PARTITIONING: {mode}")
+        self._mode = mode
+
+    # -- table-per-month ---------------------------------------------------
+
+    def month_table(self, month: datetime) -> Table:
+        """Table object of a month (it may not exist in the database yet)"""
+        name = f"{MONTH_TABLE_PREFIX}{month:%Y%m}"
+        with self._lock:
+            # Shared by all routers, like the tables themselves
+            table = _month_metadata.tables.get(name)
+            if table is None:
+                columns = [
+                    Column(column.name, column.type, primary_key=column.primary_key,
+                           nullable=column.nullable, autoincrement=column.primary_key)
+                    for column in TrafficLog.__table__.columns
+                ]
+                table = Table(
+                    name, _month_metadata, *columns,
+                    Index(f'idx_{name}_timestamp', 'timestamp'),
+                    Index(f'idx_{name}_agent', 'agent_id', 'timestamp'),
+                    Index(f'idx_{name}_user', 'user_id', 'timestamp'),
+                    sqlite_autoincrement=True
+                )
+        return table
+
+    def month_tables(self, connection) -> dict:
+        """{month start: Table} of the month tables that exist"""
+        tables = {}
+        for name in inspect(connection).get_table_names():
+            match = _MONTH_TABLE_RE.match(name)
+            if match:
+                month = _parse_month(match)
+                tables[month] = self.month_table(month)
+        return tables
+
+    def _create_month_table(self, connection, month: datetime) -> Table:
+        table = self.month_table(month)
+        if inspect(connection).has_table(table.name):
+            return table
+
+        table.create(connection, checkfirst=True)
+        logger.info(f"Created traffic log table {table.name}")
+        return table
+
+    def _max_log_id(self, connection) -> int:
+        tables = [TrafficLog.__table__] + list(self.month_tables(connection).values())
+        return max(connection.execute(select(func.max(table.c.id))).scalar() or 0 for table in tables)
+
+    def _ensure_id_sequence(self, connection):
+        """Create the id counter, starting after the highest id of every table"""
+        if self._id_sequence_ready:
+            return
+        sequence = _id_sequence
+        sequence.create(connection, checkfirst=True)
+        if connection.execute(select(sequence.c.last_id)).first() is None:
+            connection.execute(sequence.insert().values(
+                name=TrafficLog.__tablename__, last_id=self._max_log_id(connection)
+            ))
+        self._id_sequence_ready = True
+
+    def allocate_ids(self, connection, count: int) -> int:
+        """
+        Reserve count consecutive ids for month table rows; returns the first
+
+        The counter row is locked by the UPDATE until the end of the
+        transaction, so it is taken in a short transaction of its own (an
+        id lost to a rollback is just a gap). SQLite allows only one writer,
+        so there the caller's connection is used.
+        """
+        if connection.dialect.name == 'sqlite':
+            return self._reserve_ids(connection, count)
+
+        if not self._id_sequence_ready:
+            try:
+                with connection.engine.begin() as own:
+                    self._ensure_id_sequence(own)
+            except IntegrityError:
+                # Another process created the counter row at the same time
+                self._id_sequence_ready = True
+        with connection.engine.begin() as own:
+            return self._reserve_ids(own, count)
+
+    def _reserve_ids(self, connection, count: int) -> int:
+        self._ensure_id_sequence(connection)
+        sequence = _id_sequence
+        connection.execute(sequence.update().values(last_id=sequence.c.last_id + count))
+        return connection.execute(select(sequence.c.last_id)).scalar() - count + 1
+
+    # -- routing -------------------------------------------------------------
+
+    def tables_for_range(self, connection, start: datetime = None, end: datetime = None) -> list:
+        """Tables holding the rows of [start, end], oldest first"""
+        base = TrafficLog.__table__
+        if self.mode != 'tables':
+            return [base]
+
+        tables = [base]
+        for month, table in sorted(self.month_tables(connection).items()):
+            if end is not None and month > end:
+                continue
+            if start is not None and add_months(month, 1) <= start:
+                continue
+            tables.append(table)
+        return tables
+
+    def insert(self, connection, rows: list):
+        """
+        Insert traffic_log rows, one executemany per month
+
+        With month tables every row gets its 'id' from the shared counter
+        (the dicts are updated in place).
+        """
+        if not rows:
+            return
+        if self.mode != 'tables':
+            connection.execute(TrafficLog.__table__.insert(), rows)
+            return
+
+        first_id = self.allocate_ids(connection, len(rows))
+        by_month = defaultdict(list)
+        for offset, row in enumerate(rows):
+            row['id'] = first_id + offset
+            by_month[month_start(row['timestamp'])].append(row)
+
+        existing = self.month_tables(connection)
+        for month, month_rows in by_month.items():
+            table = existing.get(month)
+            if table is None:
+                table = self._create_month_table(connection, month)
+            connection.execute(table.insert(), month_rows)
+
+    def select(self, connection, where=None, start: datetime = None, end: datetime = None,
+               descending: bool = None, limit: int = None):
+        """
+        SELECT of the traffic_log columns over the tables of [start, end]
+
+        where(table) returns the conditions for one table; start and end only
+        choose the tables, the caller filters on timestamp itself. With
+        descending set the rows are ordered by (timestamp, id) and, with
+        limit, every table only contributes its first limit rows.
+        """
+        selects = []
+        for table in self.tables_for_range(connection, start, end):
+            columns = [table.c[column.name] for column in TrafficLog.__table__.columns]
+            statement = select(*columns).where(*(where(table) if where else ()))
+            if descending is not None:
+                statement = statement.order_by(*_log_order(table.c, descending)).limit(limit)
+            selects.append(statement)
+        if len(selects) == 1:
+            return selects[0]
+        if descending is None:
+            return union_all(*selects)
+
+        # ORDER BY/LIMIT inside a UNION member needs a subquery on SQLite
+        merged = union_all(*[select(statement.subquery()) for statement in selects]).subquery()
+        return select(merged).order_by(*_log_order(merged.c, descending)).limit(limit)
+
+    # -- maintenance -----------------------------------------------------------
+
+    def partitions(self, connection) -> list:
+        """[{'name', 'start', 'end'}] of the monthly partitions, oldest first"""
+        mode = self.mode
+        if mode == 'tables':
+            return [
+                {'name': table.name, 'start': month, 'end': add_months(month, 1)}
+                for month, table in sorted(self.month_tables(connection).items())
+            ]
+        if mode == 'native':
+            rows = connection.execute(text(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+                "ORDER BY PARTITION_ORDINAL_POSITION"
+            ), {'table': TrafficLog.__tablename__}).scalars().all()
+            partitions = []
+            for name in rows:
+                match = _PARTITION_RE.match(name)
+                if match:
+                    month = _parse_month(match)
+                    partitions.append({'name': name, 'start': month, 'end': add_months(month, 1)})
+            return partitions
+        return []
+
+    def ensure_partitions(self, connection, months_ahead: int = DEFAULT_MONTHS_AHEAD, now: datetime = None) -> list:
+        """Create the partitions up to months_ahead months after now; returns their names"""
+        current = month_start(now or datetime.utcnow())
+        wanted = [add_months(current, offset) for offset in range(months_ahead + 1)]
+        mode = self.mode
+
+        if mode == 'tables':
+            existing = self.month_tables(connection)
+            return [self._create_month_table(connection, month).name for month in wanted if month not in existing]
+
+        if mode == 'native':
+            partitions = self.partitions(connection)
+            if not partitions:
+                raise RuntimeError("traffic_log is not partitioned, run migrations/partition_traffic_log.py")
+            # Months can only be split off the catch-all partition, after the last one
+            month = partitions[-1]['end']
+            created = []
+            while month <= wanted[-1]:
+                name = f"p{month:%Y%m}"
+                connection.execute(text(
+                    f"ALTER TABLE {TrafficLog.__tablename__} REORGANIZE PARTITION {_CATCH_ALL_PARTITION} INTO ("
+                    f"PARTITION {name} VALUES LESS THAN (TO_DAYS('{add_months(month, 1):%Y-%m-%d}')), "
+                    f"PARTITION {_CATCH_ALL_PARTITION} VALUES LESS THAN MAXVALUE)"
+                ))
+                created.append(name)
+                month = add_months(month, 1)
+            return created
+
+        return []
+
+    def _partition_rows(self, connection, partition: dict) -> tuple:
+        """(rows, max id) of a partition"""
+        if self.mode == 'tables':
+            table = self.month_table(partition['start'])
+            conditions = ()
+        else:
+            table = TrafficLog.__table__
+            conditions = (table.c.timestamp >= partition['start'], table.c.timestamp < partition['end'])
+        count, max_id = connection.execute(
+            select(func.count(), func.max(table.c.id)).select_from(table).where(*conditions)
+        ).one()
+        return count, max_id or 0
+
+    def _watermark(self, connection, partition: dict) -> int:
+        """Rollup watermark covering a partition (month tables have their own)"""
+        watermarks = TrafficRollupWatermark.__table__
+        name = partition['name'] if self.mode == 'tables' else TrafficLog.__tablename__
+        return connection.execute(
+            select(watermarks.c.last_log_id).where(watermarks.c.name == name)
+        ).scalar() or 0
+
+    def drop_partitions_before(self, connection, cutoff: datetime, require_empty: bool = False) -> list:
+        """
+        Drop the partitions holding only rows older than cutoff; returns their names
+
+        A partition is only dropped once all of its rows are rolled up (its
+        max id is at or below the rollup watermark), so the rollups keep
+        covering the month. With require_empty (the archive is enabled) it
+        must also have been emptied by archive_traffic_logs().
+        """
+        old = []
+        for partition in self.partitions(connection):
+            if partition['end'] > cutoff:
+                continue
+            count, max_id = self._partition_rows(connection, partition)
+            if max_id > self._watermark(connection, partition):
+                logger.warning(f"Keeping traffic log partition {partition['name']}: not rolled up yet")
+            elif require_empty and count:
+                logger.warning(f"Keeping traffic log partition {partition['name']}: {count} rows not archived yet")
+            else:
+                old.append(partition)
+        if not old:
+            return []
+        names = [partition['name'] for partition in old]
+
+        if self.mode == 'native':
+            connection.execute(text(
+                f"ALTER TABLE {TrafficLog.__tablename__} DROP PARTITION {', '.join(names)}"
+            ))
+        else:
+            watermarks = TrafficRollupWatermark.__table__
+            for partition in old:
+                self.month_table(partition['start']).drop(connection, checkfirst=True)
+            connection.execute(watermarks.delete().where(watermarks.c.name.in_(names)))
+
+        logger.info(f"Dropped traffic log partitions older than {cutoff:%Y-%m-%d}: {names}")
+        return names
+
+    def partition_native_table(self, connection, months_ahead: int = DEFAULT_MONTHS_AHEAD) -> list:
+        """
+        Turn traffic_log into a RANGE-partitioned table (MySQL/MariaDB, once)
+
+        Partitioned InnoDB tables can't have foreign keys and every unique key
+        must contain the partition column, so the foreign keys are dropped
+        and the primary key becomes (id, timestamp). The table is rebuilt.
+        """
+        if connection.dialect.name not in ('mysql', 'mariadb'):
+            raise RuntimeError("Native partitions need MySQL or MariaDB, use TRAFFIC_LOG_PARTITIONING = 'tables'")
+
+        table = TrafficLog.__tablename__
+        for foreign_key in inspect(connection).get_foreign_keys(table):
+            if foreign_key.get('name'):
+                connection.execute(text(f"ALTER TABLE {table} DROP FOREIGN KEY {foreign_key['name']}"))
+        connection.execute(text(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)"))
+
+        oldest = connection.execute(select(func.min(TrafficLog.__table__.c.timestamp))).scalar()
+        month = month_start(oldest or datetime.utcnow())
+        last = add_months(month_start(datetime.utcnow()), months_ahead)
+        names, definitions = [], []
+        while month <= last:
+            names.append(f"p{month:%Y%m}")
+            definitions.append(f"PARTITION {names[-1]} VALUES LESS THAN (TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))")
+            month = add_months(month, 1)
+        definitions.append(f"PARTITION {_CATCH_ALL_PARTITION} VALUES LESS THAN MAXVALUE")
+
+        connection.execute(text(
+            f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(timestamp)) ({', '.join(definitions)})"
+        ))
+        return names
+
+    def move_legacy_rows(self, connection, batch_size: int = 50000) -> int:
+        """
+        Move the rows of traffic_log into the month tables ('tables' mode)
+
+        Ids are kept, and so is the rollup watermark: each month table starts
+        at the watermark of traffic_log, so nothing is rolled up twice.
+        """
+        base = TrafficLog.__table__
+        watermarks = TrafficRollupWatermark.__table__
+        legacy_watermark = connection.execute(
+            select(watermarks.c.last_log_id).where(watermarks.c.name == base.name)
+        ).scalar() or 0
+
+        moved = 0
+        while True:
+            rows = connection.execute(select(base).order_by(base.c.id).limit(batch_size)).mappings().all()
+            if not rows:
+                break
+            by_month = defaultdict(list)
+            for row in rows:
+                by_month[month_start(row['timestamp'])].append(dict(row))
+            existing = self.month_tables(connection)
+            for month, month_rows in by_month.items():
+                table = existing.get(month)
+                if table is None:
+                    table = self.month_table(month)
+                    table.create(connection, checkfirst=True)
+                    if legacy_watermark:
+                        connection.execute(watermarks.insert().values(
+                            name=table.name, last_log_id=legacy_watermark, updated_at=datetime.utcnow()
+                        ))
+                connection.execute(table.insert(), month_rows)
+            connection.execute(base.delete().where(base.c.id <= rows[-1]['id']))
+            moved += len(rows)
+        return moved
+
+
+traffic_log_router = TrafficLogRouter()
+
+
+def maintain_traffic_log_partitions(retention_days: int = None, months_ahead: int = None) -> dict:
+    """
+    Create the upcoming partitions and drop the expired ones
+
+    Args:
+        retention_days: keep rows this many days (TRAFFIC_LOG_RETENTION_DAYS;
+            None/0 = keep everything). Whole months are dropped, so up to a
+            month more than that is kept, and only once they are rolled up
+            and, with TRAFFIC_LOG_ARCHIVE_DAYS set, archived.
+        months_ahead: TRAFFIC_LOG_PARTITIONS_AHEAD (default 2)
+    """
+    from flask import current_app
+
+    if traffic_log_router.mode == 'none':
+        return {'skipped': True, 'reason': 'traffic_log is not partitioned'}
+
+    if retention_days is None:
+        retention_days = current_app.config.get('TRAFFIC_LOG_RETENTION_DAYS')
+    if months_ahead is None:
+        months_ahead = int(current_app.config.get('TRAFFIC_LOG_PARTITIONS_AHEAD', DEFAULT_MONTHS_AHEAD))
+
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        created = traffic_log_router.ensure_partitions(connection, months_ahead, now)
+        dropped = []
+        if retention_days:
+            dropped = traffic_log_router.drop_partitions_before(
+                connection, now - timedelta(days=int(retention_days)),
+                require_empty=bool(current_app.config.get('TRAFFIC_LOG_ARCHIVE_DAYS'))
+            )
+
+    return {
+        'mode': traffic_log_router.mode,
+        'created': created,
+        'dropped': dropped,
+        'timestamp': now.isoformat()
+    }
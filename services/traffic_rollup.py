@@ -0,0 +1,413 @@
+"""
+Hourly and daily rollups of TrafficLog
+جمع‌بندی ساعتی و روزانه لاگ‌های ترافیک
+
+rollup_traffic_logs() adds the traffic_log rows above the watermark (the last
+id already rolled up) to traffic_rollup_hourly and traffic_rollup_daily, and
+moves the watermark, in one transaction. With monthly partition tables (see
+traffic_log_partitions.py) each table has its own watermark. Rows are bucketed by their timestamp,
+so late or backdated rows still land in the right hour.
+
+get_traffic_total() and get_traffic_series() read the coarsest table that
+covers the requested range (whole days from the daily table, whole hours from
+the hourly one) and only scan traffic_log for partial hours at the edges and
+for the rows not rolled up yet. Partial hours older than
+TRAFFIC_LOG_ARCHIVE_DAYS are also read from the columnar archive (see
+traffic_log_archive.py).
+"""
+from datetime import datetime, timedelta
+
+from hiddifypanel.database import db
+from hiddifypanel.models.agent import (
+    ROLLUP_ALL, TrafficRollupDaily, TrafficRollupHourly, TrafficRollupWatermark
+)
+from loguru import logger
+from sqlalchemy import and_, bindparam, func, or_, select
+
+from .traffic_log_partitions import traffic_log_router
+
+WATERMARK_NAME = 'traffic_log'
+
+# Rows of traffic_log rolled up per run at most
+DEFAULT_BATCH_SIZE = 50000
+
+# Rows younger than this are left for the next run, so a transaction that
+# committed a lower id late (e.g. a buffered flush) is not skipped
+DEFAULT_LAG = timedelta(minutes=2)
+
+# get_traffic_series() uses hourly buckets up to this range, daily beyond
+HOURLY_SERIES_MAX_RANGE = timedelta(days=2)
+
+RESOLUTIONS = ('hour', 'day')
+
+_BUCKET_FORMAT = '%Y-%m-%d %H:00:00'
+
+
+def _hour_bucket(column, dialect: str):
+    """SQL expression formatting column as 'YYYY-MM-DD HH:00:00'"""
+    if dialect == 'postgresql':
+        return func.to_char(column, 'YYYY-MM-DD HH24:00:00')
+    if dialect in ('mysql', 'mariadb'):
+        return func.date_format(column, _BUCKET_FORMAT)
+    return func.strftime(_BUCKET_FORMAT, column)
+
+
+def _parse_bucket(value) -> datetime:
+    if isinstance(value, datetime):
+        return value.replace(minute=0, second=0, microsecond=0)
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def _floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_hour(value: datetime) -> datetime:
+    floor = _floor_hour(value)
+    return floor if floor == value else floor + timedelta(hours=1)
+
+
+def _floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _ceil_day(value: datetime) -> datetime:
+    floor = _floor_day(value)
+    return floor if floor == value else floor + timedelta(days=1)
+
+
+def _rollup_keys(agent_id, user_id):
+    """Rollup rows a log of (agent_id, user_id) is added to"""
+    keys = [(ROLLUP_ALL, ROLLUP_ALL)]
+    if agent_id:
+        keys.append((agent_id, ROLLUP_ALL))
+    if user_id:
+        keys.append((agent_id or ROLLUP_ALL, user_id))
+    return keys
+
+
+def _get_watermark(connection, name: str = WATERMARK_NAME) -> int:
+    table = TrafficRollupWatermark.__table__
+    value = connection.execute(
+        select(table.c.last_log_id).where(table.c.name == name)
+    ).scalar()
+    return value or 0
+
+
+def _set_watermark(connection, last_log_id: int, name: str = WATERMARK_NAME):
+    table = TrafficRollupWatermark.__table__
+    values = {'last_log_id': last_log_id, 'updated_at': datetime.utcnow()}
+    updated = connection.execute(
+        table.update().where(table.c.name == name).values(**values)
+    ).rowcount
+    if not updated:
+        connection.execute(table.insert().values(name=name, **values))
+
+
+def _upsert(connection, table, rows: list):
+    """Add used_traffic/entries of rows to table, inserting missing buckets"""
+    if not rows:
+        return
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.agent_id, table.c.user_id, table.c.bucket],
+            set_={
+                'used_traffic': table.c.used_traffic + statement.excluded.used_traffic,
+                'entries': table.c.entries + statement.excluded.entries,
+            }
+        )
+        connection.execute(statement, rows)
+    elif dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        statement = statement.on_duplicate_key_update(
+            used_traffic=table.c.used_traffic + statement.inserted.used_traffic,
+            entries=table.c.entries + statement.inserted.entries,
+        )
+        connection.execute(statement, rows)
+    else:
+        update = table.update().where(
+            table.c.agent_id == bindparam('b_agent_id'),
+            table.c.user_id == bindparam('b_user_id'),
+            table.c.bucket == bindparam('b_bucket'),
+        ).values(
+            used_traffic=table.c.used_traffic + bindparam('b_used_traffic'),
+            entries=table.c.entries + bindparam('b_entries'),
+        )
+        for row in rows:
+            params = {f"b_{key}": value for key, value in row.items()}
+            if not connection.execute(update, params).rowcount:
+                connection.execute(table.insert(), [row])
+
+
+def _rollup_table(connection, log, batch_size: int, cutoff: datetime) -> dict:
+    """Roll up to batch_size rows of one traffic log table above its watermark"""
+    watermark = _get_watermark(connection, log.name)
+    upper = connection.execute(
+        select(func.max(log.c.id)).where(
+            log.c.id > watermark,
+            log.c.id <= watermark + batch_size,
+            log.c.timestamp <= cutoff
+        )
+    ).scalar()
+    if upper is None:
+        # Ids may jump (e.g. the first rows of a month table); skip the gap
+        upper = connection.execute(
+            select(func.min(log.c.id)).where(log.c.id > watermark, log.c.timestamp <= cutoff)
+        ).scalar()
+        if upper is None:
+            return {'table': log.name, 'from_id': watermark, 'to_id': watermark, 'logs': 0,
+                    'hourly_rows': 0, 'daily_rows': 0, 'remaining': False}
+        upper = connection.execute(
+            select(func.max(log.c.id)).where(
+                log.c.id >= upper,
+                log.c.id < upper + batch_size,
+                log.c.timestamp <= cutoff
+            )
+        ).scalar()
+
+    bucket = _hour_bucket(log.c.timestamp, connection.dialect.name)
+    groups = connection.execute(
+        select(
+            bucket.label('bucket'), log.c.agent_id, log.c.user_id,
+            func.sum(log.c.used_traffic), func.count()
+        ).where(
+            log.c.id > watermark,
+            log.c.id <= upper
+        ).group_by(bucket, log.c.agent_id, log.c.user_id)
+    ).all()
+
+    hourly, daily = {}, {}
+    logs = 0
+    for hour, agent_id, user_id, used, entries in groups:
+        hour = _parse_bucket(hour)
+        day = _floor_day(hour)
+        logs += entries
+        for key in _rollup_keys(agent_id, user_id):
+            for totals, start in ((hourly, hour), (daily, day)):
+                current = totals.setdefault(key + (start,), [0, 0])
+                current[0] += int(used or 0)
+                current[1] += entries
+
+    for table, totals in ((TrafficRollupHourly.__table__, hourly), (TrafficRollupDaily.__table__, daily)):
+        _upsert(connection, table, [
+            {'agent_id': agent_id, 'user_id': user_id, 'bucket': start,
+             'used_traffic': used, 'entries': entries}
+            for (agent_id, user_id, start), (used, entries) in totals.items()
+        ])
+    _set_watermark(connection, upper, log.name)
+
+    remaining = connection.execute(
+        select(log.c.id).where(log.c.id > upper, log.c.timestamp <= cutoff).limit(1)
+    ).first() is not None
+
+    logger.debug(f"Rolled up {log.name} {watermark + 1}..{upper}: {logs} logs, "
+                 f"{len(hourly)} hourly / {len(daily)} daily rows")
+    return {'table': log.name, 'from_id': watermark + 1, 'to_id': upper, 'logs': logs,
+            'hourly_rows': len(hourly), 'daily_rows': len(daily), 'remaining': remaining}
+
+
+def rollup_traffic_logs(batch_size: int = DEFAULT_BATCH_SIZE, lag: timedelta = DEFAULT_LAG) -> dict:
+    """
+    Add the traffic_log rows above the watermark to the rollup tables
+
+    With monthly partition tables every table has a watermark of its own.
+    At most batch_size rows are rolled up per call; 'remaining' in the
+    result tells whether another call has work to do. Concurrent runs must
+    be prevented by the caller (the periodic task holds a TaskLock).
+
+    Returns:
+        dict: {'logs', 'hourly_rows', 'daily_rows', 'remaining', 'tables': [per table]}
+    """
+    summary = {'logs': 0, 'hourly_rows': 0, 'daily_rows': 0, 'remaining': False, 'tables': []}
+    cutoff = datetime.utcnow() - lag
+    with db.engine.begin() as connection:
+        for log in traffic_log_router.tables_for_range(connection):
+            if summary['logs'] >= batch_size:
+                summary['remaining'] = True
+                break
+            result = _rollup_table(connection, log, batch_size - summary['logs'], cutoff)
+            for key in ('logs', 'hourly_rows', 'daily_rows'):
+                summary[key] += result[key]
+            summary['remaining'] = summary['remaining'] or result['remaining']
+            if result['logs']:
+                summary['tables'].append(result)
+    return summary
+
+
+def rollup_all_traffic_logs(batch_size: int = DEFAULT_BATCH_SIZE, max_batches: int = 100,
+                            lag: timedelta = DEFAULT_LAG) -> dict:
+    """Run rollup_traffic_logs() until it catches up (or max_batches runs)"""
+    summary = {'batches': 0, 'logs': 0, 'remaining': False}
+    for _ in range(max_batches):
+        result = rollup_traffic_logs(batch_size=batch_size, lag=lag)
+        summary['batches'] += 1
+        summary['logs'] += result['logs']
+        summary['remaining'] = result['remaining']
+        if not result['remaining']:
+            break
+    return summary
+
+
+def _rollup_filter(table, agent_id: int = None, user_id: int = None):
+    """Rollup rows holding the totals of agent_id and/or user_id"""
+    if user_id:
+        conditions = [table.c.user_id == user_id]
+        if agent_id:
+            conditions.append(table.c.agent_id == agent_id)
+        return and_(*conditions)
+    return and_(table.c.agent_id == (agent_id or ROLLUP_ALL), table.c.user_id == ROLLUP_ALL)
+
+
+def _log_filter(log, agent_id: int = None, user_id: int = None):
+    conditions = []
+    if agent_id:
+        conditions.append(log.c.agent_id == agent_id)
+    if user_id:
+        conditions.append(log.c.user_id == user_id)
+    return conditions
+
+
+def _sum_rollup(connection, table, start, end, agent_id, user_id) -> int:
+    return connection.execute(
+        select(func.coalesce(func.sum(table.c.used_traffic), 0)).where(
+            _rollup_filter(table, agent_id, user_id),
+            table.c.bucket >= start,
+            table.c.bucket < end
+        )
+    ).scalar()
+
+
+def _sum_archive(ranges: list, agent_id: int = None, user_id: int = None) -> int:
+    """Bytes of archived rows in the given ranges (0 when archiving is not configured)"""
+    from flask import current_app
+    try:
+        if not current_app.config.get('TRAFFIC_LOG_ARCHIVE_DAYS'):
+            return 0
+    except RuntimeError:
+        # Outside of an app context
+        return 0
+
+    from .traffic_log_archive import get_traffic_log_archive
+    archive = get_traffic_log_archive()
+    return sum(archive.total(s, e, agent_id, user_id) for s, e in ranges if s < e)
+
+
+def get_traffic_total(agent_id: int = None, user_id: int = None,
+                      start: datetime = None, end: datetime = None) -> int:
+    """
+    Bytes logged in [start, end) for an agent, a user, both or everyone
+
+    Whole days come from traffic_rollup_daily, whole hours from
+    traffic_rollup_hourly; traffic_log (and the archive, for rows moved out
+    of it) is only read for the partial hours at both ends and for rows
+    above the watermark.
+    """
+    end = end or datetime.utcnow()
+    start = start or datetime(1970, 1, 1)
+    if start >= end:
+        return 0
+
+    with db.engine.connect() as connection:
+        total = 0
+
+        hour_start, hour_end = _ceil_hour(start), _floor_hour(end)
+        raw_ranges = []
+        if hour_start < hour_end:
+            day_start, day_end = _ceil_day(start), _floor_day(end)
+            if day_start < day_end:
+                total += _sum_rollup(connection, TrafficRollupDaily.__table__, day_start, day_end, agent_id, user_id)
+                hourly_ranges = [(hour_start, day_start), (day_end, hour_end)]
+            else:
+                hourly_ranges = [(hour_start, hour_end)]
+            for range_start, range_end in hourly_ranges:
+                if range_start < range_end:
+                    total += _sum_rollup(connection, TrafficRollupHourly.__table__,
+                                         range_start, range_end, agent_id, user_id)
+            raw_ranges = [(start, hour_start), (hour_end, end)]
+        else:
+            raw_ranges = [(start, end)]
+
+        # Partial hours (rolled-up ids only) plus everything not rolled up yet
+        for log in traffic_log_router.tables_for_range(connection, start, end):
+            watermark = _get_watermark(connection, log.name)
+            edges = [and_(log.c.timestamp >= s, log.c.timestamp < e) for s, e in raw_ranges if s < e]
+            raw = and_(log.c.id > watermark, log.c.timestamp >= start, log.c.timestamp < end)
+            if edges:
+                raw = or_(raw, and_(log.c.id <= watermark, or_(*edges)))
+            total += connection.execute(
+                select(func.coalesce(func.sum(log.c.used_traffic), 0)).where(raw, *_log_filter(log, agent_id, user_id))
+            ).scalar()
+
+    # Archived rows are rolled up, so only the partial hours can miss them
+    total += _sum_archive(raw_ranges, agent_id, user_id)
+
+    return int(total)
+
+
+def get_traffic_series(agent_id: int = None, user_id: int = None, start: datetime = None,
+                       end: datetime = None, resolution: str = None) -> list:
+    """
+    Traffic per hour or per day in [start, end)
+
+    Args:
+        resolution: 'hour' or 'day'; None picks hourly buckets for ranges up
+            to HOURLY_SERIES_MAX_RANGE and daily buckets beyond
+
+    Returns:
+        list: [{'bucket': datetime, 'used_traffic': int, 'entries': int}], oldest first
+    """
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=30)
+    if resolution is None:
+        resolution = 'hour' if end - start <= HOURLY_SERIES_MAX_RANGE else 'day'
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+
+    truncate = _floor_hour if resolution == 'hour' else _floor_day
+    table = (TrafficRollupHourly if resolution == 'hour' else TrafficRollupDaily).__table__
+    series = {}
+
+    with db.engine.connect() as connection:
+        rows = connection.execute(
+            select(table.c.bucket, func.sum(table.c.used_traffic), func.sum(table.c.entries)).where(
+                _rollup_filter(table, agent_id, user_id),
+                table.c.bucket >= truncate(start),
+                table.c.bucket < end
+            ).group_by(table.c.bucket)
+        ).all()
+        for bucket, used, entries in rows:
+            series[bucket] = [int(used or 0), int(entries or 0)]
+
+        # Rows above the watermark are not in the rollups yet
+        for log in traffic_log_router.tables_for_range(connection, truncate(start), end):
+            bucket = _hour_bucket(log.c.timestamp, connection.dialect.name)
+            pending = connection.execute(
+                select(bucket, func.sum(log.c.used_traffic), func.count()).where(
+                    log.c.id > _get_watermark(connection, log.name),
+                    log.c.timestamp >= truncate(start),
+                    log.c.timestamp < end,
+                    *_log_filter(log, agent_id, user_id)
+                ).group_by(bucket)
+            ).all()
+            for hour, used, entries in pending:
+                current = series.setdefault(truncate(_parse_bucket(hour)), [0, 0])
+                current[0] += int(used or 0)
+                current[1] += entries
+
+    return [
+        {'bucket': bucket, 'used_traffic': used, 'entries': entries}
+        for bucket, (used, entries) in sorted(series.items())
+    ]
+
+
+def init_traffic_rollups():
+    """Create the rollup tables if they do not exist"""
+    for model in (TrafficRollupHourly, TrafficRollupDaily, TrafficRollupWatermark):
+        model.__table__.create(db.engine, checkfirst=True)
@@ -5,7 +5,7 @@ Traffic Service for Agent/Reseller system
 from hiddifypanel.database import db
 from hiddifypanel.models import Agent, User, TrafficLog
 from hiddifypanel.models.user import ONE_GIG
-from sqlalchemy import event, func
+from sqlalchemy import event, func, select
 from sqlalchemy.orm import Session
 from datetime import datetime
 from loguru import logger
@@ -13,7 +13,10 @@ from loguru import logger
 
 def update_agent_traffic(agent_id: int, commit: bool = True):
     """
-    Update agent's traffic_used by calculating sum of all users' current_usage
+    Recompute agent's traffic_used (and traffic_allocated) from the users
+    
+    Both are maintained incrementally by the User listeners below; this
+    full recompute is only needed to correct drift.
     
     Args:
         agent_id: Agent ID
@@ -33,6 +36,7 @@ def update_agent_traffic(agent_id: int, commit: bool = True):
     
     old_traffic_used = agent.traffic_used
     agent.traffic_used = total_usage
+    agent.traffic_allocated = agent.get_allocated_traffic()
     agent.updated_at = datetime.utcnow()
     
     if commit:
@@ -41,7 +45,78 @@ def update_agent_traffic(agent_id: int, commit: bool = True):
     logger.debug(f"Updated agent {agent_id} traffic: {old_traffic_used / ONE_GIG:.2f} GB -> {total_usage / ONE_GIG:.2f} GB")
 
 
-def log_user_traffic(user_id: int, used_traffic: int, description: str = None, commit: bool = True):
+def reconcile_agents_traffic(commit: bool = True):
+    """
+    Recompute traffic_used, traffic_allocated, users_count and
+    active_users_count of every agent with a single correlated UPDATE
+    
+    Run periodically to fix any drift of the incremental counters.
+    
+    Args:
+        commit: Whether to commit the transaction
+    """
+    agents = Agent.__table__
+    users = User.__table__
+    
+    total_usage = select(
+        func.coalesce(func.sum(users.c.current_usage), 0)
+    ).where(
+        users.c.agent_id == agents.c.id
+    ).scalar_subquery()
+    
+    total_allocated = select(
+        func.coalesce(func.sum(users.c.usage_limit), 0)
+    ).where(
+        users.c.agent_id == agents.c.id
+    ).scalar_subquery()
+    
+    users_count = select(
+        func.count(users.c.id)
+    ).where(
+        users.c.agent_id == agents.c.id
+    ).scalar_subquery()
+    
+    active_users_count = select(
+        func.count(users.c.id)
+    ).where(
+        users.c.agent_id == agents.c.id,
+        users.c.enable == True
+    ).scalar_subquery()
+    
+    db.session.execute(
+        agents.update().values(
+            traffic_used=total_usage,
+            traffic_allocated=total_allocated,
+            users_count=users_count,
+            active_users_count=active_users_count,
+            updated_at=datetime.utcnow()
+        )
+    )
+    
+    if commit:
+        db.session.commit()
+    
+    logger.debug("Reconciled traffic and user counters of all agents")
+
+
+def _apply_agent_deltas(connection, agent_id: int, deltas: dict):
+    """Move agent's counter columns (traffic_used, traffic_allocated, users_count, ...) by deltas"""
+    deltas = {column: delta for column, delta in deltas.items() if delta}
+    if not agent_id or not deltas:
+        return
+    
+    agents = Agent.__table__
+    values = {column: agents.c[column] + delta for column, delta in deltas.items()}
+    if 'traffic_used' in deltas or 'traffic_allocated' in deltas:
+        values['updated_at'] = datetime.utcnow()
+    
+    connection.execute(
+        agents.update().where(agents.c.id == agent_id).values(**values)
+    )
+
+
+def log_user_traffic(user_id: int, used_traffic: int, description: str = None, commit: bool = True,
+                     buffered: bool = False, agent_id: int = None):
     """
     Log user traffic usage
     
@@ -50,7 +125,19 @@ def log_user_traffic(user_id: int, used_traffic: int, description: str = None, c
         used_traffic: Traffic used in bytes
         description: Optional description
         commit: Whether to commit the transaction
+        buffered: Queue the row in traffic_log_buffer instead of the session
+            (written in batches, nothing is returned)
+        agent_id: Owner agent, if known (saves the user lookup)
     """
+    if buffered:
+        from .traffic_log_buffer import traffic_log_buffer
+        traffic_log_buffer.add(
+            user_id, used_traffic,
+            agent_id=agent_id,
+            description=description or f"User {user_id} traffic usage"
+        )
+        return None
+    
     user = User.by_id(user_id)
     if not user:
         logger.warning(f"User {user_id} not found")
@@ -67,10 +154,6 @@ def log_user_traffic(user_id: int, used_traffic: int, description: str = None, c
         commit=False
     )
     
-    # Update agent traffic if user has an agent
-    if agent_id:
-        update_agent_traffic(agent_id, commit=False)
-    
     if commit:
         db.session.commit()
     
@@ -119,50 +202,128 @@ def check_agent_can_update_user_traffic(agent_id: int, user_id: int, new_traffic
     if not user:
         return False, "User not found"
     
-    old_traffic_limit = user.usage_limit or 0
-    
-    # Calculate new total
-    from sqlalchemy import func
-    total_excluding_user = db.session.query(
-        func.coalesce(func.sum(User.current_usage), 0)
-    ).filter(
-        User.agent_id == agent_id,
-        User.id != user_id
-    ).scalar() or 0
-    
+    # traffic_allocated already holds the sum of all users' usage_limit, so
+    # only the change of this user's limit has to fit
     new_traffic_limit_bytes = int(new_traffic_limit_GB * ONE_GIG)
-    new_total = total_excluding_user + new_traffic_limit_bytes
+    increase = new_traffic_limit_bytes - (user.usage_limit or 0)
+    if increase <= 0:
+        return True, None
+    
+    if agent.is_traffic_limit_exceeded:
+        return False, "Agent traffic limit exceeded"
     
-    if new_total > agent.traffic_limit:
-        remaining_GB = agent.traffic_remaining_GB or 0
-        return False, f"Updating user traffic limit would exceed agent traffic limit. Remaining: {remaining_GB:.2f} GB"
+    can_update, _ = agent.can_allocate(increase)
+    if not can_update:
+        return False, f"Updating user traffic limit would exceed agent traffic limit. Unallocated: {agent.traffic_unallocated_GB or 0:.2f} GB"
     
     return True, None
 
 
 # SQLAlchemy event listeners for automatic traffic updates
+#
+# The User listeners only accumulate net deltas per agent in session.info;
+# after_flush then issues one UPDATE per distinct agent, however many users
+# of that agent changed in the flush.
+
+_PENDING_DELTAS_KEY = 'agent_traffic_deltas'
+
+
+def _record_agent_deltas(target: User, agent_id: int, traffic_used: int = 0, traffic_allocated: int = 0,
+                         users_count: int = 0, active_users_count: int = 0):
+    """Remember counter deltas for agent_id until the end of the flush"""
+    if not agent_id or not (traffic_used or traffic_allocated or users_count or active_users_count):
+        return
+    
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is None:
+        return
+    
+    pending = session.info.setdefault(_PENDING_DELTAS_KEY, {})
+    deltas = pending.setdefault(agent_id, {'traffic_used': 0, 'traffic_allocated': 0, 'users_count': 0, 'active_users_count': 0})
+    deltas['traffic_used'] += traffic_used
+    deltas['traffic_allocated'] += traffic_allocated
+    deltas['users_count'] += users_count
+    deltas['active_users_count'] += active_users_count
+
 
 @event.listens_for(User, 'after_insert')
 def user_after_insert(mapper, connection, target: User):
-    """Update agent traffic when a new user is created"""
+    """Add a new user's usage, limit and counts to its agent"""
     if hasattr(target, 'agent_id') and target.agent_id:
-        update_agent_traffic(target.agent_id, commit=False)
+        _record_agent_deltas(
+            target, target.agent_id,
+            traffic_used=target.current_usage or 0,
+            traffic_allocated=target.usage_limit or 0,
+            users_count=1,
+            active_users_count=1 if target.enable else 0
+        )
 
 
 @event.listens_for(User, 'after_update')
 def user_after_update(mapper, connection, target: User):
-    """Update agent traffic when user's current_usage changes"""
-    if hasattr(target, 'agent_id') and target.agent_id:
-        # Check if current_usage changed
-        from sqlalchemy.orm import inspect
-        insp = inspect(target)
-        if 'current_usage' in insp.attrs and insp.attrs['current_usage'].history.has_changes():
-            update_agent_traffic(target.agent_id, commit=False)
+    """Move agent counters by the change of user's current_usage, usage_limit, enable or agent"""
+    if not hasattr(target, 'agent_id'):
+        return
+    
+    from sqlalchemy.orm import attributes
+    usage_history = attributes.get_history(target, 'current_usage')
+    limit_history = attributes.get_history(target, 'usage_limit')
+    enable_history = attributes.get_history(target, 'enable')
+    agent_history = attributes.get_history(target, 'agent_id')
+    if not (usage_history.has_changes() or limit_history.has_changes()
+            or enable_history.has_changes() or agent_history.has_changes()):
+        return
+    
+    new_usage = target.current_usage or 0
+    old_usage = (usage_history.deleted[0] if usage_history.deleted else target.current_usage) or 0
+    new_limit = target.usage_limit or 0
+    old_limit = (limit_history.deleted[0] if limit_history.deleted else target.usage_limit) or 0
+    new_active = 1 if target.enable else 0
+    old_active = 1 if (enable_history.deleted[0] if enable_history.deleted else target.enable) else 0
+    new_agent_id = target.agent_id
+    old_agent_id = agent_history.deleted[0] if agent_history.deleted else target.agent_id
+    
+    if old_agent_id == new_agent_id:
+        _record_agent_deltas(
+            target, new_agent_id,
+            traffic_used=new_usage - old_usage,
+            traffic_allocated=new_limit - old_limit,
+            active_users_count=new_active - old_active
+        )
+    else:
+        _record_agent_deltas(target, old_agent_id, traffic_used=-old_usage, traffic_allocated=-old_limit,
+                             users_count=-1, active_users_count=-old_active)
+        _record_agent_deltas(target, new_agent_id, traffic_used=new_usage, traffic_allocated=new_limit,
+                             users_count=1, active_users_count=new_active)
 
 
 @event.listens_for(User, 'after_delete')
 def user_after_delete(mapper, connection, target: User):
-    """Update agent traffic when a user is deleted"""
+    """Remove a deleted user's usage, limit and counts from its agent"""
     if hasattr(target, 'agent_id') and target.agent_id:
-        update_agent_traffic(target.agent_id, commit=False)
+        _record_agent_deltas(
+            target, target.agent_id,
+            traffic_used=-(target.current_usage or 0),
+            traffic_allocated=-(target.usage_limit or 0),
+            users_count=-1,
+            active_users_count=-1 if target.enable else 0
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def session_after_flush(session, flush_context):
+    """Apply the accumulated deltas, one UPDATE per distinct agent"""
+    pending = session.info.pop(_PENDING_DELTAS_KEY, None)
+    if not pending:
+        return
+    
+    connection = session.connection()
+    for agent_id, deltas in pending.items():
+        _apply_agent_deltas(connection, agent_id, deltas)
+
 
+@event.listens_for(Session, 'after_rollback')
+def session_after_rollback(session):
+    """Drop deltas of a flush that did not complete"""
+    session.info.pop(_PENDING_DELTAS_KEY, None)
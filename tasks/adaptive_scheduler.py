@@ -0,0 +1,218 @@
+"""
+Adaptive, headroom-prioritized scheduling of agent traffic limit checks
+زمان‌بندی تطبیقی بررسی محدودیت ترافیک ایجنت‌ها بر اساس زمان تخمینی اتمام ترافیک
+
+Instead of checking every agent on a fixed crontab, each limited agent gets
+its own next_check_at on its agent_traffic_ledger row. A cheap, frequent tick
+(check_due_agents) picks only the agents that are due, measures their recent
+consumption rate and schedules the next check at a fraction of the projected
+time to exhaustion: agents close to their limit are re-checked every few
+seconds, idle ones every MAX_CHECK_INTERVAL. That bound is no longer than
+the old fixed cadence, since the rate of an idle agent says nothing about a
+burst that starts right after its check. An agent that is already over
+its limit has its users disabled in the same tick and is then left alone for
+MAX_CHECK_INTERVAL (a change of its traffic_limit resets the schedule).
+"""
+from datetime import datetime, timedelta
+from loguru import logger
+
+# Bounds of the per-agent check interval, in seconds; MAX_CHECK_INTERVAL
+# matches the 5 minute crontab the adaptive checker replaces
+MIN_CHECK_INTERVAL = 5
+MAX_CHECK_INTERVAL = 5 * 60
+
+# Re-check after this fraction of the projected time to exhaustion
+HEADROOM_FRACTION = 0.5
+
+# Weight of the newest sample in the smoothed usage rate
+RATE_SMOOTHING = 0.3
+
+# Agents examined per tick at most (most overdue first)
+DUE_BATCH_SIZE = 500
+
+
+def smoothed_rate(old_rate: float, consumed: int, sampled_consumed, sampled_at, now: datetime) -> float:
+    """
+    Exponentially smoothed consumption rate in bytes per second
+
+    A drop of consumed (usage reset) counts as no consumption.
+    """
+    if sampled_consumed is None or sampled_at is None:
+        return old_rate or 0.0
+
+    elapsed = (now - sampled_at).total_seconds()
+    if elapsed <= 0:
+        return old_rate or 0.0
+
+    sample = max(0, consumed - sampled_consumed) / elapsed
+    if not old_rate:
+        return sample
+    return RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * old_rate
+
+
+def next_check_interval(consumed: int, traffic_limit: int, rate: float,
+                        min_interval: float = MIN_CHECK_INTERVAL,
+                        max_interval: float = MAX_CHECK_INTERVAL) -> float:
+    """
+    Seconds until an agent should be checked again
+
+    Args:
+        consumed: مصرف فعلی (بایت)
+        traffic_limit: حد مجاز (بایت)
+        rate: نرخ مصرف (بایت بر ثانیه)
+    """
+    headroom = traffic_limit - consumed
+    if headroom <= 0:
+        # Exhausted: the caller disables the users now, nothing to watch for
+        return max_interval
+    if rate <= 0:
+        return max_interval
+
+    time_to_exhaustion = headroom / rate
+    return min(max_interval, max(min_interval, time_to_exhaustion * HEADROOM_FRACTION))
+
+
+def _config(name: str, default):
+    """Read an AGENT_TRAFFIC_* setting from the app config, if any"""
+    from flask import current_app
+    try:
+        return type(default)(current_app.config.get(name, default))
+    except RuntimeError:
+        # Outside of an app context
+        return default
+
+
+def check_due_agents(now: datetime = None, batch_size: int = None) -> dict:
+    """
+    بررسی ایجنت‌هایی که زمان بررسی‌شان رسیده است
+
+    Reads the due agents' ledger rows (one indexed query), disables the users
+    of agents that reached their limit and stores the new rate and
+    next_check_at of all of them with one executemany UPDATE.
+
+    Returns:
+        dict: Statistics about the tick
+    """
+    from sqlalchemy import select, bindparam, or_
+    from hiddifypanel.database import db
+    from hiddifypanel.models.admin import AdminUser, AdminMode
+    from ..models.traffic_ledger import AgentTrafficLedger
+
+    now = now or datetime.utcnow()
+    batch_size = batch_size or _config('AGENT_TRAFFIC_ADAPTIVE_BATCH_SIZE', DUE_BATCH_SIZE)
+    min_interval = _config('AGENT_TRAFFIC_ADAPTIVE_MIN_INTERVAL', float(MIN_CHECK_INTERVAL))
+    max_interval = _config('AGENT_TRAFFIC_ADAPTIVE_MAX_INTERVAL', float(MAX_CHECK_INTERVAL))
+
+    ledger = AgentTrafficLedger.__table__
+    rows = db.session.execute(
+        select(
+            ledger.c.admin_id, ledger.c.consumed, ledger.c.usage_rate,
+            ledger.c.sampled_consumed, ledger.c.sampled_at, AdminUser.traffic_limit
+        ).join(
+            AdminUser, AdminUser.id == ledger.c.admin_id
+        ).where(
+            AdminUser.mode == AdminMode.agent,
+            AdminUser.traffic_limit.isnot(None),
+            or_(ledger.c.next_check_at.is_(None), ledger.c.next_check_at <= now)
+        ).order_by(
+            # Never-checked agents (NULL) first, then the most overdue
+            ledger.c.next_check_at.isnot(None), ledger.c.next_check_at
+        ).limit(batch_size)
+    ).all()
+
+    exceeded_ids = []
+    schedule = []
+    for admin_id, consumed, old_rate, sampled_consumed, sampled_at, traffic_limit in rows:
+        consumed = consumed or 0
+        rate = smoothed_rate(old_rate, consumed, sampled_consumed, sampled_at, now)
+        interval = next_check_interval(consumed, traffic_limit, rate, min_interval, max_interval)
+        if consumed >= traffic_limit:
+            exceeded_ids.append(admin_id)
+        schedule.append({
+            'b_admin_id': admin_id,
+            'b_usage_rate': rate,
+            'b_sampled_consumed': consumed,
+            'b_sampled_at': now,
+            'b_next_check_at': now + timedelta(seconds=interval),
+        })
+
+    if schedule:
+        db.session.execute(
+            ledger.update().where(
+                ledger.c.admin_id == bindparam('b_admin_id')
+            ).values(
+                usage_rate=bindparam('b_usage_rate'),
+                sampled_consumed=bindparam('b_sampled_consumed'),
+                sampled_at=bindparam('b_sampled_at'),
+                next_check_at=bindparam('b_next_check_at')
+            ),
+            schedule
+        )
+        db.session.commit()
+
+    disabled_users_count = 0
+    if exceeded_ids:
+        from hiddifypanel.models.user import User
+
+        for agent in AdminUser.query.filter(AdminUser.id.in_(exceeded_ids)).all():
+            # Users disabled by an earlier tick; nothing left to do
+            if not db.session.query(agent.hierarchy_users_query().filter(User.enable == True).exists()).scalar():
+                continue
+            logger.warning(
+                f"Agent {agent.name} (ID: {agent.id}) has exceeded traffic limit. "
+                f"Limit: {agent.traffic_limit_GB} GB"
+            )
+            disabled_users_count += agent.disable_all_users()
+
+    result = {
+        'timestamp': now.isoformat(),
+        'checked_agents': len(schedule),
+        'exceeded_agents': len(exceeded_ids),
+        'disabled_users_count': disabled_users_count,
+        'next_intervals': {
+            'min': min((row['b_next_check_at'] - now).total_seconds() for row in schedule) if schedule else None,
+            'max': max((row['b_next_check_at'] - now).total_seconds() for row in schedule) if schedule else None,
+        }
+    }
+    if schedule:
+        logger.debug(f"Adaptive agent traffic check: {result}")
+    return result
+
+
+def get_check_schedule(limit: int = 50) -> list:
+    """
+    Agents ordered by their next check, with the projected time to exhaustion
+
+    Returns:
+        list of dicts (soonest first)
+    """
+    from sqlalchemy import select
+    from hiddifypanel.database import db
+    from hiddifypanel.models.admin import AdminUser, AdminMode
+    from ..models.traffic_ledger import AgentTrafficLedger
+
+    ledger = AgentTrafficLedger.__table__
+    rows = db.session.execute(
+        select(
+            ledger.c.admin_id, ledger.c.consumed, ledger.c.usage_rate,
+            ledger.c.next_check_at, AdminUser.traffic_limit
+        ).join(
+            AdminUser, AdminUser.id == ledger.c.admin_id
+        ).where(
+            AdminUser.mode == AdminMode.agent,
+            AdminUser.traffic_limit.isnot(None)
+        ).order_by(
+            ledger.c.next_check_at.isnot(None), ledger.c.next_check_at
+        ).limit(limit)
+    ).all()
+
+    schedule = []
+    for admin_id, consumed, rate, next_check_at, traffic_limit in rows:
+        headroom = max(0, traffic_limit - (consumed or 0))
+        schedule.append({
+            'agent_id': admin_id,
+            'usage_rate_bps': rate or 0,
+            'seconds_to_exhaustion': headroom / rate if rate else None,
+            'next_check_at': next_check_at.isoformat() if next_check_at else None,
+        })
+    return schedule
@@ -0,0 +1,185 @@
+"""
+In-process scheduler used when Celery is not available
+زمان‌بند داخلی برای نصب‌های تک‌سروره بدون Celery
+
+A single daemon thread wakes up for the next due job and hands it to a small
+bounded thread pool; a job whose previous run is still going is not queued
+again. Every run gets a random jitter, runs inside an app context and goes
+through the same cross-process locks as the Celery tasks, so several web
+workers each running this scheduler still check at most once at a time.
+
+The scheduler starts with the first request a server process handles, not
+when the app is set up: one-shot processes that also run init_app (such as
+hiddify-panel-cli) would otherwise start it and wait for its jobs at exit,
+and a preloading gunicorn master would lose the thread at fork.
+"""
+import atexit
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+# Fraction of the interval added or removed at random from every run
+DEFAULT_JITTER = 0.1
+
+# Jobs running at the same time at most
+DEFAULT_MAX_WORKERS = 2
+
+
+class _Job:
+    def __init__(self, name: str, interval: float, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = 0.0
+        self.future = None
+
+
+class FallbackScheduler:
+    """
+    زمان‌بند پس‌زمینه با jitter، executor محدود و توقف امن
+    """
+
+    def __init__(self, app, jitter: float = DEFAULT_JITTER, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.app = app
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self._jobs = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self.pid = None
+
+    def add_job(self, name: str, interval: float, func):
+        """Run func every interval seconds (the first run after one interval)"""
+        job = _Job(name, interval, func)
+        job.next_run = time.monotonic() + self._jittered(interval)
+        self._jobs.append(job)
+
+    def _jittered(self, interval: float) -> float:
+        return max(0.0, interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def start(self):
+        """Start the scheduler thread"""
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='agent-traffic-job')
+        self._thread = threading.Thread(target=self._loop, name='agent-traffic-scheduler', daemon=True)
+        self._thread.start()
+        self.pid = os.getpid()
+        atexit.register(self.shutdown)
+        logger.info(f"Fallback agent traffic scheduler started with jobs: {[job.name for job in self._jobs]}")
+
+    def shutdown(self, wait: bool = True):
+        """Stop scheduling and wait for running jobs to finish"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        logger.info("Fallback agent traffic scheduler stopped")
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and not self._stop.is_set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for job in self._jobs:
+                if job.next_run > now:
+                    continue
+                job.next_run = now + self._jittered(job.interval)
+                if job.future is not None and not job.future.done():
+                    logger.debug(f"{job.name} is still running, skipping this run")
+                    continue
+                job.future = self._executor.submit(self._run, job)
+
+            wait = min(job.next_run for job in self._jobs) - time.monotonic() if self._jobs else 60
+            self._stop.wait(max(0.1, wait))
+
+    def _run(self, job: _Job):
+        from hiddifypanel.database import db
+
+        with self.app.app_context():
+            try:
+                return job.func()
+            except Exception as e:
+                logger.error(f"Error running {job.name}: {e}")
+            finally:
+                # Sessions are scoped per thread; don't keep one per pool thread
+                db.session.remove()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_fallback_scheduler(app, full_check_seconds: float, tick_seconds: float = None,
+                             rollup_seconds: float = None, partitions_seconds: float = None,
+                             archive_seconds: float = None) -> FallbackScheduler:
+    """
+    Start the in-process scheduler for the agent traffic checks
+
+    Args:
+        full_check_seconds: interval of check_agent_traffic_limits
+        tick_seconds: interval of the adaptive checker tick (None = disabled)
+        rollup_seconds: interval of the TrafficLog rollup (None = disabled)
+        partitions_seconds: interval of the traffic_log partition maintenance (None = disabled)
+        archive_seconds: interval of the traffic_log archival (None = disabled)
+    """
+    global _scheduler
+    from .periodic_checker import (
+        archive_traffic_logs_exclusive, check_agent_traffic_limits, check_due_agents_exclusive,
+        maintain_log_partitions_exclusive, rollup_traffic_logs_exclusive
+    )
+
+    with _scheduler_lock:
+        # A forked worker inherits the object but not the thread
+        if _scheduler is not None and _scheduler.pid == os.getpid():
+            return _scheduler
+
+        scheduler = FallbackScheduler(
+            app,
+            jitter=float(app.config.get('AGENT_TRAFFIC_SCHEDULER_JITTER', DEFAULT_JITTER)),
+            max_workers=int(app.config.get('AGENT_TRAFFIC_SCHEDULER_WORKERS', DEFAULT_MAX_WORKERS))
+        )
+        scheduler.add_job('agent_traffic.check_limits', full_check_seconds, check_agent_traffic_limits)
+        if tick_seconds:
+            scheduler.add_job('agent_traffic.check_due', tick_seconds, check_due_agents_exclusive)
+        if rollup_seconds:
+            scheduler.add_job('agent_traffic.rollup_logs', rollup_seconds, rollup_traffic_logs_exclusive)
+        if partitions_seconds:
+            scheduler.add_job('agent_traffic.maintain_log_partitions', partitions_seconds,
+                              maintain_log_partitions_exclusive)
+        if archive_seconds:
+            scheduler.add_job('agent_traffic.archive_logs', archive_seconds, archive_traffic_logs_exclusive)
+        scheduler.start()
+
+        _scheduler = scheduler
+        return scheduler
+
+
+def start_fallback_scheduler_per_worker(app, *args, **kwargs):
+    """
+    Start the scheduler with the first request of every server process
+
+    Takes the arguments of start_fallback_scheduler(). Processes that serve
+    no requests (CLI commands, a preloading master) never start it.
+    """
+    @app.before_request
+    def _start_fallback_scheduler():
+        if _scheduler is None or _scheduler.pid != os.getpid():
+            start_fallback_scheduler(app, *args, **kwargs)
+
+
+def stop_fallback_scheduler():
+    """Stop the in-process scheduler, if it was started"""
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.shutdown()
+        _scheduler = None
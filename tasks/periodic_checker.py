@@ -1,12 +1,45 @@
 """
 Background task for periodic checking of agent traffic limits
 """
+import time
+from contextlib import ExitStack, contextmanager
 from flask import Flask
 from loguru import logger
 from datetime import datetime
 from hiddifypanel.models.admin import AdminUser, AdminMode
 from ..utils.traffic_checker import AgentTrafficChecker
 
+# Cadence of the full check (reconcile + every agent), in minutes; with the
+# adaptive checker enabled the full check only corrects drift, since every
+# limited agent is re-checked at least every MAX_CHECK_INTERVAL anyway
+FULL_CHECK_MINUTES = 5
+ADAPTIVE_FULL_CHECK_MINUTES = 60
+
+# Least time between two full ledger reconciles, in minutes; the full check
+# runs more often but only reconciles when this much time has passed
+LEDGER_RECONCILE_MINUTES = 60
+
+# Tick of the adaptive checker, in seconds
+ADAPTIVE_TICK_SECONDS = 5
+
+# Names of the cross-process locks (see utils/task_lock.py)
+CHECK_LIMITS_LOCK = 'agent_traffic.check_limits'
+CHECK_DUE_LOCK = 'agent_traffic.check_due'
+ROLLUP_LOCK = 'agent_traffic.rollup_logs'
+PARTITIONS_LOCK = 'agent_traffic.maintain_log_partitions'
+ARCHIVE_LOCK = 'agent_traffic.archive_logs'
+
+# Cadence of the TrafficLog rollup, in minutes (0 = disabled)
+ROLLUP_MINUTES = 10
+
+# Cadence of the traffic_log partition maintenance (new months, retention)
+# and of the archival of old rows
+PARTITION_MAINTENANCE_HOURS = 24
+ARCHIVE_HOURS = 24
+
+# Celery tasks used to fan the full check out, filled by setup_periodic_checker
+_shard_tasks = {}
+
 
 def setup_periodic_checker(app: Flask):
     """
@@ -15,7 +48,37 @@ def setup_periodic_checker(app: Flask):
     This function sets up a Celery task that runs periodically
     to check if any agents have exceeded their traffic limits
     and disable their users if necessary.
+    
+    With AGENT_TRAFFIC_ADAPTIVE_SCHEDULING (default on), a second task ticks
+    every AGENT_TRAFFIC_ADAPTIVE_TICK seconds and checks only the agents
+    that are due (see adaptive_scheduler.py), and the full check runs every
+    AGENT_TRAFFIC_FULL_CHECK_MINUTES (default 60) to correct drift.
+    
+    With AGENT_TRAFFIC_CHECK_SHARDS > 1 the full check is split into that
+    many agent_traffic.check_shard tasks (agents by id % shards), whose
+    results a chord merges into the usual summary dict.
+    
+    Without Celery, the same checks run on an in-process scheduler
+    (fallback_scheduler.py) unless AGENT_TRAFFIC_FALLBACK_SCHEDULER is off;
+    each server process starts it with its first request.
+    
+    When the Agent model is installed, traffic_log is also rolled up into
+    the hourly/daily tables every TRAFFIC_ROLLUP_MINUTES (default 10), and
+    with TRAFFIC_LOG_PARTITIONING its monthly partitions are created ahead
+    and dropped after TRAFFIC_LOG_RETENTION_DAYS once a day. With
+    TRAFFIC_LOG_ARCHIVE_DAYS, older rows are moved to the columnar archive
+    once a day as well.
     """
+    adaptive = bool(app.config.get('AGENT_TRAFFIC_ADAPTIVE_SCHEDULING', True))
+    full_check_minutes = int(app.config.get(
+        'AGENT_TRAFFIC_FULL_CHECK_MINUTES',
+        ADAPTIVE_FULL_CHECK_MINUTES if adaptive else FULL_CHECK_MINUTES
+    ))
+    tick_seconds = float(app.config.get('AGENT_TRAFFIC_ADAPTIVE_TICK', ADAPTIVE_TICK_SECONDS))
+    rollup_minutes = int(app.config.get('TRAFFIC_ROLLUP_MINUTES', ROLLUP_MINUTES))
+    partitioned = app.config.get('TRAFFIC_LOG_PARTITIONING', 'none') != 'none'
+    archived = bool(app.config.get('TRAFFIC_LOG_ARCHIVE_DAYS'))
+    
     try:
         # Try to get celery_app from various sources
         celery_app = None
@@ -39,16 +102,86 @@ def setup_periodic_checker(app: Flask):
             with app.app_context():
                 return check_agent_traffic_limits()
         
-        # Schedule periodic task (every 5 minutes)
+        @celery_app.task(name='agent_traffic.check_shard')
+        def check_agent_shard_task(shard, shards):
+            """Celery task checking one shard of the agents"""
+            with app.app_context():
+                return run_exclusive(f"{CHECK_LIMITS_LOCK}.{shard}", check_agent_shard, shard, shards)
+        
+        @celery_app.task(name='agent_traffic.merge_shards')
+        def merge_shard_results_task(results, summary):
+            """Chord callback building the summary of a sharded check"""
+            result = merge_shard_results(summary, results)
+            logger.info(f"Sharded agent traffic check completed: {result}")
+            return result
+        
+        _shard_tasks.update({
+            'shards': int(app.config.get('AGENT_TRAFFIC_CHECK_SHARDS', 1)),
+            'check_shard': check_agent_shard_task,
+            'merge': merge_shard_results_task,
+        })
+        
+        @celery_app.task(name='agent_traffic.check_due', ignore_result=True)
+        def check_due_agents_task():
+            """Celery task for the adaptive checker tick"""
+            with app.app_context():
+                return check_due_agents_exclusive()
+        
+        @celery_app.task(name='agent_traffic.rollup_logs', ignore_result=True)
+        def rollup_traffic_logs_task():
+            """Celery task rolling traffic_log up into the hourly/daily tables"""
+            with app.app_context():
+                return rollup_traffic_logs_exclusive()
+        
+        @celery_app.task(name='agent_traffic.maintain_log_partitions')
+        def maintain_log_partitions_task():
+            """Celery task creating and dropping the monthly traffic_log partitions"""
+            with app.app_context():
+                return maintain_log_partitions_exclusive()
+        
+        @celery_app.task(name='agent_traffic.archive_logs')
+        def archive_traffic_logs_task():
+            """Celery task moving old traffic_log rows to the columnar archive"""
+            with app.app_context():
+                return archive_traffic_logs_exclusive()
+        
         from celery.schedules import crontab
+        if full_check_minutes < 60:
+            full_check_schedule = crontab(minute=f'*/{full_check_minutes}')
+        else:
+            full_check_schedule = crontab(minute=0, hour=f'*/{full_check_minutes // 60}')
         
         # Use add_periodic_task if available (preferred method)
         if hasattr(celery_app, 'add_periodic_task'):
             celery_app.add_periodic_task(
-                crontab(minute='*/5'),
+                full_check_schedule,
                 check_agent_traffic_limits_task.s(),
                 name='check-agent-traffic-limits'
             )
+            if adaptive:
+                celery_app.add_periodic_task(
+                    tick_seconds,
+                    check_due_agents_task.s(),
+                    name='check-due-agent-traffic-limits'
+                )
+            if rollup_minutes:
+                celery_app.add_periodic_task(
+                    rollup_minutes * 60,
+                    rollup_traffic_logs_task.s(),
+                    name='rollup-traffic-logs'
+                )
+            if partitioned:
+                celery_app.add_periodic_task(
+                    PARTITION_MAINTENANCE_HOURS * 3600,
+                    maintain_log_partitions_task.s(),
+                    name='maintain-traffic-log-partitions'
+                )
+            if archived:
+                celery_app.add_periodic_task(
+                    ARCHIVE_HOURS * 3600,
+                    archive_traffic_logs_task.s(),
+                    name='archive-traffic-logs'
+                )
         else:
             # Fallback to beat_schedule
             if not hasattr(celery_app.conf, 'beat_schedule'):
@@ -56,64 +189,330 @@ def setup_periodic_checker(app: Flask):
             celery_app.conf.beat_schedule.update({
                 'check-agent-traffic-limits': {
                     'task': 'agent_traffic.check_limits',
-                    'schedule': crontab(minute='*/5'),  # Every 5 minutes
+                    'schedule': full_check_schedule,
                 },
             })
+            if adaptive:
+                celery_app.conf.beat_schedule.update({
+                    'check-due-agent-traffic-limits': {
+                        'task': 'agent_traffic.check_due',
+                        'schedule': tick_seconds,
+                    },
+                })
+            if rollup_minutes:
+                celery_app.conf.beat_schedule.update({
+                    'rollup-traffic-logs': {
+                        'task': 'agent_traffic.rollup_logs',
+                        'schedule': rollup_minutes * 60,
+                    },
+                })
+            if partitioned:
+                celery_app.conf.beat_schedule.update({
+                    'maintain-traffic-log-partitions': {
+                        'task': 'agent_traffic.maintain_log_partitions',
+                        'schedule': PARTITION_MAINTENANCE_HOURS * 3600,
+                    },
+                })
+            if archived:
+                celery_app.conf.beat_schedule.update({
+                    'archive-traffic-logs': {
+                        'task': 'agent_traffic.archive_logs',
+                        'schedule': ARCHIVE_HOURS * 3600,
+                    },
+                })
         
         logger.success("Periodic agent traffic checker setup completed")
         
     except ImportError as e:
-        logger.warning(f"Celery not available, periodic checker will not run: {e}")
+        if not app.config.get('AGENT_TRAFFIC_FALLBACK_SCHEDULER', True):
+            logger.warning(f"Celery not available, periodic checker will not run: {e}")
+            return
+        
+        from .fallback_scheduler import start_fallback_scheduler_per_worker
+        logger.warning(f"Celery not available ({e}), using the in-process scheduler")
+        start_fallback_scheduler_per_worker(app, full_check_minutes * 60, tick_seconds if adaptive else None,
+                                            rollup_minutes * 60 or None,
+                                            PARTITION_MAINTENANCE_HOURS * 3600 if partitioned else None,
+                                            ARCHIVE_HOURS * 3600 if archived else None)
     except Exception as e:
         logger.error(f"Error setting up periodic checker: {e}")
 
 
+def _reconcile_agent_model_traffic():
+    """
+    Reconcile Agent.traffic_used when the Agent model is installed in the panel
+    
+    This is the only place the agent stats are written back; the agent
+    traffic API only reads them.
+    """
+    try:
+        from hiddifypanel.services.traffic_service import reconcile_agents_traffic
+    except ImportError:
+        return
+    reconcile_agents_traffic()
+
+
+def _rollup_traffic_logs() -> dict:
+    """Roll traffic_log up when the Agent model and its rollup tables are installed"""
+    try:
+        from hiddifypanel.services.traffic_rollup import rollup_all_traffic_logs
+    except ImportError:
+        return {'skipped': True, 'reason': 'traffic rollups not installed'}
+    return rollup_all_traffic_logs()
+
+
+def rollup_traffic_logs_exclusive() -> dict:
+    """TrafficLog rollup, guarded by its own lock (the watermark must not move twice)"""
+    return run_exclusive(ROLLUP_LOCK, _rollup_traffic_logs)
+
+
+def _maintain_log_partitions() -> dict:
+    """Create/drop the traffic_log partitions when the Agent model is installed"""
+    try:
+        from hiddifypanel.services.traffic_log_partitions import maintain_traffic_log_partitions
+    except ImportError:
+        return {'skipped': True, 'reason': 'traffic_log partitions not installed'}
+    return maintain_traffic_log_partitions()
+
+
+def maintain_log_partitions_exclusive() -> dict:
+    """traffic_log partition maintenance, guarded by its own lock"""
+    return run_exclusive(PARTITIONS_LOCK, _maintain_log_partitions)
+
+
+def _archive_traffic_logs() -> dict:
+    """Archive old traffic_log rows when the Agent model and the archive are installed"""
+    try:
+        from hiddifypanel.services.traffic_log_archive import archive_traffic_logs
+    except ImportError:
+        return {'skipped': True, 'reason': 'traffic log archive not installed'}
+    return archive_traffic_logs()
+
+
+def archive_traffic_logs_exclusive() -> dict:
+    """traffic_log archival, guarded by its own lock"""
+    return run_exclusive(ARCHIVE_LOCK, _archive_traffic_logs)
+
+
+def run_exclusive(lock_name: str, func, *args, **kwargs) -> dict:
+    """
+    Run func unless another worker/process holds lock_name
+    
+    Overlapping runs are skipped: the run in progress already covers them.
+    The returned run record gets started_at and duration_seconds (or
+    skipped=True when the lock was busy).
+    """
+    from ..utils.task_lock import TaskLock
+    
+    started_at = datetime.now()
+    started = time.monotonic()
+    try:
+        with TaskLock(lock_name) as lock:
+            if not lock.acquired:
+                logger.info(f"{lock_name} is already running, skipping this run")
+                return {
+                    'skipped': True,
+                    'reason': 'already running',
+                    'timestamp': started_at.isoformat()
+                }
+            result = func(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"Error running {lock_name}: {e}")
+        result = {'error': str(e), 'timestamp': started_at.isoformat()}
+    
+    result['started_at'] = started_at.isoformat()
+    result['duration_seconds'] = round(time.monotonic() - started, 3)
+    logger.info(f"{lock_name} finished in {result['duration_seconds']}s")
+    return result
+
+
+def check_due_agents_exclusive() -> dict:
+    """Adaptive checker tick, guarded by its own lock"""
+    from .adaptive_scheduler import check_due_agents
+    return run_exclusive(CHECK_DUE_LOCK, check_due_agents)
+
+
 def check_agent_traffic_limits():
     """
     Check all agents for traffic limit violations and disable users if needed
     
+    Only one run at a time across workers and processes (see run_exclusive).
+    
     Returns:
         dict: Statistics about the check
     """
+    return run_exclusive(CHECK_LIMITS_LOCK, _check_agent_traffic_limits)
+
+
+def _disable_exceeded_agents(exceeded_ids: list) -> int:
+    """Disable the users of the given agents, returning how many were disabled"""
+    if not exceeded_ids:
+        return 0
+    
+    disabled_users_count = 0
+    for agent in AdminUser.query.filter(AdminUser.id.in_(exceeded_ids)).all():
+        logger.warning(
+            f"Agent {agent.name} (ID: {agent.id}) has exceeded traffic limit. "
+            f"Limit: {agent.traffic_limit_GB} GB"
+        )
+        
+        # Disable all users
+        disabled_count = agent.disable_all_users()
+        disabled_users_count += disabled_count
+        
+        logger.info(
+            f"Disabled {disabled_count} users for agent {agent.name} "
+            f"due to traffic limit exceeded"
+        )
+    return disabled_users_count
+
+
+def check_agent_shard(shard: int, shards: int) -> dict:
+    """
+    Enforce the limits of the agents with id % shards == shard
+    
+    Expects the ledger to be reconciled by the caller.
+    """
+    from ..utils.traffic_calculator import AgentTrafficCalculator
+    
+    exceeded_ids = AgentTrafficCalculator.get_exceeded_agent_ids(shard, shards)
+    return {
+        'shard': shard,
+        'exceeded_agents': len(exceeded_ids),
+        'disabled_users_count': _disable_exceeded_agents(exceeded_ids)
+    }
+
+
+def merge_shard_results(summary: dict, results: list) -> dict:
+    """Add up the shard results into the summary of the full check"""
+    merged = dict(summary)
+    merged['shards'] = len(results)
+    merged['exceeded_agents'] = sum(result.get('exceeded_agents', 0) for result in results)
+    merged['disabled_users_count'] = sum(result.get('disabled_users_count', 0) for result in results)
+    
+    skipped = [result.get('shard') for result in results if result.get('skipped')]
+    errors = [result['error'] for result in results if result.get('error')]
+    if skipped:
+        merged['skipped_shards'] = len(skipped)
+    if errors:
+        merged['errors'] = errors
+    return merged
+
+
+def _dispatch_shards(summary: dict, shards: int) -> dict:
+    """
+    Run the shard tasks as a chord
+    
+    In eager mode (task_always_eager) the chord runs inline and the merged
+    summary is returned; otherwise the summary only records the dispatch and
+    the merged one is the chord callback's result.
+    """
+    from celery import chord
+    from celery.result import EagerResult
+    
+    header = [_shard_tasks['check_shard'].s(shard, shards) for shard in range(shards)]
+    async_result = chord(header)(_shard_tasks['merge'].s(summary))
+    
+    if isinstance(async_result, EagerResult):
+        return async_result.get()
+    
+    return {**summary, 'shards': shards, 'dispatched': True, 'result_id': async_result.id}
+
+
+@contextmanager
+def _shard_locks(shards: int):
+    """
+    Hold the lock of every shard, yielding False if one of them is busy
+    
+    The coordinator's TaskLock belongs to its own process and ends with the
+    dispatch, while the shards of the previous chord may still be running;
+    their locks tell whether that check is finished. All shard locks share
+    one dedicated connection, so the number of shards is not bounded by the
+    connection pool.
+    """
+    from hiddifypanel.database import db
+    from ..utils.task_lock import TaskLock
+    
     try:
-        agents = AdminUser.query.filter(
-            AdminUser.mode == AdminMode.agent
-        ).all()
-        
-        total_agents = len(agents)
-        checked_agents = 0
-        exceeded_agents = 0
-        disabled_users_count = 0
-        
-        for agent in agents:
-            if agent.traffic_limit_GB is None:
-                continue  # Skip agents without traffic limit
-            
-            checked_agents += 1
-            
-            if agent.is_traffic_limit_exceeded():
-                exceeded_agents += 1
-                logger.warning(
-                    f"Agent {agent.name} (ID: {agent.id}) has exceeded traffic limit. "
-                    f"Total: {agent.get_total_traffic_GB():.2f} GB / Limit: {agent.traffic_limit_GB} GB"
-                )
-                
-                # Disable all users
-                disabled_count = agent.disable_all_users()
-                disabled_users_count += disabled_count
-                
-                logger.info(
-                    f"Disabled {disabled_count} users for agent {agent.name} "
-                    f"due to traffic limit exceeded"
-                )
+        dialect = db.engine.dialect.name
+    except Exception as e:
+        # No database engine: TaskLock falls back to file locks as well
+        logger.debug(f"No database engine for the shard locks: {e}")
+        dialect = None
+
+    with ExitStack() as stack:
+        connection = None
+        if dialect in ('mysql', 'mariadb', 'postgresql'):
+            connection = stack.enter_context(db.engine.connect())
+        for shard in range(shards):
+            lock = stack.enter_context(TaskLock(f"{CHECK_LIMITS_LOCK}.{shard}", connection=connection))
+            if not lock.acquired:
+                yield False
+                return
+        yield True
+
+
+def _ledger_reconcile_due() -> bool:
+    """True when the ledger was last reconciled LEDGER_RECONCILE_MINUTES ago or more"""
+    from datetime import timedelta
+    from flask import current_app
+    from sqlalchemy import func
+    from hiddifypanel.database import db
+    from ..models.traffic_ledger import AgentTrafficLedger
+    
+    minutes = int(current_app.config.get('AGENT_TRAFFIC_LEDGER_RECONCILE_MINUTES', LEDGER_RECONCILE_MINUTES))
+    reconciled_at = db.session.query(func.min(AgentTrafficLedger.reconciled_at)).scalar()
+    return reconciled_at is None or datetime.utcnow() - reconciled_at >= timedelta(minutes=minutes)
+
+
+def _summarize_agents() -> dict:
+    """Reconcile the counters (when due) and start the summary of a full check"""
+    from sqlalchemy import func
+    from hiddifypanel.database import db
+    from ..models.traffic_ledger import reconcile_traffic_ledger
+    
+    # Correct any drift of the running per-agent counters
+    if _ledger_reconcile_due():
+        reconcile_traffic_ledger()
+    _reconcile_agent_model_traffic()
+    
+    # Agent counts in one query; exceeded agents are read per shard
+    total_agents, checked_agents = db.session.query(
+        func.count(AdminUser.id),
+        func.count(AdminUser.traffic_limit)
+    ).filter(
+        AdminUser.mode == AdminMode.agent
+    ).one()
+    
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'total_agents': total_agents,
+        'checked_agents': checked_agents,
+        'exceeded_agents': 0,
+        'disabled_users_count': 0
+    }
+
+
+def _check_agent_traffic_limits():
+    """Check all agents for traffic limit violations and disable users if needed"""
+    try:
+        shards = _shard_tasks.get('shards', 1)
+        if shards > 1 and 'check_shard' in _shard_tasks:
+            # Not while the shards of the previous check are still running
+            with _shard_locks(shards) as idle:
+                if not idle:
+                    logger.info("Shards of the previous agent traffic check are still running, skipping this run")
+                    return {
+                        'skipped': True,
+                        'reason': 'previous shards still running',
+                        'timestamp': datetime.now().isoformat()
+                    }
+                summary = _summarize_agents()
+            return _dispatch_shards(summary, shards)
         
-        result = {
-            'timestamp': datetime.now().isoformat(),
-            'total_agents': total_agents,
-            'checked_agents': checked_agents,
-            'exceeded_agents': exceeded_agents,
-            'disabled_users_count': disabled_users_count
-        }
+        summary = _summarize_agents()
+        result = merge_shard_results(summary, [check_agent_shard(0, 1)])
+        result.pop('shards')
         
         logger.info(f"Agent traffic check completed: {result}")
         return result
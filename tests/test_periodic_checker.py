@@ -0,0 +1,105 @@
+"""
+Tests of the sharded full check in tasks/periodic_checker.py
+
+They need Celery, HiddifyPanel and this package installed (pip install -e .).
+The shards run as a chord of an eager Celery app (task_always_eager), so no
+broker is needed; the database work of each shard is replaced by a fixed
+list of exceeded agents, and the shard locks are file locks in tmp_path.
+"""
+import pytest
+
+celery = pytest.importorskip('celery')
+periodic_checker = pytest.importorskip('hiddify_agent_traffic_manager.tasks.periodic_checker')
+from flask import Flask  # noqa: E402
+from hiddify_agent_traffic_manager.utils.task_lock import TaskLock  # noqa: E402
+from hiddify_agent_traffic_manager.utils.traffic_calculator import AgentTrafficCalculator  # noqa: E402
+
+EXCEEDED_IDS = [2, 3, 5, 7, 11, 12, 20]
+USERS_PER_AGENT = 4
+SHARDS = 3
+
+
+def _exceeded_agent_ids(shard=None, shards=None):
+    if shards is None:
+        return list(EXCEEDED_IDS)
+    return [agent_id for agent_id in EXCEEDED_IDS if agent_id % shards == shard]
+
+
+def _summary():
+    return {
+        'timestamp': '2026-01-01T00:00:00',
+        'total_agents': 25,
+        'checked_agents': 20,
+        'exceeded_agents': 0,
+        'disabled_users_count': 0
+    }
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['AGENT_TRAFFIC_LOCK_DIR'] = str(tmp_path)
+    app.config['AGENT_TRAFFIC_CHECK_SHARDS'] = SHARDS
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def eager_shards(app, monkeypatch):
+    """Shard tasks registered as in setup_periodic_checker(), on an eager Celery app"""
+    celery_app = celery.Celery('test_periodic_checker', set_as_current=False)
+    celery_app.conf.task_always_eager = True
+    celery_app.conf.task_eager_propagates = True
+
+    @celery_app.task(name='agent_traffic.check_shard')
+    def check_agent_shard_task(shard, shards):
+        with app.app_context():
+            return periodic_checker.run_exclusive(
+                f"{periodic_checker.CHECK_LIMITS_LOCK}.{shard}", periodic_checker.check_agent_shard, shard, shards
+            )
+
+    @celery_app.task(name='agent_traffic.merge_shards')
+    def merge_shard_results_task(results, summary):
+        return periodic_checker.merge_shard_results(summary, results)
+
+    monkeypatch.setattr(AgentTrafficCalculator, 'get_exceeded_agent_ids', staticmethod(_exceeded_agent_ids))
+    monkeypatch.setattr(periodic_checker, '_disable_exceeded_agents', lambda ids: len(ids) * USERS_PER_AGENT)
+    monkeypatch.setattr(periodic_checker, '_summarize_agents', _summary)
+    monkeypatch.setattr(periodic_checker, '_shard_tasks', {
+        'shards': int(app.config['AGENT_TRAFFIC_CHECK_SHARDS']),
+        'check_shard': check_agent_shard_task,
+        'merge': merge_shard_results_task,
+    })
+    return periodic_checker._shard_tasks
+
+
+def _single_shard_result(monkeypatch):
+    monkeypatch.setitem(periodic_checker._shard_tasks, 'shards', 1)
+    return periodic_checker._check_agent_traffic_limits()
+
+
+def test_sharded_check_matches_single_shard(eager_shards, monkeypatch):
+    sharded = periodic_checker._check_agent_traffic_limits()
+
+    assert 'error' not in sharded
+    assert sharded.pop('shards') == SHARDS
+    assert 'skipped_shards' not in sharded
+
+    single = _single_shard_result(monkeypatch)
+    assert sharded == single
+    assert single['exceeded_agents'] == len(EXCEEDED_IDS)
+    assert single['disabled_users_count'] == len(EXCEEDED_IDS) * USERS_PER_AGENT
+
+
+def test_sharded_check_is_skipped_while_a_shard_lock_is_held(eager_shards):
+    with TaskLock(f"{periodic_checker.CHECK_LIMITS_LOCK}.1") as lock:
+        assert lock.acquired
+        result = periodic_checker._check_agent_traffic_limits()
+
+    assert result['skipped'] is True
+    assert result['reason'] == 'previous shards still running'
+
+    # The locks are all released again afterwards
+    result = periodic_checker._check_agent_traffic_limits()
+    assert 'skipped' not in result
+    assert result['exceeded_agents'] == len(EXCEEDED_IDS)
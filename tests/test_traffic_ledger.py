@@ -0,0 +1,116 @@
+"""
+Tests of reserve_traffic() in models/traffic_ledger.py
+
+They need HiddifyPanel and this package installed (pip install -e .), and
+run on a file-backed SQLite database so several threads can share it.
+"""
+import threading
+
+import pytest
+
+traffic_ledger = pytest.importorskip('hiddify_agent_traffic_manager.models.traffic_ledger')
+from hiddify_agent_traffic_manager.models.admin_hierarchy import AdminHierarchy  # noqa: E402
+from hiddifypanel.models.admin import AdminUser, AdminMode  # noqa: E402
+from sqlalchemy import Column, MetaData, Table, create_engine, event, select  # noqa: E402
+
+ONE_GIG = 1024 ** 3
+ROOT_ID = 1
+AGENT_ID = 2
+
+
+def _copy(table, metadata, names=None) -> Table:
+    """Copy of table without foreign keys (optionally only some columns)"""
+    return Table(table.name, metadata, *[
+        Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+               default=column.default.arg if column.default is not None else None)
+        for column in table.columns
+        if names is None or column.name in names
+    ])
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'ledger.db'}",
+        connect_args={'timeout': 60, 'check_same_thread': False}
+    )
+
+    # Take the write lock at BEGIN, as the row lock of the UPDATE would on MySQL
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _begin(connection):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    metadata = MetaData()
+    ledger = _copy(traffic_ledger.AgentTrafficLedger.__table__, metadata)
+    hierarchy = _copy(AdminHierarchy.__table__, metadata)
+    admins = _copy(AdminUser.__table__, metadata, ('id', 'mode'))
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(admins.insert(), [
+            {'id': ROOT_ID, 'mode': AdminMode.super_admin},
+            {'id': AGENT_ID, 'mode': AdminMode.agent},
+        ])
+        connection.execute(ledger.insert(), [
+            {'admin_id': ROOT_ID, 'consumed': 0, 'reserved': 0},
+            {'admin_id': AGENT_ID, 'consumed': 0, 'reserved': 0},
+        ])
+        connection.execute(hierarchy.insert(), [
+            {'ancestor_id': ROOT_ID, 'descendant_id': ROOT_ID, 'depth': 0},
+            {'ancestor_id': AGENT_ID, 'descendant_id': AGENT_ID, 'depth': 0},
+            {'ancestor_id': ROOT_ID, 'descendant_id': AGENT_ID, 'depth': 1},
+        ])
+    yield engine
+    engine.dispose()
+
+
+def _reserved(engine) -> dict:
+    ledger = traffic_ledger.AgentTrafficLedger.__table__
+    with engine.connect() as connection:
+        return dict(connection.execute(select(ledger.c.admin_id, ledger.c.reserved)).all())
+
+
+def test_concurrent_reservations_never_exceed_limit(engine):
+    limit = 10 * ONE_GIG
+    admitted = []
+    errors = []
+
+    def worker():
+        for _ in range(5):
+            try:
+                with engine.begin() as connection:
+                    if traffic_ledger.reserve_traffic(connection, AGENT_ID, ONE_GIG, limit):
+                        admitted.append(ONE_GIG)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reserved = _reserved(engine)
+    assert errors == []
+    assert reserved[AGENT_ID] == sum(admitted) <= limit
+    assert len(admitted) == 10
+    # The root admin is not an agent, so reservations never touch its row
+    assert reserved[ROOT_ID] == 0
+
+
+def test_rolled_back_reservation_is_released(engine):
+    class Rollback(Exception):
+        pass
+
+    with pytest.raises(Rollback):
+        with engine.begin() as connection:
+            assert traffic_ledger.reserve_traffic(connection, AGENT_ID, 4 * ONE_GIG, 5 * ONE_GIG)
+            raise Rollback()
+
+    with engine.begin() as connection:
+        assert traffic_ledger.reserve_traffic(connection, AGENT_ID, 5 * ONE_GIG, 5 * ONE_GIG)
+        assert not traffic_ledger.reserve_traffic(connection, AGENT_ID, 1, 5 * ONE_GIG)
+    assert _reserved(engine)[AGENT_ID] == 5 * ONE_GIG
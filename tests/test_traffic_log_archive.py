@@ -0,0 +1,118 @@
+"""
+Tests of the columnar archive in services/traffic_log_archive.py
+
+They need NumPy and HiddifyPanel with the Agent model and services
+installed; the archive is written under tmp_path.
+"""
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('numpy')
+archive_module = pytest.importorskip('hiddifypanel.services.traffic_log_archive')
+TrafficLogArchive = archive_module.TrafficLogArchive
+rows_to_columns = archive_module.rows_to_columns
+
+AGENT_ID = 3
+MONTH = datetime(2025, 1, 1)
+USER_IDS = [None, 10, 11, 12]
+
+
+def _rows(count: int = 600) -> list:
+    """Rows of one month with increasing ids and shuffled timestamps"""
+    rng = random.Random(42)
+    return [
+        {
+            'id': 1000 + i,
+            'user_id': rng.choice(USER_IDS),
+            'used_traffic': rng.randint(1, 10 ** 9),
+            'timestamp': MONTH + timedelta(seconds=rng.randint(0, 31 * 86400 - 1)),
+        }
+        for i in range(count)
+    ]
+
+
+def _expected(rows: list, start: datetime = None, end: datetime = None, user_id: int = None) -> int:
+    return sum(
+        row['used_traffic'] for row in rows
+        if (start is None or row['timestamp'] >= start)
+        and (end is None or row['timestamp'] < end)
+        and (user_id is None or (row['user_id'] or 0) == user_id)
+    )
+
+
+@pytest.fixture
+def rows():
+    return _rows()
+
+
+@pytest.fixture
+def archive(tmp_path, rows):
+    archive = TrafficLogArchive(str(tmp_path / 'archive'))
+    for offset in range(0, len(rows), 200):
+        archive.append(AGENT_ID, MONTH, rows_to_columns(rows[offset:offset + 200]))
+    return archive
+
+
+def _check_sums(archive, rows):
+    assert archive.range_sum(AGENT_ID) == _expected(rows)
+    for start, end in [
+        (datetime(2025, 1, 5), datetime(2025, 1, 12, 7, 30)),
+        (None, datetime(2025, 1, 20)),
+        (datetime(2025, 1, 31, 12), None),
+        (datetime(2024, 12, 1), datetime(2025, 3, 1)),
+    ]:
+        assert archive.range_sum(AGENT_ID, start, end) == _expected(rows, start, end)
+        assert archive.range_sum(AGENT_ID, start, end, user_id=11) == _expected(rows, start, end, user_id=11)
+    assert archive.range_sum(AGENT_ID, datetime(2025, 2, 1), datetime(2025, 3, 1)) == 0
+
+    totals = defaultdict(int)
+    for row in rows:
+        totals[row['user_id'] or 0] += row['used_traffic']
+    assert archive.user_totals(AGENT_ID) == dict(totals)
+
+    days = defaultdict(int)
+    for row in rows:
+        days[row['timestamp'].replace(hour=0, minute=0, second=0)] += row['used_traffic']
+    assert archive.daily_totals(AGENT_ID) == sorted(days.items())
+
+
+def test_round_trip(archive, rows):
+    assert archive.agents() == [AGENT_ID]
+    assert archive.months(AGENT_ID) == [MONTH]
+    assert len(archive.chunks(AGENT_ID, MONTH)) == 3
+
+    columns = archive.read(AGENT_ID, MONTH)
+    assert sorted(columns['id'].tolist()) == [row['id'] for row in rows]
+    timestamps = columns['timestamp'].tolist()
+    assert timestamps == sorted(timestamps)
+
+    _check_sums(archive, rows)
+    assert archive.total(agent_id=AGENT_ID) == _expected(rows)
+    assert archive.info()['rows'] == len(rows)
+
+
+def test_compact_keeps_the_sums(archive, rows):
+    assert archive.compact(AGENT_ID, MONTH) == len(rows)
+    assert len(archive.chunks(AGENT_ID, MONTH)) == 1
+
+    _check_sums(archive, rows)
+    assert archive.info()['rows'] == len(rows)
+
+
+def test_repeated_append_skips_archived_ids(archive, rows):
+    # A run interrupted after writing the files repeats the same batch
+    assert archive.append(AGENT_ID, MONTH, rows_to_columns(rows[200:400])) == 0
+    assert archive.append(AGENT_ID, MONTH, rows_to_columns(rows)) == 0
+
+    more = _rows(700)[600:]
+    assert archive.append(AGENT_ID, MONTH, rows_to_columns(rows[500:] + more)) == len(more)
+
+    assert archive.info()['rows'] == len(rows) + len(more)
+    _check_sums(archive, rows + more)
+
+    archive.compact(AGENT_ID, MONTH)
+    assert archive.append(AGENT_ID, MONTH, rows_to_columns(more)) == 0
+    _check_sums(archive, rows + more)
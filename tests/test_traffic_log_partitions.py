@@ -0,0 +1,79 @@
+"""
+Tests of the table-per-month mode of services/traffic_log_partitions.py
+
+They need HiddifyPanel with the Agent model and services installed, and run
+on an in-memory SQLite database.
+"""
+from datetime import datetime
+
+import pytest
+
+partitions = pytest.importorskip('hiddifypanel.services.traffic_log_partitions')
+from hiddifypanel.models.agent import TrafficLog, TrafficRollupWatermark  # noqa: E402
+from sqlalchemy import create_engine, select  # noqa: E402
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        TrafficLog.__table__.create(connection)
+        TrafficRollupWatermark.__table__.create(connection)
+        yield connection
+
+
+def _rows(timestamp: datetime, count: int) -> list:
+    return [
+        {'user_id': None, 'agent_id': 1, 'used_traffic': 100, 'timestamp': timestamp, 'description': None}
+        for _ in range(count)
+    ]
+
+
+def _ids(connection, router) -> list:
+    ids = []
+    for table in router.tables_for_range(connection):
+        ids += connection.execute(select(table.c.id)).scalars().all()
+    return ids
+
+
+def test_month_tables_created_ahead_share_one_id_counter(connection):
+    router = partitions.TrafficLogRouter('tables')
+    created = router.ensure_partitions(connection, months_ahead=2, now=datetime(2026, 10, 18))
+    assert created == ['traffic_log_202610', 'traffic_log_202611', 'traffic_log_202612']
+
+    router.insert(connection, _rows(datetime(2026, 10, 18), 3))
+    router.insert(connection, _rows(datetime(2026, 11, 2), 3))
+    router.insert(connection, _rows(datetime(2026, 10, 31), 2))
+
+    ids = _ids(connection, router)
+    assert len(ids) == 8
+    assert len(set(ids)) == 8
+
+
+def test_month_table_ids_continue_after_legacy_rows(connection):
+    connection.execute(TrafficLog.__table__.insert(), _rows(datetime(2026, 9, 30), 5))
+    router = partitions.TrafficLogRouter('tables')
+
+    rows = _rows(datetime(2026, 10, 1), 2)
+    router.insert(connection, rows)
+
+    assert [row['id'] for row in rows] == [6, 7]
+    assert sorted(_ids(connection, router)) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_old_months_are_dropped_only_once_rolled_up_and_archived(connection):
+    router = partitions.TrafficLogRouter('tables')
+    september, october = _rows(datetime(2026, 9, 10), 2), _rows(datetime(2026, 10, 10), 2)
+    router.insert(connection, september)
+    router.insert(connection, october)
+    watermarks = TrafficRollupWatermark.__table__
+    cutoff = datetime(2026, 11, 1)
+
+    # Rolled up to the middle of September only
+    connection.execute(watermarks.insert().values(name='traffic_log_202609', last_log_id=september[0]['id']))
+    assert router.drop_partitions_before(connection, cutoff) == []
+
+    connection.execute(watermarks.update().values(last_log_id=september[-1]['id']))
+    # Rolled up but still holding rows the archive has not moved
+    assert router.drop_partitions_before(connection, cutoff, require_empty=True) == []
+    assert router.drop_partitions_before(connection, cutoff) == ['traffic_log_202609']
@@ -0,0 +1,85 @@
+"""
+Tests of the traffic checks in utils/user_creation_hook.py
+
+They need HiddifyPanel and this package installed (pip install -e .).
+"""
+from types import SimpleNamespace
+
+import pytest
+
+hook = pytest.importorskip('hiddify_agent_traffic_manager.utils.user_creation_hook')
+traffic_ledger = pytest.importorskip('hiddify_agent_traffic_manager.models.traffic_ledger')
+from hiddifypanel.models.admin import AdminMode  # noqa: E402
+from hiddifypanel.models.user import User  # noqa: E402
+
+ONE_GIG = 1024 ** 3
+
+
+class FakeAgent:
+    """Agent whose pre-check passes, as when another transaction reserved the budget first"""
+    id = 7
+    name = 'agent'
+    mode = AdminMode.agent
+    traffic_limit = 10 * ONE_GIG
+    traffic_limit_GB = 10
+
+    def can_create_user_with_traffic(self, user_traffic_limit_GB=None):
+        return True, None
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    agent = FakeAgent()
+    monkeypatch.setattr(hook, 'AdminUser', SimpleNamespace(query=SimpleNamespace(get=lambda admin_id: agent)))
+    monkeypatch.setattr(hook, '_', lambda message: message)
+    return agent
+
+
+def test_insert_rejected_when_reservation_fails(agent, monkeypatch):
+    monkeypatch.setattr(traffic_ledger, 'reserve_traffic', lambda connection, admin_id, amount, limit: False)
+    user = User(added_by=agent.id, usage_limit=2 * ONE_GIG)
+
+    with pytest.raises(ValueError, match="Cannot create user due to traffic limit"):
+        hook._check_user_insert(None, user)
+
+
+def test_insert_admitted_when_reservation_succeeds(agent, monkeypatch):
+    reserved = []
+    monkeypatch.setattr(
+        traffic_ledger, 'reserve_traffic',
+        lambda connection, admin_id, amount, limit: reserved.append((admin_id, amount)) or True
+    )
+    user = User(added_by=agent.id, usage_limit=2 * ONE_GIG)
+
+    hook._check_user_insert(None, user)
+    assert reserved == [(agent.id, 2 * ONE_GIG)]
+
+
+def test_insert_without_owner_is_counted_on_the_reserved_agent(agent, monkeypatch):
+    from sqlalchemy import inspect
+
+    monkeypatch.setattr(hook, '_resolve_agent_id', lambda target: agent.id)
+    monkeypatch.setattr(traffic_ledger, 'reserve_traffic', lambda connection, admin_id, amount, limit: True)
+    user = User(usage_limit=2 * ONE_GIG)
+
+    hook._check_user_insert(None, user)
+    assert user.added_by == agent.id
+    assert inspect(user).info.get(traffic_ledger.RESERVED_KEY)
+
+
+def test_update_of_expired_limit_reserves_only_the_increase(agent, monkeypatch):
+    from sqlalchemy.orm import make_transient_to_detached
+
+    reserved = []
+    monkeypatch.setattr(
+        traffic_ledger, 'reserve_traffic',
+        lambda connection, admin_id, amount, limit: reserved.append((admin_id, amount)) or True
+    )
+    # The stored usage_limit, as the hook reads it back from the database
+    connection = SimpleNamespace(execute=lambda statement: SimpleNamespace(scalar=lambda: 2 * ONE_GIG))
+    user = User(id=5, added_by=agent.id)
+    make_transient_to_detached(user)  # usage_limit was never loaded
+    user.usage_limit = 3 * ONE_GIG
+
+    hook._check_user_update(connection, user)
+    assert reserved == [(agent.id, ONE_GIG)]
@@ -1,5 +1,7 @@
 from .traffic_calculator import AgentTrafficCalculator
 from .traffic_checker import AgentTrafficChecker
+from .query_counter import QueryCounter
+from .task_lock import TaskLock
 
-__all__ = ['AgentTrafficCalculator', 'AgentTrafficChecker']
+__all__ = ['AgentTrafficCalculator', 'AgentTrafficChecker', 'QueryCounter', 'TaskLock']
 
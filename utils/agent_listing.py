@@ -0,0 +1,54 @@
+"""
+Sort keys, status filters and keyset cursors shared by the agent listings
+
+The panel-side Agent model (models/agent.py, copied into hiddifypanel by
+the Agent system install) defines these; they are imported from there when
+it is installed. Plain plugin installs have no Agent model, so the same
+definitions are kept here for AgentTrafficCalculator.get_agents_traffic_page().
+"""
+try:
+    from hiddifypanel.models.agent import (  # noqa: F401
+        AGENT_SORT_KEYS, AGENT_STATUS_FILTERS, agent_sort_key, encode_agent_cursor, decode_agent_cursor
+    )
+except ImportError:
+    import base64
+    import json
+    from sqlalchemy import case, func
+
+    # Sort keys and status filters accepted by Agent.get_page() and
+    # AgentTrafficCalculator.get_agents_traffic_page()
+    AGENT_SORT_KEYS = ('id', 'used', 'remaining', 'usage_percentage')
+    AGENT_STATUS_FILTERS = ('exceeded', 'warning', 'unlimited', 'limited')
+
+
+    def agent_sort_key(sort: str, traffic_used, traffic_limit):
+        """
+        SQL sort expression of an agent listing (see AGENT_SORT_KEYS)
+
+        Works on columns as well as on bound literals, so a keyset cursor is
+        compared with exactly the same arithmetic. Unlimited agents sort as -1.
+        """
+        if sort == 'used':
+            return traffic_used
+        if sort == 'remaining':
+            remaining = traffic_limit - traffic_used
+            return func.coalesce(case((remaining < 0, 0), else_=remaining), -1)
+        if sort == 'usage_percentage':
+            return func.coalesce(traffic_used * 100.0 / func.nullif(traffic_limit, 0), -1)
+        raise ValueError(f"Unknown sort key: {sort}")
+
+
+    def encode_agent_cursor(agent_id: int, traffic_used, traffic_limit) -> str:
+        """Opaque keyset cursor pointing after the given agent row"""
+        data = {'id': agent_id, 'used': int(traffic_used or 0), 'limit': traffic_limit}
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+    def decode_agent_cursor(cursor: str) -> dict:
+        """Decode a cursor from encode_agent_cursor(), raising ValueError if invalid"""
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            limit = None if data['limit'] is None else int(data['limit'])
+            return {'id': int(data['id']), 'used': int(data['used']), 'limit': limit}
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError(f"Invalid cursor: {e}")
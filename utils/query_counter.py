@@ -0,0 +1,34 @@
+"""
+Utility for counting SQL statements, e.g. to measure listener overhead
+"""
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """
+    Count statements executed on an engine while the context is active
+    
+    Example:
+        with QueryCounter(db.engine) as counter:
+            sync_users_usage()
+        print(counter.count)
+    """
+    
+    def __init__(self, engine, keep_statements: bool = False):
+        self.engine = engine
+        self.keep_statements = keep_statements
+        self.count = 0
+        self.statements = []
+    
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        if self.keep_statements:
+            self.statements.append(statement)
+    
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return False
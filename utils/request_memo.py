@@ -0,0 +1,55 @@
+"""
+Request-scoped memoization of per-agent quota figures
+"""
+from functools import wraps
+
+from flask import g, has_request_context
+
+# Attribute of flask.g holding {(method name, agent id, args): value}
+_MEMO_ATTR = '_agent_traffic_memo'
+
+
+def _request_memo():
+    """The memo dict of the current request, or None outside of a request"""
+    if not has_request_context():
+        return None
+    memo = getattr(g, _MEMO_ATTR, None)
+    if memo is None:
+        memo = {}
+        setattr(g, _MEMO_ATTR, memo)
+    return memo
+
+
+def memoize_per_request(method):
+    """
+    Compute an AdminUser method at most once per request and agent
+    
+    Entries are dropped by invalidate_request_memo() when the request's own
+    writes touch the agent.
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        memo = _request_memo()
+        if memo is None or self.id is None:
+            return method(self, *args)
+        
+        key = (method.__name__, self.id, args)
+        if key not in memo:
+            memo[key] = method(self, *args)
+        return memo[key]
+    
+    return wrapper
+
+
+def invalidate_request_memo(agent_ids=None):
+    """Drop memoized figures of agent_ids (or all of them if None)"""
+    memo = _request_memo()
+    if not memo:
+        return
+    
+    if agent_ids is None:
+        memo.clear()
+        return
+    
+    for key in [key for key in memo if key[1] in agent_ids]:
+        del memo[key]
@@ -0,0 +1,227 @@
+"""
+Bounded LRU/TTL cache for per-agent traffic statistics
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+from .request_memo import invalidate_request_memo
+
+
+class AgentStatsCache:
+    """
+    کش آمار ترافیک ایجنت‌ها با محدودیت اندازه (LRU) و زمان انقضا (TTL)
+
+    Entries are keyed by agent id and dropped when they expire, when the
+    cache is full (least recently used first) or when invalidate() is called
+    for the agent.
+
+    The cache and its invalidation listeners are local to the process: a
+    change made by a Celery worker or another web worker (usage sync, the
+    adaptive checker, disabling users) does not reach this process's entries,
+    so they can be up to ttl seconds stale across processes.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize: int = None, ttl: float = None):
+        """Change size/TTL and drop all entries"""
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    def get(self, agent_id: int):
+        """Return a copy of the cached stats, or None on a miss"""
+        with self._lock:
+            entry = self._data.get(agent_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[agent_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(agent_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, agent_id: int, stats: dict):
+        """Store stats for agent_id"""
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[agent_id] = (time.monotonic() + self.ttl, dict(stats))
+            self._data.move_to_end(agent_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, agent_ids):
+        """Drop the entries of the given agent ids"""
+        with self._lock:
+            for agent_id in agent_ids:
+                if self._data.pop(agent_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def info(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+            }
+
+
+agent_stats_cache = AgentStatsCache()
+
+
+# session.info keys used by the invalidation listeners
+_DIRTY_ADMINS_KEY = 'agent_stats_dirty_admins'
+_INVALIDATE_ON_COMMIT_KEY = 'agent_stats_invalidate_on_commit'
+
+
+def _mark_dirty(target, *admin_ids):
+    """Remember admin ids whose users changed in this flush"""
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is None:
+        return
+    dirty = session.info.setdefault(_DIRTY_ADMINS_KEY, set())
+    dirty.update(admin_id for admin_id in admin_ids if admin_id)
+
+
+def _user_changed(mapper, connection, target):
+    """User inserted or deleted"""
+    _mark_dirty(target, target.added_by)
+
+
+def _user_updated(mapper, connection, target):
+    """User updated; only fields shown in the stats matter"""
+    from sqlalchemy.orm import attributes
+
+    changed = False
+    for name in ('current_usage', 'usage_limit', 'enable', 'added_by'):
+        if attributes.get_history(target, name).has_changes():
+            changed = True
+            break
+    if not changed:
+        return
+
+    owner_history = attributes.get_history(target, 'added_by')
+    _mark_dirty(target, target.added_by, *owner_history.deleted)
+
+
+def _admin_changed(mapper, connection, target):
+    """
+    Admin inserted or deleted
+
+    Its parent and the parent's ancestors gain or lose a sub-admin. The
+    parent is marked rather than the admin itself: the admin's own closure
+    rows may already be gone when the flush ends.
+    """
+    _mark_dirty(target, target.id, target.parent_admin_id)
+
+
+def _admin_updated(mapper, connection, target):
+    """traffic_limit, mode or hierarchy of an admin changed"""
+    from sqlalchemy.orm import attributes
+
+    for name in ('traffic_limit', 'mode', 'parent_admin_id', 'name'):
+        if attributes.get_history(target, name).has_changes():
+            # A moved admin also leaves the subtrees of its old parent chain
+            parent_history = attributes.get_history(target, 'parent_admin_id')
+            _mark_dirty(target, target.id, *parent_history.deleted)
+            return
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    """No-op 'set' listener; registered with active_history=True"""
+    return value
+
+
+def _session_after_flush(session, flush_context):
+    """Invalidate the dirty admins and all of their ancestors"""
+    dirty = session.info.pop(_DIRTY_ADMINS_KEY, None)
+    if not dirty:
+        return
+
+    from sqlalchemy import select
+    from ..models.admin_hierarchy import AdminHierarchy
+
+    hierarchy = AdminHierarchy.__table__
+    affected = set(dirty)
+    affected.update(
+        row[0] for row in session.connection().execute(
+            select(hierarchy.c.ancestor_id).where(hierarchy.c.descendant_id.in_(list(dirty)))
+        )
+    )
+
+    agent_stats_cache.invalidate(affected)
+    invalidate_request_memo(affected)
+    # Invalidate again once the transaction ends, in case another request
+    # cached the pre-commit figures in between
+    session.info.setdefault(_INVALIDATE_ON_COMMIT_KEY, set()).update(affected)
+
+
+def _session_after_transaction_end(session):
+    """Drop the entries touched by the finished (committed or rolled back) transaction"""
+    affected = session.info.pop(_INVALIDATE_ON_COMMIT_KEY, None)
+    if affected:
+        agent_stats_cache.invalidate(affected)
+        invalidate_request_memo(affected)
+
+
+def init_stats_cache(app=None):
+    """Configure the stats cache from the app config and register invalidation listeners"""
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from hiddifypanel.models.user import User
+    from hiddifypanel.models.admin import AdminUser
+
+    if app is not None:
+        agent_stats_cache.configure(
+            maxsize=int(app.config.get('AGENT_TRAFFIC_STATS_CACHE_SIZE', agent_stats_cache.maxsize)),
+            ttl=float(app.config.get('AGENT_TRAFFIC_STATS_CACHE_TTL', agent_stats_cache.ttl))
+        )
+
+    for target, name, listener in (
+        (User, 'after_insert', _user_changed),
+        (User, 'after_delete', _user_changed),
+        (User, 'after_update', _user_updated),
+        (AdminUser, 'after_insert', _admin_changed),
+        (AdminUser, 'after_delete', _admin_changed),
+        (AdminUser, 'after_update', _admin_updated),
+        (Session, 'after_flush', _session_after_flush),
+        (Session, 'after_commit', _session_after_transaction_end),
+        (Session, 'after_rollback', _session_after_transaction_end),
+    ):
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    # Load the old parent (if expired) when it is changed, so the old parent
+    # chain is known to _admin_updated
+    if not event.contains(AdminUser.parent_admin_id, 'set', _load_old_value):
+        event.listen(AdminUser.parent_admin_id, 'set', _load_old_value, active_history=True, retval=True)
+
+    logger.debug(f"Agent stats cache initialized: {agent_stats_cache.info()}")
@@ -0,0 +1,163 @@
+"""
+Cross-process lock for the periodic agent traffic tasks
+قفل سراسری برای جلوگیری از اجرای هم‌زمان بررسی ترافیک ایجنت‌ها
+
+MySQL/MariaDB use GET_LOCK(), PostgreSQL uses pg_try_advisory_lock(); both
+are released automatically if the holding connection dies. Other databases
+(SQLite, single-node installs) fall back to an fcntl lock on a file in
+AGENT_TRAFFIC_LOCK_DIR (default: the system temp directory).
+"""
+import os
+import tempfile
+import zlib
+
+from loguru import logger
+
+
+class TaskLock:
+    """
+    Non-blocking named lock, usable as a context manager
+
+    Example:
+        with TaskLock('agent_traffic.check_limits') as lock:
+            if not lock.acquired:
+                return  # another run is in progress
+            ...
+
+    Pass connection to hold several database locks on one session instead
+    of one pooled connection each (MySQL >= 5.7 and PostgreSQL allow it);
+    the caller then owns the connection and closes it after the locks.
+    """
+
+    def __init__(self, name: str, engine=None, lock_dir: str = None, connection=None):
+        self.name = name
+        self.engine = engine
+        self.lock_dir = lock_dir
+        self.connection = connection
+        self.acquired = False
+        self.backend = None
+        self._connection = None
+        self._file = None
+
+    def _engine(self):
+        if self.engine is None:
+            from hiddifypanel.database import db
+            self.engine = db.engine
+        return self.engine
+
+    def _lock_path(self) -> str:
+        lock_dir = self.lock_dir
+        if lock_dir is None:
+            from flask import current_app
+            try:
+                lock_dir = current_app.config.get('AGENT_TRAFFIC_LOCK_DIR')
+            except RuntimeError:
+                # Outside of an app context
+                lock_dir = None
+        return os.path.join(lock_dir or tempfile.gettempdir(), f"{self.name}.lock")
+
+    def acquire(self) -> bool:
+        """Try to take the lock without waiting"""
+        try:
+            dialect = (self.connection or self._engine()).dialect.name
+        except Exception as e:
+            logger.debug(f"No database engine for lock {self.name}, using a file lock: {e}")
+            dialect = None
+
+        if dialect in ('mysql', 'mariadb'):
+            self.acquired = self._acquire_db("SELECT GET_LOCK(:name, 0)", {'name': self.name})
+            self.backend = 'mysql'
+        elif dialect == 'postgresql':
+            self.acquired = self._acquire_db("SELECT pg_try_advisory_lock(:key)", {'key': self._pg_key()})
+            self.backend = 'postgresql'
+        else:
+            self.acquired = self._acquire_file()
+            self.backend = 'file'
+        return self.acquired
+
+    def release(self):
+        """Release the lock if it is held"""
+        if not self.acquired:
+            return
+        try:
+            if self.backend == 'mysql':
+                self._release_db("SELECT RELEASE_LOCK(:name)", {'name': self.name})
+            elif self.backend == 'postgresql':
+                self._release_db("SELECT pg_advisory_unlock(:key)", {'key': self._pg_key()})
+            else:
+                self._release_file()
+        finally:
+            self.acquired = False
+
+    def _pg_key(self) -> int:
+        """Signed 32-bit key derived from the lock name"""
+        key = zlib.crc32(self.name.encode())
+        return key - (1 << 32) if key >= (1 << 31) else key
+
+    def _acquire_db(self, statement: str, params: dict) -> bool:
+        from sqlalchemy import text
+
+        # A dedicated connection: the lock lives as long as it stays open
+        self._connection = self.connection or self._engine().connect()
+        try:
+            acquired = bool(self._connection.execute(text(statement), params).scalar())
+        except Exception:
+            self._close_connection()
+            raise
+        if not acquired:
+            self._close_connection()
+        return acquired
+
+    def _release_db(self, statement: str, params: dict):
+        from sqlalchemy import text
+
+        try:
+            self._connection.execute(text(statement), params)
+        finally:
+            self._close_connection()
+
+    def _close_connection(self):
+        """Close the lock's own connection; a shared one is left to its owner"""
+        if self._connection is not self.connection:
+            self._connection.close()
+        self._connection = None
+
+    def _acquire_file(self) -> bool:
+        try:
+            import fcntl
+        except ImportError:
+            logger.warning(f"No database lock or fcntl available, running {self.name} without a lock")
+            return True
+
+        self._file = open(self._lock_path(), 'a+')
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+
+        # Holder's pid, for debugging only
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(os.getpid()))
+        self._file.flush()
+        return True
+
+    def _release_file(self):
+        if self._file is None:
+            return
+        import fcntl
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
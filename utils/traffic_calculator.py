@@ -7,6 +7,30 @@ from loguru import logger
 ONE_GIG = 1024 * 1024 * 1024
 
 
+def _agent_traffic_dict(agent_id, name, uuid, traffic_limit, total_traffic, users_count) -> dict:
+    """Build the per-agent result dict of get_all_agents_traffic()"""
+    if traffic_limit is None:
+        traffic_limit_GB = None
+        remaining_traffic_GB = None
+        is_exceeded = False
+    else:
+        traffic_limit_GB = traffic_limit / ONE_GIG
+        remaining_traffic_GB = max(0, traffic_limit - total_traffic) / ONE_GIG
+        is_exceeded = total_traffic >= traffic_limit
+    
+    return {
+        'agent_id': agent_id,
+        'agent_name': name,
+        'agent_uuid': uuid,
+        'total_traffic_bytes': total_traffic,
+        'total_traffic_GB': total_traffic / ONE_GIG,
+        'traffic_limit_GB': traffic_limit_GB,
+        'remaining_traffic_GB': remaining_traffic_GB,
+        'is_limit_exceeded': is_exceeded,
+        'users_count': users_count
+    }
+
+
 class AgentTrafficCalculator:
     """کلاس برای محاسبه ترافیک ایجنت‌ها"""
     
@@ -43,41 +67,201 @@ class AgentTrafficCalculator:
         total_bytes = AgentTrafficCalculator.calculate_agent_traffic(agent_id)
         return total_bytes / ONE_GIG
     
+    @staticmethod
+    def _agent_tree(limited_only: bool = False):
+        """
+        Subquery of (agent_id, admin_id) rows
+        
+        Each agent is mapped to itself and to all of its sub-admins through
+        the admin_hierarchy closure table.
+        """
+        from sqlalchemy import select
+        from hiddifypanel.models.admin import AdminUser, AdminMode
+        from ..models.admin_hierarchy import AdminHierarchy
+        
+        conditions = [AdminUser.mode == AdminMode.agent]
+        if limited_only:
+            conditions.append(AdminUser.traffic_limit.isnot(None))
+        
+        return select(
+            AdminHierarchy.ancestor_id.label('agent_id'),
+            AdminHierarchy.descendant_id.label('admin_id')
+        ).join(
+            AdminUser, AdminUser.id == AdminHierarchy.ancestor_id
+        ).where(*conditions).subquery('agent_tree')
+    
+    @staticmethod
+    def get_exceeded_agent_ids(shard: int = None, shards: int = None) -> list:
+        """
+        شناسه ایجنت‌هایی که مصرفشان از حد مجاز گذشته است
+        
+        Each limited agent's consumed counter is compared with its
+        traffic_limit on its own agent_traffic_ledger row, so no users are
+        aggregated (run reconcile_traffic_ledger() first to correct drift).
+        
+        Args:
+            shard, shards: only agents with id % shards == shard
+        
+        Returns:
+            لیست شناسه ایجنت‌های متجاوز
+        """
+        from sqlalchemy import select
+        from hiddifypanel.database import db
+        from hiddifypanel.models.admin import AdminUser, AdminMode
+        from ..models.traffic_ledger import AgentTrafficLedger
+        
+        stmt = select(AdminUser.id).join(
+            AgentTrafficLedger, AgentTrafficLedger.admin_id == AdminUser.id
+        ).where(
+            AdminUser.mode == AdminMode.agent,
+            AdminUser.traffic_limit.isnot(None),
+            AgentTrafficLedger.consumed >= AdminUser.traffic_limit
+        )
+        if shards and shards > 1:
+            stmt = stmt.where(AdminUser.id % shards == shard)
+        
+        return [row[0] for row in db.session.execute(stmt)]
+    
     @staticmethod
     def get_all_agents_traffic():
         """
         دریافت ترافیک تمام ایجنت‌ها
         
+        Totals come from the agent_traffic_ledger counters, like
+        get_agents_traffic_page(), so both listings report the same figures.
+        
         Returns:
             لیست دیکشنری شامل اطلاعات ترافیک هر ایجنت
         """
+        from sqlalchemy import select
+        from hiddifypanel.database import db
         from hiddifypanel.models.admin import AdminUser, AdminMode
+        from hiddifypanel.models.user import User
+        from ..models.traffic_ledger import AgentTrafficLedger
+        
+        tree = AgentTrafficCalculator._agent_tree()
+        
+        # User counts for every agent in one grouped query
+        users_counts = dict(db.session.execute(
+            select(
+                tree.c.agent_id, func.count(User.id)
+            ).select_from(tree).join(
+                User, User.added_by == tree.c.admin_id
+            ).group_by(tree.c.agent_id)
+        ).all())
         
-        agents = AdminUser.query.filter(
+        agents = db.session.query(
+            AdminUser.id, AdminUser.name, AdminUser.uuid, AdminUser.traffic_limit,
+            func.coalesce(AgentTrafficLedger.consumed, 0)
+        ).outerjoin(
+            AgentTrafficLedger, AgentTrafficLedger.admin_id == AdminUser.id
+        ).filter(
             AdminUser.mode == AdminMode.agent
         ).all()
         
-        result = []
-        for agent in agents:
-            total_traffic = agent.get_total_traffic()
-            total_traffic_GB = total_traffic / ONE_GIG
-            traffic_limit_GB = agent.traffic_limit_GB
-            remaining_traffic_GB = agent.get_remaining_traffic_GB()
-            is_exceeded = agent.is_traffic_limit_exceeded()
+        return [
+            _agent_traffic_dict(agent_id, name, uuid, traffic_limit, int(total or 0), users_counts.get(agent_id, 0))
+            for agent_id, name, uuid, traffic_limit, total in agents
+        ]
+    
+    @staticmethod
+    def get_agents_traffic_page(limit: int = 50, cursor: str = None, sort: str = 'id',
+                                descending: bool = False, status: str = None):
+        """
+        دریافت یک صفحه از ترافیک ایجنت‌ها (keyset pagination)
+        
+        Totals come from the agent_traffic_ledger counters, so sorting and
+        filtering happen in SQL and only the page's user counts are grouped.
+        
+        Args:
+            limit: اندازه صفحه
+            cursor: cursor صفحه قبلی
+            sort: یکی از AGENT_SORT_KEYS
+            descending: جهت مرتب‌سازی
+            status: فیلتر اختیاری، یکی از AGENT_STATUS_FILTERS
             
-            result.append({
-                'agent_id': agent.id,
-                'agent_name': agent.name,
-                'agent_uuid': agent.uuid,
-                'total_traffic_bytes': total_traffic,
-                'total_traffic_GB': total_traffic_GB,
-                'traffic_limit_GB': traffic_limit_GB,
-                'remaining_traffic_GB': remaining_traffic_GB,
-                'is_limit_exceeded': is_exceeded,
-                'users_count': agent.recursive_users_query().count()
-            })
-        
-        return result
+        Returns:
+            tuple: (لیست دیکشنری‌ها, next_cursor)
+        """
+        from sqlalchemy import select, and_, or_, literal, BigInteger
+        from hiddifypanel.database import db
+        from hiddifypanel.models.admin import AdminUser, AdminMode
+        from hiddifypanel.models.user import User
+        from .agent_listing import agent_sort_key, decode_agent_cursor, encode_agent_cursor
+        from ..models.admin_hierarchy import AdminHierarchy
+        from ..models.traffic_ledger import AgentTrafficLedger
+        
+        consumed = func.coalesce(AgentTrafficLedger.consumed, 0)
+        traffic_limit = AdminUser.traffic_limit
+        
+        query = db.session.query(
+            AdminUser.id, AdminUser.name, AdminUser.uuid, traffic_limit, consumed
+        ).outerjoin(
+            AgentTrafficLedger, AgentTrafficLedger.admin_id == AdminUser.id
+        ).filter(
+            AdminUser.mode == AdminMode.agent
+        )
+        
+        if status == 'unlimited':
+            query = query.filter(traffic_limit.is_(None))
+        elif status == 'limited':
+            query = query.filter(traffic_limit.isnot(None))
+        elif status == 'exceeded':
+            query = query.filter(traffic_limit.isnot(None), consumed >= traffic_limit)
+        elif status == 'warning':
+            query = query.filter(traffic_limit > 0, consumed * 100 > traffic_limit * 90)
+        elif status is not None:
+            raise ValueError(f"Unknown status filter: {status}")
+        
+        key = AdminUser.id if sort == 'id' else agent_sort_key(sort, consumed, traffic_limit)
+        
+        if cursor:
+            last = decode_agent_cursor(cursor)
+            after_id = AdminUser.id < last['id'] if descending else AdminUser.id > last['id']
+            if sort == 'id':
+                query = query.filter(after_id)
+            else:
+                last_key = agent_sort_key(
+                    sort,
+                    literal(last['used'], BigInteger),
+                    literal(last['limit'], BigInteger)
+                )
+                after_key = key < last_key if descending else key > last_key
+                query = query.filter(or_(after_key, and_(key == last_key, after_id)))
+        
+        if sort == 'id':
+            order_by = [AdminUser.id.desc() if descending else AdminUser.id.asc()]
+        elif descending:
+            order_by = [key.desc(), AdminUser.id.desc()]
+        else:
+            order_by = [key.asc(), AdminUser.id.asc()]
+        
+        rows = query.order_by(*order_by).limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_id, _name, _uuid, last_limit, last_used = rows[-1]
+            next_cursor = encode_agent_cursor(last_id, last_used, last_limit)
+        
+        # User counts only for the agents on this page
+        page_ids = [row[0] for row in rows]
+        users_counts = {}
+        if page_ids:
+            users_counts = dict(db.session.execute(
+                select(
+                    AdminHierarchy.ancestor_id, func.count(User.id)
+                ).join(
+                    User, User.added_by == AdminHierarchy.descendant_id
+                ).where(
+                    AdminHierarchy.ancestor_id.in_(page_ids)
+                ).group_by(AdminHierarchy.ancestor_id)
+            ).all())
+        
+        items = [
+            _agent_traffic_dict(agent_id, name, uuid, agent_limit, int(total or 0), users_counts.get(agent_id, 0))
+            for agent_id, name, uuid, agent_limit, total in rows
+        ]
+        return items, next_cursor
     
     @staticmethod
     def get_agent_traffic_stats(agent_id: int) -> dict:
@@ -92,20 +276,25 @@ class AgentTrafficCalculator:
         """
         from hiddifypanel.models.admin import AdminUser
         from hiddifypanel.models.user import User
+        from .stats_cache import agent_stats_cache
+        
+        cached = agent_stats_cache.get(agent_id)
+        if cached is not None:
+            return cached
         
         agent = AdminUser.query.get(agent_id)
         if not agent:
             return None
         
-        total_traffic = agent.get_total_traffic()
+        total_traffic, allocated_traffic = agent.get_ledger_counters()
         total_traffic_GB = total_traffic / ONE_GIG
         traffic_limit_GB = agent.traffic_limit_GB
         remaining_traffic_GB = agent.get_remaining_traffic_GB()
         is_exceeded = agent.is_traffic_limit_exceeded()
-        users_count = agent.recursive_users_query().count()
-        active_users_count = agent.recursive_users_query().filter(User.enable == True).count()
+        users_count = agent.hierarchy_users_query().count()
+        active_users_count = agent.hierarchy_users_query().filter(User.enable == True).count()
         
-        return {
+        stats = {
             'agent_id': agent.id,
             'agent_name': agent.name,
             'agent_uuid': agent.uuid,
@@ -113,9 +302,12 @@ class AgentTrafficCalculator:
             'total_traffic_GB': round(total_traffic_GB, 2),
             'traffic_limit_GB': traffic_limit_GB,
             'remaining_traffic_GB': round(remaining_traffic_GB, 2) if remaining_traffic_GB is not None else None,
+            'allocated_traffic_GB': round(allocated_traffic / ONE_GIG, 2),
             'is_limit_exceeded': is_exceeded,
             'users_count': users_count,
             'active_users_count': active_users_count,
             'usage_percentage': round((total_traffic_GB / traffic_limit_GB * 100), 2) if traffic_limit_GB else None
         }
+        agent_stats_cache.set(agent_id, stats)
+        return stats
 
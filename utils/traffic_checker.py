@@ -96,19 +96,20 @@ class AgentTrafficChecker:
         Returns:
             تعداد ایجنت‌هایی که از حد تجاوز کرده‌اند
         """
-        from hiddifypanel.models.admin import AdminUser, AdminMode
+        from hiddifypanel.models.admin import AdminUser
+        from .traffic_calculator import AgentTrafficCalculator
         
-        agents = AdminUser.query.filter(
-            AdminUser.mode == AdminMode.agent
-        ).all()
+        exceeded_ids = AgentTrafficCalculator.get_exceeded_agent_ids()
+        if not exceeded_ids:
+            return 0
         
-        exceeded_count = 0
+        agents = AdminUser.query.filter(AdminUser.id.in_(exceeded_ids)).all()
         for agent in agents:
-            if agent.traffic_limit_GB is None:
-                continue  # Skip agents without traffic limit
-            
-            if AgentTrafficChecker.check_and_disable_if_exceeded(agent.id):
-                exceeded_count += 1
+            logger.warning(
+                f"Agent {agent.name} (ID: {agent.id}) has exceeded traffic limit. "
+                f"Disabling all users..."
+            )
+            disabled_count = agent.disable_all_users()
+            logger.info(f"Disabled {disabled_count} users for agent {agent.name}")
         
-        return exceeded_count
-
+        return len(agents)
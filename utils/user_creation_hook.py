@@ -1,120 +1,277 @@
 """
 Hook برای بررسی ترافیک قبل از ایجاد کاربر
 """
-from sqlalchemy import event
+from contextlib import contextmanager
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
 from hiddifypanel.models.user import User
 from hiddifypanel.models.admin import AdminUser
 from loguru import logger
 from flask_babel import gettext as _
 
 
-def setup_user_creation_hook():
-    """Setup hook to check traffic before user creation"""
+# session.info keys used by bulk_user_import()
+_BATCH_MODE_KEY = 'agent_traffic_batch_mode'
+_REJECTED_KEY = 'agent_traffic_rejected_users'
+
+
+@contextmanager
+def bulk_user_import(session=None):
+    """
+    حالت دسته‌ای برای وارد کردن تعداد زیادی کاربر
     
-    @event.listens_for(User, 'before_insert', propagate=True)
-    def check_traffic_before_user_insert(mapper, connection, target):
-        """بررسی ترافیک قبل از insert کردن کاربر"""
-        # Get the agent who is creating this user
-        agent_id = target.added_by
+    While active, pending User inserts are checked once per flush: they are
+    grouped by agent, each agent's limit and ledger row are loaded once, and
+    the rows are admitted in order against the agent's unreserved budget.
+    The admitted total is then reserved with one atomic UPDATE per agent.
+    Rows that would overflow the budget are expunged instead of failing the
+    whole flush.
+    
+    Yields the list of (user, reason) tuples rejected so far.
+    
+    Example:
+        with bulk_user_import() as rejected:
+            db.session.add_all(users)
+            db.session.commit()
+    """
+    if session is None:
+        from hiddifypanel.database import db
+        session = db.session
+    
+    session.info[_BATCH_MODE_KEY] = True
+    rejected = session.info.setdefault(_REJECTED_KEY, [])
+    try:
+        yield rejected
+    finally:
+        session.info.pop(_BATCH_MODE_KEY, None)
+        session.info.pop(_REJECTED_KEY, None)
+
+
+def _resolve_agent_id(target):
+    """Admin id a new user is being created for"""
+    agent_id = target.added_by
+    
+    if not agent_id:
+        # If no agent specified, use current admin
+        from flask import g
+        if hasattr(g, 'account') and isinstance(g.account, AdminUser):
+            agent_id = g.account.id
+        else:
+            agent_id = 1  # Owner
+    
+    return agent_id
+
+
+def _check_batch_traffic(session, users):
+    """Admit pending users per agent against its unreserved budget and reserve it"""
+    from hiddifypanel.models.admin import AdminMode
+    from ..models.traffic_ledger import AgentTrafficLedger, reserve_traffic, mark_reserved, clear_reserved
+    
+    users_by_agent = {}
+    for user in users:
+        clear_reserved(user)
+        agent_id = _resolve_agent_id(user)
+        # The ledger listeners count the user on added_by, so it has to be
+        # the admin the reservation is made on
+        user.added_by = agent_id
+        users_by_agent.setdefault(agent_id, []).append(user)
+    
+    agent_ids = list(users_by_agent)
+    agents = {
+        agent.id: agent
+        for agent in session.query(AdminUser).filter(AdminUser.id.in_(agent_ids))
+        if agent.mode == AdminMode.agent and agent.traffic_limit is not None
+    }
+    if not agents:
+        return []
+    
+    counters = {
+        admin_id: (consumed, reserved)
+        for admin_id, consumed, reserved in session.query(
+            AgentTrafficLedger.admin_id, AgentTrafficLedger.consumed, AgentTrafficLedger.reserved
+        ).filter(
+            AgentTrafficLedger.admin_id.in_(list(agents))
+        )
+    }
+    
+    connection = session.connection()
+    rejected = []
+    for agent_id, agent in agents.items():
+        consumed, reserved = counters.get(agent_id, (0, 0))
+        budget = agent.traffic_limit - reserved
+        exhausted = consumed >= agent.traffic_limit
         
-        if not agent_id:
-            # If no agent specified, use current admin
-            from flask import g
-            if hasattr(g, 'account') and isinstance(g.account, AdminUser):
-                agent_id = g.account.id
+        admitted = []
+        agent_rejected = 0
+        for user in users_by_agent[agent_id]:
+            user_limit = user.usage_limit or 0
+            if exhausted or user_limit > budget:
+                rejected.append((user, _("Cannot create user due to traffic limit")))
+                agent_rejected += 1
             else:
-                agent_id = 1  # Owner
-        
-        agent = AdminUser.query.get(agent_id)
-        if not agent:
-            logger.warning(f"Agent with ID {agent_id} not found, skipping traffic check")
-            return
-        
-        # Only check for agents
-        from hiddifypanel.models.admin import AdminMode
-        if agent.mode != AdminMode.agent:
-            return  # Not an agent, skip check
-        
-        # Check if agent has traffic limit
-        if agent.traffic_limit_GB is None:
-            return  # No limit set, allow creation
+                budget -= user_limit
+                admitted.append(user)
         
-        # Get user traffic limit
-        user_traffic_limit_GB = target.usage_limit_GB if hasattr(target, 'usage_limit') and target.usage_limit else None
+        # Another transaction may have reserved part of the budget since it was read
+        if admitted and not reserve_traffic(
+            connection, agent_id, sum(user.usage_limit or 0 for user in admitted), agent.traffic_limit
+        ):
+            rejected.extend((user, _("Cannot create user due to traffic limit")) for user in admitted)
+            agent_rejected += len(admitted)
+            admitted = []
         
-        # Check if agent can create this user
-        can_create, error_msg = agent.can_create_user_with_traffic(user_traffic_limit_GB)
+        for user in admitted:
+            mark_reserved(user)
         
-        if not can_create:
-            error_message = error_msg or _("Cannot create user due to traffic limit")
-            logger.error(
-                f"User creation blocked for agent {agent.name} (ID: {agent_id}). "
-                f"Reason: {error_message}"
+        if agent_rejected:
+            logger.warning(
+                f"Bulk user import for agent {agent.name} (ID: {agent_id}): "
+                f"{agent_rejected} of {len(users_by_agent[agent_id])} user(s) rejected due to traffic limit"
             )
-            raise ValueError(error_message)
     
-    @event.listens_for(User, 'before_update', propagate=True)
-    def check_traffic_before_user_update(mapper, connection, target):
-        """بررسی ترافیک قبل از update کردن کاربر (اگر usage_limit تغییر کند)"""
-        from sqlalchemy.orm import inspect
-        
-        # Check if usage_limit is being updated using SQLAlchemy inspect
-        insp = inspect(target)
-        if not insp.has_identity:
-            return  # New object, not an update
-        
-        # Get changed attributes
-        attrs = insp.attrs
-        usage_limit_changed = 'usage_limit' in attrs and attrs['usage_limit'].history.has_changes()
-        
-        if not usage_limit_changed:
-            return  # usage_limit not changed, skip check
-        
-        agent_id = target.added_by
-        if not agent_id:
-            return
-        
-        agent = AdminUser.query.get(agent_id)
-        if not agent:
-            return
-        
-        from hiddifypanel.models.admin import AdminMode
-        if agent.mode != AdminMode.agent:
+    return rejected
+
+
+def _check_user_insert(connection, target):
+    """Reserve a new user's usage_limit on its agent, raising ValueError if it does not fit"""
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is not None and session.info.get(_BATCH_MODE_KEY):
+        return  # Already checked by check_traffic_before_batch_flush
+    
+    from ..models.traffic_ledger import reserve_traffic, mark_reserved, clear_reserved
+    clear_reserved(target)
+    
+    # Get the agent who is creating this user; the ledger listeners count
+    # the user on added_by, so it has to be the admin the reservation is on
+    agent_id = _resolve_agent_id(target)
+    target.added_by = agent_id
+    
+    agent = AdminUser.query.get(agent_id)
+    if not agent:
+        logger.warning(f"Agent with ID {agent_id} not found, skipping traffic check")
+        return
+    
+    # Only check for agents
+    from hiddifypanel.models.admin import AdminMode
+    if agent.mode != AdminMode.agent:
+        return  # Not an agent, skip check
+    
+    # Check if agent has traffic limit
+    if agent.traffic_limit_GB is None:
+        return  # No limit set, allow creation
+    
+    # Reserve the user's traffic limit on the agent's ledger row; this is
+    # the admission check and is undone if the transaction rolls back
+    user_limit = target.usage_limit or 0
+    if not reserve_traffic(connection, agent_id, user_limit, agent.traffic_limit):
+        _allowed, error_msg = agent.can_create_user_with_traffic(user_limit / (1024**3) if user_limit else None)
+        error_message = error_msg or _("Cannot create user due to traffic limit")
+        logger.error(
+            f"User creation blocked for agent {agent.name} (ID: {agent_id}). "
+            f"Reason: {error_message}"
+        )
+        raise ValueError(error_message)
+    
+    mark_reserved(target)
+
+
+def _stored_usage_limit(connection, target, history):
+    """usage_limit of target before the pending change, read back if it was never loaded"""
+    if history.deleted:
+        return history.deleted[0] or 0
+    # Expired or unloaded before it was set, so the history has no old value
+    users = User.__table__
+    return connection.execute(
+        select(users.c.usage_limit).where(users.c.id == target.id)
+    ).scalar() or 0
+
+
+def _check_user_update(connection, target):
+    """Reserve a raised usage_limit on the user's agent, raising ValueError if it does not fit"""
+    from sqlalchemy.orm import inspect
+    from ..models.traffic_ledger import reserve_traffic, mark_reserved, clear_reserved
+    
+    # Check if usage_limit is being updated using SQLAlchemy inspect
+    insp = inspect(target)
+    if not insp.has_identity:
+        return  # New object, not an update
+    clear_reserved(target)
+    
+    # Get changed attributes
+    attrs = insp.attrs
+    usage_limit_changed = 'usage_limit' in attrs and attrs['usage_limit'].history.has_changes()
+    
+    if not usage_limit_changed:
+        return  # usage_limit not changed, skip check
+    
+    agent_id = target.added_by
+    if not agent_id:
+        return
+    
+    agent = AdminUser.query.get(agent_id)
+    if not agent:
+        return
+    
+    from hiddifypanel.models.admin import AdminMode
+    if agent.mode != AdminMode.agent:
+        return
+    
+    if agent.traffic_limit_GB is None:
+        return
+    
+    # Get old and new usage_limit values
+    old_value = _stored_usage_limit(connection, target, attrs['usage_limit'].history)
+    new_value = target.usage_limit or 0
+    
+    # Lowering a limit can never push the agent further over its limit
+    if new_value <= old_value:
+        return
+    
+    # Moving the user to another owner is accounted by the ledger listeners
+    if attrs['added_by'].history.has_changes():
+        return
+    
+    # Reserve only the increase on the agent's allocated counter, in the
+    # flush's transaction, so the check is one conditional row update
+    if not reserve_traffic(connection, agent_id, new_value - old_value, agent.traffic_limit):
+        error_message = _("Updating user traffic limit would exceed agent's traffic limit")
+        _consumed, allocated = agent.get_ledger_counters()
+        logger.error(
+            f"User update blocked for agent {agent.name} (ID: {agent_id}). "
+            f"New allocation would exceed limit: {(allocated - old_value + new_value)/(1024**3):.2f} GB > {agent.traffic_limit_GB} GB"
+        )
+        raise ValueError(error_message)
+    
+    mark_reserved(target)
+
+
+def setup_user_creation_hook():
+    """Setup hook to check traffic before user creation"""
+    
+    @event.listens_for(Session, 'before_flush')
+    def check_traffic_before_batch_flush(session, flush_context, instances):
+        """بررسی دسته‌ای ترافیک کاربران جدید در حالت bulk_user_import"""
+        if not session.info.get(_BATCH_MODE_KEY):
             return
         
-        if agent.traffic_limit_GB is None:
+        new_users = [obj for obj in session.new if isinstance(obj, User)]
+        if not new_users:
             return
         
-        # Get old and new usage_limit values
-        old_value = attrs['usage_limit'].history.deleted[0] if attrs['usage_limit'].history.deleted else 0
-        new_value = target.usage_limit or 0
-        
-        # Get current total traffic (excluding this user's old limit, including new limit)
-        # We need to get total from database excluding this user, then add new limit
-        from hiddifypanel.database import db
-        from hiddifypanel.models.user import User
-        from sqlalchemy import func
-        
-        admin_ids = agent.recursive_sub_admins_ids()
-        # Get total traffic excluding this user
-        total_excluding_user = db.session.query(
-            func.coalesce(func.sum(User.current_usage), 0)
-        ).filter(
-            User.added_by.in_(admin_ids),
-            User.id != target.id
-        ).scalar() or 0
-        
-        # Calculate new total with new user limit
-        new_total = total_excluding_user + new_value
-        agent_limit = int(agent.traffic_limit_GB * (1024**3))
-        
-        if new_total > agent_limit:
-            error_message = _("Updating user traffic limit would exceed agent's traffic limit")
-            logger.error(
-                f"User update blocked for agent {agent.name} (ID: {agent_id}). "
-                f"New total would exceed limit: {new_total/(1024**3):.2f} GB > {agent.traffic_limit_GB} GB"
-            )
-            raise ValueError(error_message)
+        for user, reason in _check_batch_traffic(session, new_users):
+            session.expunge(user)
+            session.info.setdefault(_REJECTED_KEY, []).append((user, reason))
+    
+    @event.listens_for(User, 'before_insert', propagate=True)
+    def check_traffic_before_user_insert(mapper, connection, target):
+        """بررسی ترافیک قبل از insert کردن کاربر"""
+        _check_user_insert(connection, target)
+    
+    @event.listens_for(User, 'before_update', propagate=True)
+    def check_traffic_before_user_update(mapper, connection, target):
+        """بررسی ترافیک قبل از update کردن کاربر (اگر usage_limit تغییر کند)"""
+        _check_user_update(connection, target)
 
 
 def init_user_creation_hook():